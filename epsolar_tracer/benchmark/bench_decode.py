@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Microbenchmark of the epsolar_tracer per frame decode and JSON cost.
+
+Compares the v0.1 parse_sensor_data, with int.from_bytes on slices per field,
+and TracerMsg.to_json, with json.dumps of the instance dict, with the
+CommandDecoder compiled from REGISTER_MAP and its record, and checks both give
+the same JSON. Reading and publishing are not included.
+
+Usage: python3 bench_decode.py [iterations]
+"""
+
+import os
+import random
+import sys
+import timeit
+
+# Allow depend on epsolar_tracer.py in the parent directory, and the v0.1
+# baseline in bench_scanner.py.
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(1, os.path.dirname(__file__))
+import epsolar_tracer
+from bench_scanner import BaselineTracerMsg, baseline_parse_sensor_data
+
+RECORDS = 100  # Records per bulk conversion.
+
+
+def bench(func, iterations):
+  """Returns the per call time in microseconds, best of 5 runs."""
+  return min(timeit.repeat(func, number=iterations, repeat=5)) / iterations * 1e6
+
+
+def baseline_decode(data):
+  msg = BaselineTracerMsg()
+  msg.controller_id = 1
+  msg.command = 0xA0
+  msg.data_length = len(data)
+  msg.crc = 0
+  baseline_parse_sensor_data(data, msg)
+  return msg
+
+
+def main(argv):
+  iterations = int(argv[1]) if len(argv) > 1 else 100000
+  decoder = epsolar_tracer.DECODERS[0xA0]
+  rnd = random.Random(1)
+  data = bytearray(rnd.randrange(256) for _ in range(30))
+
+  def decode():
+    return decoder.decode(data, 0, len(data), 1, 0xA0, 0)
+
+  before_msg = baseline_decode(data)
+  after_msg = decode()
+  if before_msg.to_json() != after_msg.to_json():
+    print('Decoded values differ:\n  v0.1: %s\n  now:  %s' % (
+      before_msg, after_msg))
+  before_msgs = [before_msg] * RECORDS
+  after_msgs = [after_msg] * RECORDS
+
+  print('%-16s %12s %12s %8s' % ('', 'before (us)', 'after (us)', 'speedup'))
+  for name, before_func, after_func, number in (
+      ('decode', lambda: baseline_decode(data), decode, iterations),
+      ('to_json', before_msg.to_json, after_msg.to_json, iterations),
+      ('%d to_json' % RECORDS,
+       lambda: '[%s]' % ', '.join([msg.to_json() for msg in before_msgs]),
+       lambda: epsolar_tracer.records_to_json(after_msgs),
+       iterations // RECORDS)):
+    before = bench(before_func, number)
+    after = bench(after_func, number)
+    print('%-16s %12.2f %12.2f %7.1fx' % (name, before, after, before / after))
+
+
+if __name__ == "__main__":
+  main(sys.argv)
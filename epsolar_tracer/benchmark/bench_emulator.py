@@ -0,0 +1,364 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Benchmark and fuzz test of the epsolar_tracer frame reader on an emulator.
+
+Reads frames from the MT-5 emulator in emulator.py through a pseudo-terminal
+and pyserial, as the add-on reads a charger, and checks every decoded frame
+against the frames the emulator sent:
+
+  stream - frames pushed back to back, with the faults of --noise,
+           --truncated, --bad-footer and --bad-crc. Decoded frames/s, CPU
+           per frame of the reading thread, and frames missed or decoded
+           that were not sent.
+  resync - time from writing a frame after a burst of garbage to reading it,
+           including the wake up of the blocked reader.
+  query  - round trip of QUERY_COMMAND and the response.
+  fuzz   - frames mutated at random (bit flips, inserted, deleted and cut
+           bytes, garbage, shorter data with a valid CRC) read in memory in
+           random chunks. The readings go through the aggregates, history
+           and change filter, as in the add-on. Any exception is a failure,
+           as is a phantom frame with verify_crc: a record that was never
+           sent. Exits 1 on failure.
+
+Runs on any Linux machine, no charger or serial adapter needed.
+
+Usage:
+  python3 bench_emulator.py [--frames 5000] [--noise 0.05] [--bad-crc 0.01]
+                            [--verify-crc] [--fuzz 20000] [--output out.json]
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import serial
+
+# Allow depend on epsolar_tracer.py in the parent directory, and the emulator
+# and in-memory serial port next to this file.
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(1, os.path.dirname(__file__))
+import epsolar_tracer
+from bench_scanner import MemorySerial
+from emulator import Faults, MT5Emulator, make_frame
+
+READ_TIMEOUT_S = 0.5
+RESYNC_REPEATS = 200
+
+
+def open_reader(emulator, verify_crc):
+  serial_client = serial.Serial(emulator.port, timeout=READ_TIMEOUT_S)
+  return serial_client, epsolar_tracer.FrameScanner(
+    serial_client, verify_crc=verify_crc)
+
+
+def read_message(scanner):
+  return scanner.read_message(time.monotonic() + READ_TIMEOUT_S)
+
+
+def percentile(values, fraction):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def compare(sent, decoded, verify_crc):
+  """Returns (missed, recovered, phantom) of the decoded records.
+
+  Intact frames sent and not decoded are missed. Mutated frames decoded as
+  sent are recovered, a mutation of the noise before the sync header leaves
+  the frame intact. Any other record decoded is a phantom.
+  """
+  expected = collections.Counter()
+  mutated = collections.Counter()
+  for frame in sent:
+    if frame.record is None or (verify_crc and frame.fault == 'bad_crc'):
+      continue
+    counter = mutated if frame.fault == 'mutated' else expected
+    counter[frame.record.to_tuple()] += 1
+  found = collections.Counter(record.to_tuple() for record in decoded)
+  matched = expected & found
+  recovered = mutated & (found - matched)
+  return (sum((expected - matched).values()), sum(recovered.values()),
+          sum((found - matched - recovered).values()))
+
+
+def bench_stream(args, faults):
+  emulator = MT5Emulator(faults=faults, seed=args.seed)
+  serial_client, scanner = open_reader(emulator, args.verify_crc)
+  writer = threading.Thread(
+    target=emulator.push, args=(args.frames,), daemon=True)
+  decoded = []
+  start = time.perf_counter()
+  cpu_start = time.thread_time()
+  elapsed_s = cpu_s = 0.0
+  writer.start()
+  while True:
+    msg = read_message(scanner)
+    if msg is None:
+      if not writer.is_alive() and not serial_client.in_waiting:
+        break
+      continue
+    decoded.append(msg)
+    # Up to the last frame, without the final read timeout.
+    elapsed_s = time.perf_counter() - start
+    cpu_s = time.thread_time() - cpu_start
+  serial_client.close()
+  emulator.close()
+
+  missed, _, phantom = compare(emulator.sent, decoded, args.verify_crc)
+  return {
+    'frames_sent': len(emulator.sent),
+    'faults': {name: emulator.counters[name] for name in Faults.NAMES},
+    'decoded': len(decoded),
+    'missed': missed,
+    'phantom': phantom,
+    'frames_per_s': round(len(decoded) / elapsed_s) if elapsed_s else None,
+    'cpu_us_per_frame': round(cpu_s * 1e6 / len(decoded), 2)
+                        if decoded else None,
+    'stats': json.loads(scanner.stats.to_json()),
+  }
+
+
+def bench_resync(args, noise_length):
+  emulator = MT5Emulator(seed=args.seed)
+  serial_client, scanner = open_reader(emulator, args.verify_crc)
+  controller_id = next(iter(emulator.models))
+  latencies_us = []
+  missed = 0
+  percentiles = {}
+  for _ in range(RESYNC_REPEATS):
+    data, sent_frame = emulator.frame(controller_id, fault='')
+    garbage = emulator.noise(noise_length)
+    # Written while the reader is blocked in read, as on a real port.
+    writer = threading.Timer(
+      0.001, emulator.write, args=(garbage + data, sent_frame))
+    writer.start()
+    msg = read_message(scanner)
+    read_at = time.perf_counter()
+    writer.join()
+    if msg is None or msg.to_tuple() != sent_frame.record.to_tuple():
+      missed += 1
+      continue
+    latencies_us.append((read_at - emulator.sent[-1].written_at) * 1e6)
+  serial_client.close()
+  emulator.close()
+  if latencies_us:
+    percentiles = {'p50_us': round(percentile(latencies_us, 0.5), 1),
+                   'p99_us': round(percentile(latencies_us, 0.99), 1)}
+  return dict(percentiles, noise_bytes=noise_length, missed=missed)
+
+
+def bench_query(args):
+  emulator = MT5Emulator(seed=args.seed).start()
+  serial_client, scanner = open_reader(emulator, args.verify_crc)
+  query = epsolar_tracer.SYNC_HEADER + epsolar_tracer.QUERY_COMMAND
+  latencies_ms = []
+  cpu_start = time.thread_time()
+  for _ in range(args.queries):
+    start = time.perf_counter()
+    serial_client.write(query)
+    msg = read_message(scanner)
+    if msg is not None:
+      latencies_ms.append((time.perf_counter() - start) * 1e3)
+  cpu_s = time.thread_time() - cpu_start
+  serial_client.close()
+  emulator.close()
+  percentiles = {}
+  if latencies_ms:
+    percentiles = {'p50_ms': round(percentile(latencies_ms, 0.5), 3),
+                   'p99_ms': round(percentile(latencies_ms, 0.99), 3)}
+  return dict(percentiles, queries=args.queries, answered=len(latencies_ms),
+              cpu_us_per_query=round(cpu_s * 1e6 / args.queries, 1))
+
+
+def mutate(rnd, frame):
+  """Returns frame with a random mutation."""
+  frame = bytearray(frame)
+  kind = rnd.randrange(6)
+  if kind == 0:
+    for _ in range(rnd.randrange(1, 4)):
+      frame[rnd.randrange(len(frame))] ^= 1 << rnd.randrange(8)
+  elif kind == 1:
+    position = rnd.randrange(len(frame) + 1)
+    frame[position:position] = bytes(
+      rnd.randrange(256) for _ in range(rnd.randrange(1, 8)))
+  elif kind == 2:
+    position = rnd.randrange(len(frame))
+    del frame[position:position + rnd.randrange(1, 8)]
+  elif kind == 3:
+    del frame[rnd.randrange(len(frame)):]
+  elif kind == 4:
+    frame = bytearray(rnd.randrange(256) for _ in range(len(frame)))
+  else:
+    # A frame too short to decode, with a valid CRC, as of another model.
+    header = len(epsolar_tracer.SYNC_HEADER)
+    controller_id, command = frame[header:header + 2]
+    length = rnd.randrange(epsolar_tracer.DECODERS[command].struct.size)
+    frame = make_frame(controller_id, command, bytes(
+      frame[header + 3:header + 3 + length]))
+  return bytes(frame)
+
+
+def init_stages(directory):
+  """Returns (controller, history) of the add-on, storing in directory."""
+  options_json = {
+    'aggregate_periods_sec': [60],
+    'energy_file': os.path.join(directory, 'energy.json'),
+    'publish_changes': True,
+    'history_dir': os.path.join(directory, 'history'),
+  }
+  controller = epsolar_tracer.init_controllers(options_json, 'fuzz')[0]
+  epsolar_tracer.init_aggregators([controller], options_json)
+  epsolar_tracer.init_change_filters([controller], options_json)
+  return controller, epsolar_tracer.init_history(options_json)
+
+
+def run_stages(controller, history, msg):
+  """Passes a reading through the stages after the reader, as main does."""
+  if not epsolar_tracer.is_decoded(msg):
+    return False
+  if controller.query_period is not None:
+    controller.query_period.on_reading(msg)
+  aggregator = controller.aggregators.get(msg.command)
+  if aggregator is not None:
+    aggregator.on_reading(msg)
+  if msg.command == epsolar_tracer.REAL_TIME_DATA_COMMAND:
+    history.append(controller.controller_id, msg)
+  change_filter = controller.change_filters.get(msg.command)
+  if change_filter is not None:
+    change_filter.changes(msg)
+  return True
+
+
+def fuzz(args, verify_crc):
+  """Feeds intact and mutated frames, returns the result dict."""
+  rnd = random.Random(args.seed)
+  emulator = MT5Emulator(seed=args.seed)
+  controller_id = next(iter(emulator.models))
+  chunks = []
+  sent = []
+  for _ in range(args.fuzz):
+    data, sent_frame = emulator.frame(controller_id, fault='')
+    if rnd.random() < 0.5:
+      data = mutate(rnd, data)
+      sent_frame = sent_frame._replace(fault='mutated')
+    chunks.append(data)
+    sent.append(sent_frame)
+  emulator.close()
+
+  serial_client = MemorySerial(b''.join(chunks), chunk=1)
+  scanner = epsolar_tracer.FrameScanner(serial_client, verify_crc=verify_crc)
+  directory = tempfile.TemporaryDirectory()
+  controller, history = init_stages(directory.name)
+  decoded = []
+  undecoded = 0
+  errors = 0
+  while serial_client.in_waiting:
+    # Reads of random size, as a UART driver delivers them.
+    serial_client.chunk = rnd.randrange(1, 128)
+    try:
+      msg = scanner.read_message()
+    except Exception as e:  # Any exception is a bug of the reader.
+      errors += 1
+      epsolar_tracer.LOG.error('Reader raised %r', e)
+      scanner = epsolar_tracer.FrameScanner(
+        serial_client, verify_crc=verify_crc)
+      continue
+    if msg is None:
+      continue
+    try:
+      if not run_stages(controller, history, msg):
+        undecoded += 1
+        continue
+    except Exception as e:  # Any exception is a bug of the add-on.
+      errors += 1
+      epsolar_tracer.LOG.error('Reading %s raised %r', msg, e)
+    decoded.append(msg)
+  directory.cleanup()
+
+  # Intact frames cut by a mutation of the frame before may be missed.
+  missed, recovered, phantom = compare(sent, decoded, False)
+  return {
+    'verify_crc': verify_crc,
+    'frames': len(sent),
+    'mutated': sum(1 for frame in sent if frame.fault),
+    'decoded': len(decoded),
+    'undecoded': undecoded,
+    'missed': missed,
+    'recovered': recovered,
+    'phantom': phantom,
+    'exceptions': errors,
+  }
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--frames', type=int, default=5000)
+  parser.add_argument('--noise', type=float, default=0.05,
+                      help='Probability of noise before a frame.')
+  parser.add_argument('--truncated', type=float, default=0.01)
+  parser.add_argument('--bad-footer', type=float, default=0.01)
+  parser.add_argument('--bad-crc', type=float, default=0.01)
+  parser.add_argument('--verify-crc', action='store_true',
+                      help='Verify the CRC of each frame in the reader.')
+  parser.add_argument('--queries', type=int, default=200)
+  parser.add_argument('--fuzz', type=int, default=20000,
+                      help='Frames of the fuzz test, half of them mutated.')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--output', help='Write results as JSON to this file.')
+  args = parser.parse_args(argv[1:])
+
+  # Rejected frames are counted, do not log each one.
+  epsolar_tracer.LOG.setLevel(epsolar_tracer.logging.ERROR)
+  faults = Faults(args.noise, args.truncated, args.bad_footer, args.bad_crc)
+  results = {'verify_crc': args.verify_crc}
+
+  stream = results['stream'] = bench_stream(args, faults)
+  print('stream: %d of %d frames decoded, %s frames/s, %s us CPU/frame, '
+        'missed %d, phantom %d, faults %s' % (
+          stream['decoded'], stream['frames_sent'], stream['frames_per_s'],
+          stream['cpu_us_per_frame'], stream['missed'], stream['phantom'],
+          stream['faults']))
+
+  results['resync'] = []
+  for noise_length in (16, 256, 900):
+    resync = bench_resync(args, noise_length)
+    results['resync'].append(resync)
+    print('resync after %4d bytes: p50 %s us, p99 %s us, missed %d' % (
+      noise_length, resync.get('p50_us'), resync.get('p99_us'),
+      resync['missed']))
+
+  query = results['query'] = bench_query(args)
+  print('query: %d of %d answered, p50 %s ms, p99 %s ms, %s us CPU/query' % (
+    query['answered'], query['queries'], query.get('p50_ms'),
+    query.get('p99_ms'),
+    query['cpu_us_per_query']))
+
+  results['fuzz'] = []
+  for verify_crc in (False, True):
+    result = fuzz(args, verify_crc)
+    results['fuzz'].append(result)
+    print('fuzz verify_crc %-5s: %d frames, %d mutated, %d decoded, '
+          '%d too short, %d recovered, missed %d, phantom %d, '
+          'exceptions %d' % (
+            verify_crc, result['frames'], result['mutated'],
+            result['decoded'], result['undecoded'], result['recovered'],
+            result['missed'], result['phantom'], result['exceptions']))
+
+  if args.output:
+    with open(args.output, 'w') as output_file:
+      json.dump(results, output_file, indent=2)
+  failed = any(result['exceptions'] or (result['verify_crc'] and
+                                         result['phantom'])
+               for result in results['fuzz'])
+  return 1 if failed else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -0,0 +1,305 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Benchmark of the epsolar_tracer frame reader.
+
+Compares the v0.1 read_serial_message, which hunts for the sync header one
+byte read at a time, with FrameScanner. By default an in-memory serial
+stand-in has at most --chunk bytes waiting at once, like a UART driver
+delivering what arrived. With --pty the input is written to a pseudo-terminal
+and read with pyserial, including the system call cost of each read.
+
+Reports frames/s on clean input and on noisy input, with random bytes and
+partial sync headers between the frames, and the resync time: how long it
+takes to find the next frame after a burst of noise. Frames missed by v0.1
+are counted, it matches the sync header without backtracking and loses the
+frame after noise ending in a partial header, e.g. EB 90 EB 90.
+
+Usage:
+  python3 bench_scanner.py [--frames 2000] [--chunk 64] [--noise 64] [--pty]
+                           [--verify-crc]
+"""
+
+import argparse
+import io
+import json
+import os
+import pty
+import random
+import sys
+import threading
+import time
+import tty
+
+import serial
+
+# Allow depend on epsolar_tracer.py in the parent directory.
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+import epsolar_tracer
+
+LOG = epsolar_tracer.LOG
+SYNC_HEADER = epsolar_tracer.SYNC_HEADER
+RESYNC_REPEATS = 200
+PTY_READ_TIMEOUT_S = 0.2
+
+
+class MemorySerial(object):
+  """In-memory serial stand-in, at most chunk bytes are waiting at once.
+
+  Like pyserial, read(size) blocks until size bytes arrived.
+  """
+
+  def __init__(self, data, chunk):
+    self.stream = io.BytesIO(data)
+    self.length = len(data)
+    self.chunk = chunk
+    self.timeout = None
+
+  @property
+  def in_waiting(self):
+    return min(self.chunk, self.length - self.stream.tell())
+
+  def read(self, size=1):
+    return self.stream.read(size)
+
+
+def make_frame(rnd):
+  """Returns a real time data frame with random values."""
+  body = bytes([0x01, 0xA0, 30]) + bytes(rnd.randrange(256) for _ in range(30))
+  return (SYNC_HEADER + body +
+          epsolar_tracer.FRAME_FOOTER.pack(epsolar_tracer.crc16(body), 0x7F))
+
+
+def make_noise(rnd, length):
+  """Returns random bytes, with a partial sync header at the end."""
+  return (bytes(rnd.randrange(256) for _ in range(length)) +
+          SYNC_HEADER[:rnd.randrange(len(SYNC_HEADER))])
+
+
+class BaselineTracerMsg(object):
+  """The v0.1 TracerMsg."""
+
+  def __init__(self):
+    self.controller_id = None
+    self.command = None
+    self.data_length = None
+    self.crc = None
+
+  def __str__(self):
+    return 'TrackerMsg%s' % self.to_json()
+
+  def to_json(self):
+    return json.dumps(self.__dict__)
+
+
+def baseline_parse_sensor_data(data, msg):
+  """The v0.1 parse_sensor_data."""
+  if len(data) < 23:
+    return
+
+  def parse_float(offset):
+    return int.from_bytes(data[offset: offset+2], byteorder='little') / 100.0
+
+  msg.batt_volt = parse_float(0)
+  msg.pv_volt = parse_float(2)
+  msg.load_current = parse_float(6)
+  msg.batt_overdischarge_volt = parse_float(8)
+  msg.batt_full_volt = parse_float(10)
+  msg.load_on = data[12] > 0
+  msg.load_overload = data[13] > 0
+  msg.load_short = data[14] > 0
+  msg.batt_overload = data[16] > 0
+  msg.batt_overdischarge = data[17] > 0
+  msg.batt_full = data[18] > 0
+  msg.batt_temp = int.from_bytes(data[20:21], byteorder='little') - 30
+  msg.charge_current = parse_float(21)
+
+  msg.load_power = msg.batt_volt * msg.load_current
+  msg.charge_power = msg.batt_volt * msg.charge_current
+
+
+def baseline_read_serial_message(serial_client,
+                                 max_bytes=epsolar_tracer.MAX_READ_LENGTH):
+  """The v0.1 read_serial_message."""
+  msg = BaselineTracerMsg()
+
+  sync_offset = 0
+  while True:
+    last_bytes = serial_client.read(size=1)
+    if not last_bytes:
+      LOG.debug('Read timeout')
+      return None
+
+    max_bytes -= 1
+    if max_bytes <= 0:
+      LOG.debug('No sync found')
+      return None
+
+    last_byte = last_bytes[0]
+    if last_byte == SYNC_HEADER[sync_offset]:
+      sync_offset += 1
+    elif last_byte == SYNC_HEADER[0]:
+      sync_offset = 1
+    else:
+      sync_offset = 0
+    LOG.debug('Sync byte read. sync_offset: %s', sync_offset)
+
+    if sync_offset >= len(SYNC_HEADER):
+      break
+
+  last_bytes = serial_client.read(size=3)
+  if len(last_bytes) < 3:
+    return None
+  msg.controller_id = int.from_bytes(last_bytes[0:1], byteorder='little')
+  msg.command = int.from_bytes(last_bytes[1:2], byteorder='little')
+  msg.data_length = int.from_bytes(last_bytes[2:3], byteorder='little')
+
+  data = serial_client.read(size=msg.data_length)
+  if len(data) < msg.data_length:
+    return None
+  if msg.command == 0xA0:
+    baseline_parse_sensor_data(data, msg)
+
+  footer = serial_client.read(size=3)
+  if len(footer) < 3:
+    return None
+  msg.crc = int.from_bytes(footer[0:2], byteorder='little')
+  if int.from_bytes(footer[2:3], byteorder='little') != 0x7F:
+    return None
+  return msg
+
+
+def write_all(fd, data):
+  view = memoryview(data)
+  while view:
+    view = view[os.write(fd, view):]
+
+
+class Reader(object):
+  """Reads frames with either implementation, knows when data is consumed."""
+
+  def __init__(self, data, chunk, scanner, use_pty, verify_crc):
+    self.writer = None
+    if use_pty:
+      self.master, slave = pty.openpty()
+      tty.setraw(slave)
+      self.serial_client = serial.Serial(
+        os.ttyname(slave), timeout=PTY_READ_TIMEOUT_S)
+      os.close(slave)
+      self.writer = threading.Thread(
+        target=write_all, args=(self.master, data), daemon=True)
+      self.writer.start()
+    else:
+      self.serial_client = MemorySerial(data, chunk)
+    self.scanner = (epsolar_tracer.FrameScanner(
+      self.serial_client, verify_crc=verify_crc) if scanner else None)
+
+  def read_message(self):
+    if self.scanner is not None:
+      return self.scanner.read_message(time.monotonic() + PTY_READ_TIMEOUT_S)
+    return baseline_read_serial_message(self.serial_client)
+
+  def finished(self):
+    if self.writer is not None and self.writer.is_alive():
+      return False
+    return not self.serial_client.in_waiting
+
+  def close(self):
+    if self.writer is not None:
+      self.serial_client.close()
+      os.close(self.master)
+
+
+def read_all(reader, expected):
+  """Returns (frames, seconds) to read up to expected frames of reader."""
+  start = time.perf_counter()
+  elapsed_s = 0.0
+  frames = 0
+  while frames < expected:
+    msg = reader.read_message()
+    if msg is None:
+      # Timeout at the end of data, or max_bytes of noise.
+      if reader.finished():
+        break
+      continue
+    frames += 1
+    # Up to the last frame, without the final read timeout.
+    elapsed_s = time.perf_counter() - start
+  reader.close()
+  return frames, elapsed_s
+
+
+def bench_throughput(data, args, scanner):
+  """Returns (frames, frames per second), best of 3 runs."""
+  best_s = None
+  for _ in range(3):
+    frames, elapsed_s = read_all(
+      Reader(data, args.chunk, scanner, args.pty, args.verify_crc),
+      args.frames)
+    best_s = elapsed_s if best_s is None else min(best_s, elapsed_s)
+  return frames, frames / best_s
+
+
+def bench_resync(rnd, noise_length, args, scanner):
+  """Returns (median microseconds, frames missed) to find a frame after noise.
+  """
+  times_us = []
+  missed = 0
+  for _ in range(RESYNC_REPEATS):
+    data = make_noise(rnd, noise_length) + make_frame(rnd)
+    reader = Reader(data, args.chunk, scanner, args.pty, args.verify_crc)
+    start = time.perf_counter()
+    msg = reader.read_message()
+    while msg is None and not reader.finished():
+      msg = reader.read_message()
+    times_us.append((time.perf_counter() - start) * 1e6)
+    reader.close()
+    if msg is None:
+      missed += 1
+  return sorted(times_us)[len(times_us) // 2], missed
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--frames', type=int, default=2000)
+  parser.add_argument('--chunk', type=int, default=64,
+                      help='Max bytes waiting in the serial port at once.')
+  parser.add_argument('--noise', type=int, default=64,
+                      help='Max random bytes between frames on noisy input.')
+  parser.add_argument('--pty', action='store_true',
+                      help='Read through a pseudo-terminal.')
+  parser.add_argument('--verify-crc', action='store_true',
+                      help='Verify the CRC of each frame in the scanner.')
+  args = parser.parse_args(argv[1:])
+
+  rnd = random.Random(1)
+  frames = [make_frame(rnd) for _ in range(args.frames)]
+  clean = b''.join(frames)
+  noisy = b''.join(make_noise(rnd, rnd.randrange(args.noise + 1)) + frame
+                   for frame in frames)
+
+  print('%-14s %16s %16s %8s %12s' % (
+    'input', 'v0.1 (frames/s)', 'scanner', 'speedup', 'v0.1 missed'))
+  for name, data in (('clean', clean), ('noisy', noisy)):
+    found_before, before = bench_throughput(data, args, scanner=False)
+    found_after, after = bench_throughput(data, args, scanner=True)
+    if found_after != args.frames:
+      print('Scanner found only %d of %d frames' % (found_after, args.frames))
+    print('%-14s %16.0f %16.0f %7.1fx %12d' % (
+      name, before, after, after / before, args.frames - found_before))
+
+  print()
+  print('%-14s %16s %16s %8s %12s' % (
+    'noise (bytes)', 'v0.1 resync (us)', 'scanner', 'speedup', 'v0.1 missed'))
+  for noise_length in (16, 256, 900):
+    before, missed_before = bench_resync(
+      rnd, noise_length, args, scanner=False)
+    after, missed_after = bench_resync(
+      rnd, noise_length, args, scanner=True)
+    if missed_after:
+      print('Scanner missed %d of %d frames' % (missed_after, RESYNC_REPEATS))
+    print('%-14d %16.1f %16.1f %7.1fx %12d' % (
+      noise_length, before, after, before / after, missed_before))
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -0,0 +1,308 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""EP-Solar MT-5 charger emulator on a pseudo-terminal.
+
+Answers real time data queries (command 0xA0) of the controllers it
+emulates, on a pseudo-terminal that epsolar_tracer or a benchmark opens as
+its serial port. The readings follow a simulated day: PV voltage and charge
+current with the sun and passing clouds, battery voltage with its charge,
+and a load in the evening. Frames can be pushed unasked as well.
+
+Faults are injected with a probability per frame: noise before the frame,
+truncated frames, bad end bytes and bad CRCs. Each frame sent is logged with
+its fault, and the record it decodes to if it is intact, so a reader can be
+checked frame by frame.
+
+Run on its own to point the add-on at it:
+
+  python3 emulator.py [--ids 22,23] [--speed 60] [--noise 0.05]
+"""
+
+import argparse
+import collections
+import math
+import os
+import pty
+import random
+import struct
+import sys
+import threading
+import time
+import tty
+
+# Allow depend on epsolar_tracer.py in the parent directory.
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+import epsolar_tracer
+
+SYNC_HEADER = epsolar_tracer.SYNC_HEADER
+REAL_TIME_DATA = epsolar_tracer.REGISTER_MAP[
+  epsolar_tracer.REAL_TIME_DATA_COMMAND]
+DATA_LENGTH = 30  # Data bytes of a real time data frame of the MT-5.
+DAY_S = 86400.0
+
+# A frame written by the emulator. record is what an intact frame decodes
+# to, fault is None or the name of the fault injected.
+SentFrame = collections.namedtuple(
+  'SentFrame', ['controller_id', 'record', 'fault', 'written_at'])
+
+
+class Faults(object):
+  """Probabilities of each fault per frame, at most one fault per frame."""
+
+  NAMES = ('noise', 'truncated', 'bad_footer', 'bad_crc')
+
+  def __init__(self, noise=0.0, truncated=0.0, bad_footer=0.0, bad_crc=0.0,
+               noise_max_bytes=64):
+    self.noise = noise
+    self.truncated = truncated
+    self.bad_footer = bad_footer
+    self.bad_crc = bad_crc
+    self.noise_max_bytes = noise_max_bytes
+
+  def pick(self, rnd):
+    """Returns the name of a fault to inject, or None."""
+    draw = rnd.random()
+    for name in self.NAMES:
+      draw -= getattr(self, name)
+      if draw < 0:
+        return name
+    return None
+
+
+class ChargerModel(object):
+  """Real time data of a simulated charger over a day.
+
+  With speed, a day passes speed times faster than real time. Each
+  controller gets its own clouds and battery from rnd.
+  """
+
+  def __init__(self, rnd, speed=1.0, start_hour=12.0):
+    self.rnd = rnd
+    self.speed = speed
+    self.start = time.monotonic() - start_hour * 3600.0 / speed
+    self.soc = 0.5  # Battery state of charge, 0 to 1.
+    self.clouds = 1.0  # Share of the sun passing the clouds.
+    self.last = None
+
+  def values(self, now=None):
+    """Returns {field name: value} of the fields of REAL_TIME_DATA."""
+    now = time.monotonic() if now is None else now
+    day_phase = ((now - self.start) * self.speed % DAY_S) / DAY_S
+    elapsed_h = 0.0 if self.last is None else (
+      (now - self.last) * self.speed / 3600.0)
+    self.last = now
+    rnd = self.rnd
+    sun = max(0.0, math.sin(2 * math.pi * (day_phase - 0.25)))
+    self.clouds = min(1.0, max(0.2, self.clouds + rnd.gauss(0, 0.05)))
+    charge_current = 20.0 * sun * self.clouds if self.soc < 1.0 else 0.0
+    evening = 0.75 <= day_phase < 0.95
+    load_current = rnd.uniform(1.5, 3.0) if evening else rnd.uniform(0, 0.3)
+    self.soc = min(1.0, max(0.0, self.soc + elapsed_h * (
+      charge_current - load_current) / 100.0))
+    batt_volt = 11.9 + 1.3 * self.soc + 0.04 * charge_current
+    return {
+      'batt_volt': batt_volt,
+      'pv_volt': (16.0 + 4.0 * sun + rnd.gauss(0, 0.2) if sun
+                  else rnd.uniform(0, 3.0)),
+      'load_current': load_current,
+      'batt_overdischarge_volt': 11.1,
+      'batt_full_volt': 14.4,
+      'load_on': load_current > 0.05,
+      'load_overload': False,
+      'load_short': False,
+      'batt_overload': False,
+      'batt_overdischarge': batt_volt < 11.8,
+      'batt_full': self.soc >= 1.0,
+      'batt_temp': round(20 + 8 * sun + rnd.gauss(0, 0.5)),
+      'charge_current': charge_current,
+    }
+
+
+def encode_data(spec, values, length=DATA_LENGTH):
+  """Returns the data bytes of command spec for values, the inverse of its
+  CommandDecoder.
+  """
+  data = bytearray(length)
+  for field in spec.fields:
+    value = values[field.name]
+    if field.type != 'bool':
+      value = round((value - field.bias) / field.scale)
+    struct.pack_into('<' + epsolar_tracer.FIELD_TYPES[field.type], data,
+                     field.offset, value)
+  return bytes(data)
+
+
+def make_frame(controller_id, command, data, crc=None, end=None):
+  """Returns a frame of data, with its CRC and end byte unless given."""
+  body = bytes([controller_id, command, len(data)]) + data
+  if crc is None:
+    crc = epsolar_tracer.crc16(body)
+  return SYNC_HEADER + body + epsolar_tracer.FRAME_FOOTER.pack(
+    crc, epsolar_tracer.FRAME_END if end is None else end)
+
+
+def write_all(fd, data):
+  view = memoryview(data)
+  while view:
+    view = view[os.write(fd, view):]
+
+
+class MT5Emulator(object):
+  """Emulates MT-5 chargers at controller_ids behind a pseudo-terminal.
+
+  port is the path of the serial port to open. Queries are answered after
+  response_delay_s from the reader thread started by start(). sent logs every
+  frame written, the counters count faults and queries.
+  """
+
+  def __init__(self, controller_ids=(epsolar_tracer.DEFAULT_CONTROLLER_ID,),
+               faults=None, seed=1, speed=1.0, response_delay_s=0.0):
+    self.rnd = random.Random(seed)
+    self.faults = faults or Faults()
+    self.response_delay_s = response_delay_s
+    self.models = {controller_id: ChargerModel(random.Random(seed + i), speed)
+                   for i, controller_id in enumerate(controller_ids)}
+    self.decoder = epsolar_tracer.DECODERS[
+      epsolar_tracer.REAL_TIME_DATA_COMMAND]
+    self.master, self.slave = pty.openpty()
+    tty.setraw(self.master)
+    tty.setraw(self.slave)
+    self.port = os.ttyname(self.slave)
+    self.sent = []
+    self.counters = collections.Counter()
+    self.write_lock = threading.Lock()
+    self.closed = False
+
+  def start(self):
+    threading.Thread(target=self._serve, daemon=True).start()
+    return self
+
+  def close(self):
+    self.closed = True
+    os.close(self.master)
+    os.close(self.slave)
+
+  def frame(self, controller_id, fault=None):
+    """Returns (bytes, SentFrame) of a real time data frame.
+
+    fault is picked with the Faults probabilities unless given, '' for none.
+    """
+    if fault is None:
+      fault = self.faults.pick(self.rnd)
+    data = encode_data(
+      REAL_TIME_DATA, self.models[controller_id].values())
+    command = epsolar_tracer.REAL_TIME_DATA_COMMAND
+    crc = epsolar_tracer.crc16(
+      bytes([controller_id, command, len(data)]) + data)
+    if fault == 'bad_crc':
+      crc = (crc + 1 + self.rnd.randrange(0xFFFF)) & 0xFFFF
+    frame = make_frame(controller_id, command, data, crc)
+    # Decoded with verify_crc off, also with a bad CRC.
+    record = self.decoder.decode(
+      data, 0, len(data), controller_id, command, crc)
+    if fault == 'noise':
+      frame = self.noise() + frame
+    elif fault == 'truncated':
+      frame = frame[:self.rnd.randrange(len(SYNC_HEADER), len(frame))]
+      record = None
+    elif fault == 'bad_footer':
+      frame = frame[:-1] + bytes([self.rnd.randrange(epsolar_tracer.FRAME_END)])
+      record = None
+    if fault:
+      self.counters[fault] += 1
+    return frame, SentFrame(controller_id, record, fault or None, None)
+
+  def noise(self, length=None):
+    """Returns random bytes, ending in a partial sync header at times."""
+    if length is None:
+      length = self.rnd.randrange(1, self.faults.noise_max_bytes + 1)
+    return (bytes(self.rnd.randrange(256) for _ in range(length)) +
+            SYNC_HEADER[:self.rnd.randrange(len(SYNC_HEADER))])
+
+  def write(self, data, sent_frame=None):
+    """Writes data to the port, logs sent_frame with the write time."""
+    with self.write_lock:
+      write_all(self.master, data)
+      if sent_frame is not None:
+        self.sent.append(sent_frame._replace(written_at=time.perf_counter()))
+
+  def push(self, frames, controller_id=None, fault=None):
+    """Writes frames frames unasked, as fast as the port takes them."""
+    controller_id = controller_id or next(iter(self.models))
+    for _ in range(frames):
+      self.write(*self.frame(controller_id, fault))
+
+  def _serve(self):
+    buffer = bytearray()
+    while not self.closed:
+      try:
+        buffer += os.read(self.master, 4096)
+      except OSError:
+        return  # Closed.
+      while True:
+        sync = buffer.find(SYNC_HEADER)
+        if sync < 0:
+          # Keep what may be the start of a sync header.
+          del buffer[:-len(SYNC_HEADER)]
+          break
+        if len(buffer) < sync + len(SYNC_HEADER) + 6:
+          break
+        query = bytes(buffer[sync + len(SYNC_HEADER):
+                             sync + len(SYNC_HEADER) + 6])
+        del buffer[:sync + len(SYNC_HEADER) + 6]
+        controller_id, command = query[0], query[1]
+        if query != epsolar_tracer.query_command(controller_id, command):
+          self.counters['bad_queries'] += 1
+          continue
+        self.counters['queries'] += 1
+        if (controller_id not in self.models or
+            command != epsolar_tracer.REAL_TIME_DATA_COMMAND):
+          continue
+        if self.response_delay_s:
+          time.sleep(self.response_delay_s)
+        self.write(*self.frame(controller_id))
+
+
+def parse_ids(text):
+  return [int(value, 0) for value in text.split(',')]
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--ids', type=parse_ids,
+                      default=[epsolar_tracer.DEFAULT_CONTROLLER_ID],
+                      help='Controller ids, e.g. 22,23 or 0x16.')
+  parser.add_argument('--speed', type=float, default=1.0,
+                      help='Simulated day runs this many times faster.')
+  parser.add_argument('--delay', type=float, default=0.05,
+                      help='Seconds to answer a query.')
+  parser.add_argument('--push', type=float, default=0.0,
+                      help='Also push a frame every this many seconds.')
+  parser.add_argument('--seed', type=int, default=1)
+  for name in Faults.NAMES:
+    parser.add_argument('--' + name.replace('_', '-'), type=float, default=0.0,
+                        help='Probability of %s per frame.' % name)
+  args = parser.parse_args(argv[1:])
+
+  emulator = MT5Emulator(
+    args.ids, Faults(args.noise, args.truncated, args.bad_footer,
+                     args.bad_crc),
+    args.seed, args.speed, args.delay).start()
+  print('Emulating controllers %s on %s, set it as serial_port.' % (
+    ', '.join(str(controller_id) for controller_id in args.ids),
+    emulator.port))
+  try:
+    while True:
+      time.sleep(args.push or 10.0)
+      if args.push:
+        for controller_id in args.ids:
+          emulator.push(1, controller_id)
+      else:
+        print(dict(emulator.counters))
+  except KeyboardInterrupt:
+    emulator.close()
+
+
+if __name__ == "__main__":
+  main(sys.argv)
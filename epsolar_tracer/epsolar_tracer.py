@@ -9,11 +9,26 @@ and pass the values to mqtt.
 Author: Christian Falk <falkn@brannered.com>
 """
 
+import array
+import bisect
+import collections
+import ctypes
+import heapq
+import itertools
 import json
+import keyword
 import logging
+import math
+import mmap
+import operator
+import os
+import select
+import struct
 import sys
 import serial
+import threading
 import time
+import zlib
 from urllib.parse import urlparse
 
 from paho.mqtt import client as mqtt
@@ -21,15 +36,110 @@ from paho.mqtt import client as mqtt
 LOG = logging.getLogger(__name__)
 LOG.setLevel(logging.INFO)
 
-SERIAL_TIMEOUT = 100.0  # seconds?
-RECONNECT_TIMEOUT_S = 30.0  # seconds
+SERIAL_TIMEOUT = 100.0  # seconds, also the longest read without deadline.
+# Read timeouts are rounded up to this, setting a new one costs a tcsetattr.
+SERIAL_TIMEOUT_RESOLUTION_S = 0.01
+RECONNECT_MIN_S = 0.5  # First reconnect backoff, doubled on each failure.
+RECONNECT_TIMEOUT_S = 30.0  # seconds, max reconnect backoff.
 SYNC_HEADER = bytes([0xEB, 0x90, 0xEB, 0x90, 0xEB, 0x90])
-QUERY_COMMAND = bytes([0x16, 0xA0, 0x00, 0x00, 0x00, 0x7F])
+SYNC_PERIOD = 2  # SYNC_HEADER repeats itself after this many bytes.
+DEFAULT_CONTROLLER_ID = 0x16
+REAL_TIME_DATA_COMMAND = 0xA0
+# Sync header, controller id, command, data length; then data.
+FRAME_HEADER = struct.Struct('<6sBBB')
+FRAME_FOOTER = struct.Struct('>HB')  # CRC, end byte.
+FRAME_END = 0x7F
+CRC_POLY = 0x1041
 
 MAX_READ_LENGTH = 1024
 
+DEFAULT_CONTROLLER_TIMEOUT_MS = 500  # Wait for a query response on the bus.
+DEFAULT_QUERY_PERIOD_MIN_SEC = 10
+DEFAULT_QUERY_PERIOD_NIGHT_SEC = 1800
+CHARGE_CURRENT_DELTA_A = 0.1  # Charge current change that speeds up queries.
+
+DEFAULT_SPOOL_DIR = '/data/spool'
+DEFAULT_SPOOL_MAX_MB = 10
+SPOOL_MAGIC = b'EPTSPL01'
+# Wall clock time read, CRC-32 of topic and payload, topic length, payload
+# length; then topic and payload.
+SPOOL_RECORD = struct.Struct('<dIHI')
+SPOOL_CURSOR = struct.Struct('<QQ')  # Segment, offset of the next record.
+SPOOL_SUFFIX = '.spool'
+SPOOL_SEGMENTS = 16  # Segments of a full spool, the unit of eviction.
+SPOOL_SYNC_S = 5.0  # Max time appended readings are not synced to disk.
+SPOOL_DRAIN_PERIOD_S = 1.0
+SPOOL_DRAIN_BATCH = 500  # Readings published from the spool per drain.
+MAX_INFLIGHT_PUBLISHES = 100  # Publishes not acked yet before spooling.
+
+DEFAULT_ENERGY_FILE = '/data/energy.json'
+# Power fields integrated over time, and the name of their Wh counter.
+ENERGY_FIELDS = (
+  ('charge_power', 'charge_energy_wh'),
+  ('load_power', 'load_energy_wh'),
+)
+ENERGY_MAX_GAP_S = 3600.0  # Longer gaps between readings are not counted.
+ENERGY_SAVE_PERIOD_S = 60.0
+
+DEFAULT_HISTORY_DIR = '/data/history'
+DEFAULT_HISTORY_DAYS = 7
+HISTORY_MAGIC = b'EPTHIS01'
+# Magic, length of the JSON header with the fields; then the header and rows.
+HISTORY_HEADER = struct.Struct('<8sI')
+HISTORY_TIME = struct.Struct('<d')  # First column of each row.
+HISTORY_SUFFIX = '.hist'
+HISTORY_DECIMALS = 3  # Rows store float32, more decimals are noise.
+MAX_HISTORY_POINTS = 10000  # Rows or steps in one history response.
+
+DEFAULT_HEARTBEAT_SEC = 600
+DEADBAND_TOLERANCE = 1e-9  # Float error, e.g. 12.66 - 12.61 < 0.05.
+
 LOG_FIRST_N_MSG = 2
 
+
+def crc16_table_entry(byte):
+  crc = byte << 8
+  for _ in range(8):
+    crc = (crc << 1) ^ CRC_POLY if crc & 0x8000 else crc << 1
+  return crc & 0xFFFF
+
+
+CRC_TABLE = tuple(crc16_table_entry(byte) for byte in range(256))
+# CRC after shifting in a 16 bit word, indexed by crc ^ word.
+CRC_WORD_TABLE = array.array('H', [
+  ((CRC_TABLE[high] & 0xFF) << 8) ^ CRC_TABLE[(CRC_TABLE[high] >> 8) ^ low]
+  for high in range(256) for low in range(256)])
+
+
+def crc16(data, start=0, end=None):
+  """CRC-16 of data[start:end], a frame from controller id to end of data.
+
+  The tracer CRC uses polynomial 0x1041, MSB first, starting at 0. Two bytes
+  are processed per step.
+  """
+  if end is None:
+    end = len(data)
+  table = CRC_WORD_TABLE
+  crc = 0
+  for word in struct.unpack_from('>%dH' % ((end - start) >> 1), data, start):
+    crc = table[crc ^ word]
+  if (end - start) & 1:
+    crc = ((crc & 0xFF) << 8) ^ CRC_TABLE[(crc >> 8) ^ data[end - 1]]
+  return crc
+
+
+def query_command(controller_id, command=REAL_TIME_DATA_COMMAND):
+  """Returns the query frame for controller_id, after the sync header.
+
+  Controller id, command, data length, CRC (see crc16), end byte.
+  """
+  body = bytes([controller_id, command, 0])
+  return body + FRAME_FOOTER.pack(crc16(body), FRAME_END)
+
+
+QUERY_COMMAND = query_command(DEFAULT_CONTROLLER_ID)
+
+
 def init_logger_stdout():
   handler = logging.StreamHandler(sys.stdout)
   handler.setLevel(logging.INFO)
@@ -88,144 +198,1374 @@ def init_serial_client(options_json):
     sys.exit(1)
 
 
-def reconnect_serial_client(serial_client):
-  while not serial_client.is_open:
+# inotify(7) event masks, see <sys/inotify.h>.
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len; then name.
+
+
+class DeviceWatcher(object):
+  """Signals when a serial device node (re)appears, using inotify.
+
+  Watches the directory of the device, e.g. /dev or /dev/serial/by-id, for
+  the device name being created, moved in or getting its permissions set by
+  udev. Where inotify is not available (not Linux, or the directory itself is
+  gone) available is False and wait() just sleeps, so callers fall back to
+  plain backoff.
+  """
+
+  def __init__(self, device_path):
+    self.directory, self.name = os.path.split(device_path)
+    self.name = self.name.encode()
+    self.fd = -1
     try:
-      serial_client.open()
-    except serial.SerialException as se:
-      LOG.info('Reconnection attempt failed, waiting %d s: %s',
-               RECONNECT_TIMEOUT_S, str(se))
-      time.sleep(RECONNECT_TIMEOUT_S)
-      continue
+      libc = ctypes.CDLL(None, use_errno=True)
+      fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+      if fd < 0:
+        raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+      if libc.inotify_add_watch(fd, (self.directory or '.').encode(),
+                                IN_CREATE | IN_ATTRIB | IN_MOVED_TO) < 0:
+        errno = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(errno, 'inotify_add_watch %s failed' % self.directory)
+      self.fd = fd
+    except (OSError, AttributeError) as e:
+      LOG.info('Hotplug detection for %s not available, using backoff: %s',
+               device_path, str(e))
+
+  @property
+  def available(self):
+    return self.fd >= 0
+
+  def fileno(self):
+    return self.fd
+
+  def read_events(self):
+    """Consumes pending events, returns True if any was for the device."""
+    try:
+      data = os.read(self.fd, 4096)
+    except BlockingIOError:
+      return False
+    found = False
+    offset = 0
+    while offset < len(data):
+      _, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+      offset += INOTIFY_EVENT.size
+      if data[offset:offset + length].rstrip(b'\0') == self.name:
+        found = True
+      offset += length
+    return found
+
+  def wait(self, timeout_s):
+    """Blocks until the device appears or timeout_s passed."""
+    if not self.available:
+      time.sleep(timeout_s)
+      return False
+    deadline = time.monotonic() + timeout_s
+    while True:
+      remaining_s = deadline - time.monotonic()
+      if remaining_s <= 0:
+        return False
+      readable, _, _ = select.select([self.fd], [], [], remaining_s)
+      if readable and self.read_events():
+        return True
+
+  def close(self):
+    if self.fd >= 0:
+      os.close(self.fd)
+      self.fd = -1
+
+
+def reconnect_serial_client(serial_client):
+  """Reopens serial_client, as soon as its device node reappears.
+
+  Retries with exponential backoff from RECONNECT_MIN_S up to
+  RECONNECT_TIMEOUT_S, a hotplug event cuts the wait short.
+  """
+  # Watch before the first attempt, so a device appearing in between is seen.
+  watcher = DeviceWatcher(serial_client.port)
+  backoff_s = RECONNECT_MIN_S
+  try:
+    while not serial_client.is_open:
+      try:
+        serial_client.open()
+      except serial.SerialException as se:
+        LOG.info('Reconnection attempt failed, waiting up to %.1f s: %s',
+                 backoff_s, str(se))
+        if watcher.wait(backoff_s):
+          LOG.info('Serial device %s appeared.', serial_client.port)
+          # udev may still be setting up permissions, retry quickly.
+          backoff_s = RECONNECT_MIN_S
+        else:
+          backoff_s = min(backoff_s * 2, RECONNECT_TIMEOUT_S)
+  finally:
+    watcher.close()
   LOG.info('Reconnection to serial successful!')
 
 
-class TracerMsg(object):
+BOOL_JSON = ('false', 'true')
 
-  def __init__(self):
-    # Header
-    self.controller_id = None
-    self.command = None
-    self.data_length = None
-    self.crc = None
 
-    # Data
+class TracerMsg(object):
+  """A frame from the tracer, the header only.
+
+  Commands in REGISTER_MAP are decoded into a subclass compiled by
+  CommandDecoder, with a slot per data field. FIELDS lists all fields in JSON
+  order.
+  """
+  __slots__ = ('controller_id', 'command', 'data_length', 'crc')
+  FIELDS = __slots__
+
+  def __init__(self, controller_id=None, command=None, data_length=None,
+               crc=None):
+    self.controller_id = controller_id
+    self.command = command
+    self.data_length = data_length
+    self.crc = crc
 
   def __str__(self):
     return 'TrackerMsg%s' % self.to_json()
 
-  def to_json(self):
-    return json.dumps(self.__dict__)
-
+  def to_tuple(self):
+    return tuple(getattr(self, name) for name in self.FIELDS)
 
-def read_serial_message(serial_client, max_bytes=MAX_READ_LENGTH):
-  msg = TracerMsg()
+  def to_dict(self):
+    return dict(zip(self.FIELDS, self.to_tuple()))
 
-  # Wait for sync
-  sync_offset = 0
-  while True:
-    last_bytes = serial_client.read(size=1)
-    if not last_bytes:
-      LOG.debug('Read timeout')
-      return None  # Read timeout
-
-    max_bytes -= 1
-    if max_bytes <= 0:
-      LOG.debug('No sync found')
-      return None  # No sync found
-
-    last_byte = last_bytes[0]
-    if last_byte == SYNC_HEADER[sync_offset]:
-      sync_offset += 1
-    elif last_byte == SYNC_HEADER[0]:
-      sync_offset = 1
-    else:
-      sync_offset = 0
-    LOG.debug('Sync byte read. sync_offset: %s', sync_offset)
-
-    if sync_offset >= len(SYNC_HEADER):
-      break
-
-  LOG.debug('Sync header received. sync_offset: %s', sync_offset)
-
-  # Read header
-  last_bytes = serial_client.read(size=3)
-  if len(last_bytes) < 3:
-    return None  # Read timeout
-
-  msg.controller_id = int.from_bytes(last_bytes[0:1], byteorder='little')
-  msg.command = int.from_bytes(last_bytes[1:2], byteorder='little')
-  msg.data_length = int.from_bytes(last_bytes[2:3], byteorder='little')
-  LOG.debug('Header received. msg: %s', msg)
-
-  # Read Data
-  data = serial_client.read(size=msg.data_length)
-  if len(data) < msg.data_length:
-    LOG.debug('Too short message (%d), or read timeout.', len(data))
-    return None  # Read timeout
-  if msg.command == 0xA0:
-    parse_sensor_data(data, msg)
-  LOG.debug('Data read. msg: %s',  msg)
-
-  # Footer
-  footer = serial_client.read(size=3)
-  if len(footer) < 3:
-    LOG.debug('Too short footer (%d), or read timeout.', len(footer))
-    return None  # Read timeout
-  msg.crc = int.from_bytes(footer[0:2], byteorder='little')
-  if int.from_bytes(footer[2:3], byteorder='little') != 0x7F:
-    LOG.debug('Incorrect footer: %d', footer[2:3])
-    return None  # Incorrect footer
-  LOG.debug('Footer read. msg: %s', msg)
-
-  return msg
-
-
-def parse_sensor_data(data, msg):
-  if len(data) < 23:
-    return
+  def to_json(self):
+    return json.dumps(self.to_dict())
+
+
+def records_to_json(records):
+  """Returns records as one JSON array."""
+  return '[%s]' % ', '.join([record.to_json() for record in records])
+
+
+def records_to_columns(records, names=None):
+  """Returns {name: [value of each record]}, e.g. for aggregation.
+
+  names defaults to the FIELDS of the first record, all records need them.
+  """
+  if not records:
+    return {}
+  names = names or records[0].FIELDS
+  if len(names) == 1:
+    return {names[0]: [getattr(record, names[0]) for record in records]}
+  columns = zip(*map(operator.attrgetter(*names), records))
+  return dict(zip(names, map(list, columns)))
+
+
+# A field in the data of a command: value = raw * scale + bias. Types are
+# u8, u16, s16 (little endian) and bool. Changes smaller than deadband are
+# not published with publish_changes, 0 publishes any change.
+FieldSpec = collections.namedtuple(
+  'FieldSpec', ['name', 'offset', 'type', 'scale', 'bias', 'unit', 'deadband'],
+  defaults=(1, 0, None, 0))
+# A field computed as the product of two decoded fields.
+ProductSpec = collections.namedtuple(
+  'ProductSpec', ['name', 'factor', 'other_factor', 'unit', 'deadband'],
+  defaults=(0,))
+# The data of a command, published to <mqtt_topic>/<sub_topic>.
+CommandSpec = collections.namedtuple(
+  'CommandSpec', ['name', 'sub_topic', 'fields', 'products'])
+
+FIELD_TYPES = {'u8': 'B', 'u16': 'H', 's16': 'h', 'bool': '?'}
+
+# Commands of the tracer, by command byte. Add new commands or controller
+# models here.
+REGISTER_MAP = {
+  REAL_TIME_DATA_COMMAND: CommandSpec(
+    name='real_time_data',
+    sub_topic='read',
+    fields=(
+      FieldSpec('batt_volt', 0, 'u16', 0.01, unit='V', deadband=0.05),
+      FieldSpec('pv_volt', 2, 'u16', 0.01, unit='V', deadband=0.1),
+      FieldSpec('load_current', 6, 'u16', 0.01, unit='A', deadband=0.05),
+      FieldSpec('batt_overdischarge_volt', 8, 'u16', 0.01, unit='V',
+                deadband=0.05),
+      FieldSpec('batt_full_volt', 10, 'u16', 0.01, unit='V', deadband=0.05),
+      FieldSpec('load_on', 12, 'bool'),
+      FieldSpec('load_overload', 13, 'bool'),
+      FieldSpec('load_short', 14, 'bool'),
+      FieldSpec('batt_overload', 16, 'bool'),
+      FieldSpec('batt_overdischarge', 17, 'bool'),
+      FieldSpec('batt_full', 18, 'bool'),
+      FieldSpec('batt_temp', 20, 'u8', bias=-30, unit='°C'),
+      FieldSpec('charge_current', 21, 'u16', 0.01, unit='A', deadband=0.05),
+    ),
+    products=(
+      ProductSpec('load_power', 'batt_volt', 'load_current', 'W', 1.0),
+      ProductSpec('charge_power', 'batt_volt', 'charge_current', 'W', 1.0),
+    )),
+}
+
+
+class CommandDecoder(object):
+  """Decodes the data of a command, compiled from its CommandSpec.
+
+  All fields are unpacked with one struct.Struct, gaps between fields are pad
+  bytes. The scaling and products are compiled into a decode function once,
+  like collections.namedtuple does, so a frame costs one unpack and a few
+  arithmetic operations. Scaled fields are divided by 1 / scale, which gives
+  the same floats as v0.1, e.g. 12.34 instead of 12.340000000000002.
+
+  Frames are decoded into record, a TracerMsg subclass with a slot per field.
+  Its to_json fills a JSON template compiled from the fields in one string
+  formatting, instead of building and encoding a dict.
+  """
+
+  def __init__(self, spec):
+    self.name = spec.name
+    self.sub_topic = spec.sub_topic
+    fields = sorted(spec.fields, key=lambda field: field.offset)
+    for field in fields + list(spec.products):
+      if not field.name.isidentifier() or keyword.iskeyword(field.name):
+        raise ValueError('Field name %r of %s is not an identifier.' % (
+          field.name, spec.name))
+
+    struct_format = '<'
+    offset = 0
+    for field in fields:
+      if field.offset < offset:
+        raise ValueError('Field %s of %s overlaps the previous field.' % (
+          field.name, spec.name))
+      if field.offset > offset:
+        struct_format += '%dx' % (field.offset - offset)
+      struct_format += FIELD_TYPES[field.type]
+      offset = struct.calcsize(struct_format)
+    self.struct = struct.Struct(struct_format)
+    self.names = tuple(field.name for field in fields) + tuple(
+      product.name for product in spec.products)
+    self.units = {field.name: field.unit
+                  for field in fields + list(spec.products) if field.unit}
+    self.deadbands = {field.name: field.deadband
+                      for field in fields + list(spec.products)}
+    bools = {field.name for field in fields if field.type == 'bool'}
+    # Fields with a number value, e.g. for aggregation.
+    self.numeric_names = tuple(
+      name for name in self.names if name not in bools)
+
+    variables = {field.name: 'v%d' % i for i, field in enumerate(fields)}
+    lines = ['def decode(buffer, offset, controller_id, command, data_length,',
+             '           crc):',
+             '  %s, = unpack_from(buffer, offset)' % ', '.join(
+               variables[field.name] for field in fields),
+             '  msg = new(Record)']
+    lines.extend('  msg.%s = %s' % (name, name) for name in TracerMsg.FIELDS)
+    for field in fields:
+      value = variables[field.name]
+      if field.scale != 1:
+        value = '%s / %r' % (value, 1 / field.scale)
+      if field.bias:
+        value = '%s + %r' % (value, field.bias)
+      lines.append('  msg.%s = %s = %s' % (
+        field.name, variables[field.name], value))
+    for i, product in enumerate(spec.products):
+      variables[product.name] = 'p%d' % i
+      lines.append('  msg.%s = %s = %s * %s' % (
+        product.name, variables[product.name], variables[product.factor],
+        variables[product.other_factor]))
+    lines.append('  return msg')
+
+    all_names = TracerMsg.FIELDS + self.names
+    json_template = '{%s}' % ', '.join(
+      '"%s": %s' % (name, '%s' if name in bools else '%r')
+      for name in all_names)
+    lines.extend([
+      'def to_tuple(self):',
+      '  return (%s,)' % ', '.join('self.%s' % name for name in all_names),
+      'def to_json(self):',
+      '  return %r %% (%s,)' % (json_template, ', '.join(
+        'BOOL_JSON[self.%s]' % name if name in bools else 'self.%s' % name
+        for name in all_names)),
+    ])
+    namespace = {'unpack_from': self.struct.unpack_from, 'new': object.__new__,
+                 'BOOL_JSON': BOOL_JSON}
+    exec('\n'.join(lines), namespace)
+    self.record = namespace['Record'] = type(
+      ''.join(part.title() for part in spec.name.split('_')), (TracerMsg,), {
+        '__slots__': self.names,
+        'FIELDS': all_names,
+        'to_tuple': namespace['to_tuple'],
+        'to_json': namespace['to_json'],
+      })
+    self._decode = namespace['decode']
+
+  def decode(self, buffer, offset, length, controller_id, command, crc):
+    """Returns a record of buffer[offset:offset + length] and the header.
+
+    Returns None if the data is too short.
+    """
+    if length < self.struct.size:
+      return None
+    return self._decode(buffer, offset, controller_id, command, length, crc)
+
+
+def init_decoders(register_map):
+  """Returns {command: CommandDecoder} of register_map."""
+  return {command: CommandDecoder(spec)
+          for command, spec in register_map.items()}
+
+
+DECODERS = init_decoders(REGISTER_MAP)
+
+
+def is_decoded(msg, decoders=DECODERS):
+  """Returns False for a frame of a command in decoders too short to decode.
+
+  Such a frame is a TracerMsg with the header only, e.g. noise passing as a
+  frame without verify_crc, or the frame of another charger model.
+  """
+  decoder = decoders.get(msg.command)
+  return decoder is None or isinstance(msg, decoder.record)
+
+
+class FrameStats(object):
+  """Frame counters of a serial port, kept across reconnects."""
 
-  msg.batt_volt = parse_float(data, 0)
-  msg.pv_volt = parse_float(data, 2)
-  msg.load_current = parse_float(data, 6)
-  msg.batt_overdischarge_volt = parse_float(data, 8)
-  msg.batt_full_volt = parse_float(data, 10)
-  msg.load_on = parse_bool(data, 12)
-  msg.load_overload = parse_bool(data, 13)
-  msg.load_short = parse_bool(data, 14)
-  msg.batt_overload = parse_bool(data, 16)
-  msg.batt_overdischarge = parse_bool(data, 17)
-  msg.batt_full = parse_bool(data, 18)
-  msg.batt_temp = parse_temp(data, 20)
-  msg.charge_current = parse_float(data, 21)
+  def __init__(self):
+    self.frames = 0
+    self.crc_errors = 0
+    self.footer_errors = 0
+    self.skipped_bytes = 0  # Bytes discarded while hunting for sync.
+    self.query_timeouts = {}  # Unanswered queries by controller id.
 
-  msg.load_power = msg.batt_volt * msg.load_current
-  msg.charge_power = msg.batt_volt * msg.charge_current
+  def to_json(self):
+    return json.dumps(self.__dict__)
 
 
-def parse_float(data, offset):
-  return parse_int(data, offset) / 100.0
+class FrameScanner(object):
+  """Reads tracer frames from a serial port through a buffer.
+
+  Reads whatever the port has waiting at once, or the rest of a partial
+  frame, instead of byte by byte. The sync header is located with
+  bytearray.find, frames are decoded in place from the buffer with struct and
+  partial frames are kept for the next read. Consumed bytes are deleted
+  from the front of the buffer, which bytearray does without moving the rest.
+
+  With verify_crc, frames with a bad CRC are rejected and counted in stats.
+  The data of commands in decoders is decoded into their records.
+  """
+
+  def __init__(self, serial_client, max_bytes=MAX_READ_LENGTH,
+               verify_crc=False, stats=None, decoders=None):
+    self.serial_client = serial_client
+    self.max_bytes = max_bytes
+    self.verify_crc = verify_crc
+    self.decoders = decoders if decoders is not None else DECODERS
+    self.stats = stats if stats is not None else FrameStats()
+    self.buffer = bytearray()
+    self.start = 0  # Offset of the first byte not scanned yet.
+    self.missing = 1  # Bytes known to be missing for the next frame.
+
+  def fill(self):
+    """Reads at least one byte into the buffer, returns 0 on timeout."""
+    if self.start:
+      del self.buffer[:self.start]
+      self.start = 0
+    data = self.serial_client.read(
+      max(self.missing, self.serial_client.in_waiting))
+    self.buffer += data
+    return len(data)
+
+  def read_message(self, deadline=None):
+    """Returns the next TracerMsg.
+
+    Returns None on read timeout, at deadline (time.monotonic()), or when
+    max_bytes were read without a complete frame. Partial frames are kept for
+    the next call.
+    """
+    read_bytes = 0
+    while True:
+      msg = self.next_message()
+      if msg is not None:
+        return msg
+      if read_bytes >= self.max_bytes:
+        LOG.debug('No sync found')
+        return None
+      timeout_s = SERIAL_TIMEOUT
+      if deadline is not None:
+        timeout_s = deadline - time.monotonic()
+        if timeout_s <= 0:
+          return None
+        # Up to SERIAL_TIMEOUT_RESOLUTION_S late, but the port is set up
+        # again only every SERIAL_TIMEOUT_RESOLUTION_S, not on each read.
+        timeout_s = math.ceil(
+          timeout_s / SERIAL_TIMEOUT_RESOLUTION_S) * SERIAL_TIMEOUT_RESOLUTION_S
+      if self.serial_client.timeout != timeout_s:
+        self.serial_client.timeout = timeout_s
+      length = self.fill()
+      if not length:
+        LOG.debug('Read timeout')
+        return None
+      read_bytes += length
+
+  def next_message(self):
+    """Decodes the next complete frame in the buffer, None if there is none."""
+    buffer = self.buffer
+    while True:
+      sync = buffer.find(SYNC_HEADER, self.start)
+      if sync < 0:
+        # Keep the start of a sync header split across reads, and read the
+        # rest of it and the header at once.
+        keep = buffer.find(SYNC_HEADER[0], max(
+          self.start, len(buffer) - len(SYNC_HEADER) + 1))
+        while keep >= 0 and not SYNC_HEADER.startswith(buffer[keep:]):
+          keep = buffer.find(SYNC_HEADER[0], keep + 1)
+        if keep < 0:
+          keep = len(buffer)
+        self.stats.skipped_bytes += keep - self.start
+        self.start = keep
+        partial = len(buffer) - keep
+        self.missing = FRAME_HEADER.size - partial if partial else 1
+        return None
+      # Noise ending in a partial sync header, e.g. EB 90 EB 90, matches too
+      # early. The frame starts after the last repetition.
+      while buffer.startswith(SYNC_HEADER, sync + SYNC_PERIOD):
+        sync += SYNC_PERIOD
+      self.stats.skipped_bytes += sync - self.start
+      self.start = sync
+
+      data_start = sync + FRAME_HEADER.size
+      if len(buffer) < data_start:
+        self.missing = data_start - len(buffer)
+        return None
+      _, controller_id, command, data_length = FRAME_HEADER.unpack_from(
+        buffer, sync)
+      data_end = data_start + data_length
+      if len(buffer) < data_end + FRAME_FOOTER.size:
+        self.missing = data_end + FRAME_FOOTER.size - len(buffer)
+        return None
+      crc, end = FRAME_FOOTER.unpack_from(buffer, data_end)
+      if end != FRAME_END:
+        LOG.debug('Incorrect footer: %d', end)
+        self.stats.footer_errors += 1
+      elif self.verify_crc and not self.check_crc(sync, data_end, crc):
+        self.stats.crc_errors += 1
+      else:
+        break
+      # A sync header in noise or a corrupt frame, hunt for the next one.
+      self.start = sync + 1
+      self.stats.skipped_bytes += 1
+
+    self.start = data_end + FRAME_FOOTER.size
+    self.missing = 1
+    self.stats.frames += 1
+
+    msg = None
+    decoder = self.decoders.get(command)
+    if decoder is not None:
+      msg = decoder.decode(
+        buffer, data_start, data_length, controller_id, command, crc)
+    if msg is None:
+      msg = TracerMsg(controller_id, command, data_length, crc)
+    if LOG.isEnabledFor(logging.DEBUG):
+      LOG.debug('Frame read. msg: %s', msg)
+    return msg
+
+  def check_crc(self, sync, data_end, crc):
+    expected_crc = crc16(self.buffer, sync + len(SYNC_HEADER), data_end)
+    if crc != expected_crc:
+      LOG.debug('Incorrect CRC: %04X, expected %04X', crc, expected_crc)
+      return False
+    return True
+
+
+class DeadlineScheduler(object):
+  """Runs callbacks at time.monotonic() deadlines, kept in a heap.
+
+  The main loop reads serial until next_deadline, then calls run_due.
+  Periodic callbacks schedule their next call themselves.
+  """
 
+  def __init__(self):
+    self._heap = []  # (deadline, seq, callback)
+    self._seq = itertools.count()  # Keeps equal deadlines in call order.
+
+  @property
+  def next_deadline(self):
+    """Monotonic time of the next callback, None if none is scheduled."""
+    return self._heap[0][0] if self._heap else None
+
+  def call_at(self, deadline, callback):
+    heapq.heappush(self._heap, (deadline, next(self._seq), callback))
+
+  def call_later(self, delay_s, callback):
+    self.call_at(time.monotonic() + delay_s, callback)
+
+  def run_due(self):
+    """Calls all callbacks whose deadline has passed."""
+    now = time.monotonic()
+    while self._heap and self._heap[0][0] <= now:
+      _, _, callback = heapq.heappop(self._heap)
+      callback()
+
+
+class QueryPeriod(object):
+  """Period between queries, optionally adapted to the readings.
+
+  With adaptive, the period halves down to min_s on each reading where the
+  charge current changed by CHARGE_CURRENT_DELTA_A or more, and doubles back
+  up to period_s while it is steady. At night, with the PV voltage below the
+  battery voltage, it is night_s.
+  """
+
+  def __init__(self, period_s, adaptive=False, min_s=None, night_s=None):
+    self.base_s = period_s
+    self.period_s = period_s
+    self.adaptive = adaptive
+    self.min_s = min(min_s or period_s, period_s)
+    self.night_s = max(night_s or period_s, period_s)
+    self.charge_current = None
+
+  def on_reading(self, msg):
+    if not self.adaptive:
+      return
+    charge_current = getattr(msg, 'charge_current', None)
+    if charge_current is None:
+      return
+    if msg.pv_volt < msg.batt_volt:
+      self.period_s = self.night_s
+    elif (self.charge_current is not None and
+          abs(charge_current - self.charge_current) >= CHARGE_CURRENT_DELTA_A):
+      self.period_s = max(self.min_s, min(self.period_s, self.base_s) / 2)
+    else:
+      self.period_s = min(self.base_s, self.period_s * 2)
+    self.charge_current = charge_current
+
+
+class Controller(object):
+  """A charger on the bus, with its address, topics and query period."""
+
+  def __init__(self, controller_id, mqtt_topic, timeout_s, query_period=None):
+    self.controller_id = controller_id
+    self.timeout_s = timeout_s
+    self.query_period = query_period
+    self.query = SYNC_HEADER + query_command(controller_id)
+    self.aggregators = {}  # ReadingAggregator by command.
+    self.change_filters = {}  # ChangeFilter by command.
+    # Topic of each decoded command.
+    self.topics = {
+      command: '%s/%s' % (mqtt_topic.removesuffix('/'), decoder.sub_topic)
+      for command, decoder in DECODERS.items()}
+
+
+class BusPoller(object):
+  """Queries the controllers on a shared RS-485 bus one at a time.
+
+  The bus is half-duplex, two controllers answering at once garble both
+  frames, so only one query is outstanding. The next due query is sent as
+  soon as the response to the previous one was read, or its controller
+  timed out, which polls the whole bus back to back.
+  """
+
+  def __init__(self, serial_client, scheduler, stats):
+    self.serial_client = serial_client
+    self.scheduler = scheduler
+    self.stats = stats
+    self.due = collections.deque()
+    self.pending = None  # Controller queried and not answered yet.
+    self.pending_seq = 0  # Tells a stale timeout from the current one.
+
+  def request(self, controller):
+    """Queries controller now, or once the bus is free."""
+    if controller is not self.pending and controller not in self.due:
+      self.due.append(controller)
+    if self.pending is None:
+      self._send_next()
+
+  def on_message(self, msg):
+    """Frees the bus if msg is the response of the pending controller."""
+    if self.pending is not None and (
+        msg.controller_id == self.pending.controller_id):
+      self.pending = None
+      self._send_next()
+
+  def _on_timeout(self, seq):
+    if self.pending is None or seq != self.pending_seq:
+      return
+    controller_id = self.pending.controller_id
+    LOG.debug('No response from controller %d', controller_id)
+    timeouts = self.stats.query_timeouts
+    timeouts[controller_id] = timeouts.get(controller_id, 0) + 1
+    self.pending = None
+    self._send_next()
+
+  def _send_next(self):
+    if not self.due:
+      return
+    self.pending = controller = self.due.popleft()
+    self.pending_seq += 1
+    seq = self.pending_seq
+    # Schedule first, a failed write must not keep the bus busy.
+    self.scheduler.call_later(
+      controller.timeout_s, lambda: self._on_timeout(seq))
+    self.serial_client.write(controller.query)
+
+
+def init_controllers(options_json, mqtt_topic):
+  """Returns the Controller list of the controllers option.
+
+  Without the option it is the single controller at DEFAULT_CONTROLLER_ID,
+  published to mqtt_topic. With several controllers each defaults to
+  <mqtt_topic>/<id>.
+  """
+  controllers_json = options_json.get('controllers') or [
+    {'id': DEFAULT_CONTROLLER_ID, 'topic': mqtt_topic}]
+  timeout_ms = options_json.get(
+    'controller_timeout_ms', DEFAULT_CONTROLLER_TIMEOUT_MS)
+  controllers = []
+  for controller_json in controllers_json:
+    controller_id = controller_json['id']
+    controllers.append(Controller(
+      controller_id,
+      controller_json.get('topic') or (
+        '%s/%d' % (mqtt_topic.removesuffix('/'), controller_id)
+        if len(controllers_json) > 1 else mqtt_topic),
+      controller_json.get('timeout_ms', timeout_ms) / 1000.0,
+      init_query_period(options_json)))
+  return controllers
+
+
+def init_query_period(options_json):
+  """Returns the QueryPeriod, None if queries are disabled."""
+  period_s = options_json.get('query_period_sec', 600)
+  if period_s <= 0:
+    return None
+  return QueryPeriod(
+    period_s, options_json.get('query_adaptive', False),
+    options_json.get('query_period_min_sec', DEFAULT_QUERY_PERIOD_MIN_SEC),
+    options_json.get('query_period_night_sec', DEFAULT_QUERY_PERIOD_NIGHT_SEC))
+
+
+class ReadingSpool(object):
+  """Append-only spool of readings on disk, for while MQTT is unreachable.
+
+  Readings are appended to segment files <seq>.spool in directory, each
+  starting with SPOOL_MAGIC and followed by records of SPOOL_RECORD, topic
+  and payload. A segment is synced and closed once it reaches segment_bytes.
+  When the spool exceeds max_bytes the oldest segment is dropped, readings
+  are lost oldest first.
+
+  The drain position is kept in the file cursor, written after each drain,
+  so readings are published at least once across restarts. A record cut
+  short by a crash while appending is cut off when the spool is opened.
+  """
+
+  def __init__(self, directory, max_bytes):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.segment_bytes = max(max_bytes // SPOOL_SEGMENTS, 4096)
+    self.sizes = {}  # Bytes by segment seq.
+    self.total_bytes = 0
+    self.dropped_segments = 0
+    self.full = False  # Dropped readings since it was last drained.
+    self._file = None
+    self._sync_at = 0.0
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+      if name.endswith(SPOOL_SUFFIX) and name[:-len(SPOOL_SUFFIX)].isdigit():
+        seq = int(name[:-len(SPOOL_SUFFIX)])
+        self.sizes[seq] = os.path.getsize(self._path(seq))
+    self.segments = collections.deque(sorted(self.sizes))
+    if self.segments:
+      self._recover(self.segments[-1])
+    self.total_bytes = sum(self.sizes.values())
+    self.read_seq, self.read_offset = self._load_cursor()
+    if self.segments:
+      LOG.info('Spool %s has %d bytes of readings to publish', directory,
+               self.total_bytes)
+
+  def _path(self, seq):
+    return os.path.join(self.directory, '%016d%s' % (seq, SPOOL_SUFFIX))
+
+  def _load_cursor(self):
+    try:
+      with open(os.path.join(self.directory, 'cursor'), 'rb') as cursor:
+        seq, offset = SPOOL_CURSOR.unpack(cursor.read(SPOOL_CURSOR.size))
+    except (OSError, struct.error):
+      seq, offset = None, 0
+    if seq not in self.sizes:
+      # No cursor, or its segment was dropped.
+      return (self.segments[0] if self.segments else 0), len(SPOOL_MAGIC)
+    return seq, max(offset, len(SPOOL_MAGIC))
+
+  def _save_cursor(self):
+    path = os.path.join(self.directory, 'cursor')
+    with open(path + '.tmp', 'wb') as cursor:
+      cursor.write(SPOOL_CURSOR.pack(self.read_seq, self.read_offset))
+    os.replace(path + '.tmp', path)
+
+  def _recover(self, seq):
+    """Cuts off a record of the last segment cut short by a crash."""
+    with open(self._path(seq), 'rb') as segment:
+      data = segment.read()
+    if not data.startswith(SPOOL_MAGIC):
+      LOG.warning('Dropping spool segment %s, not a spool', self._path(seq))
+      self._drop(seq)
+      return
+    offset = len(SPOOL_MAGIC)
+    record = next_record(data, offset)
+    while record is not None:
+      offset = record[0]
+      record = next_record(data, offset)
+    if offset < len(data):
+      LOG.warning('Cutting off %d bytes of an incomplete reading in %s',
+                  len(data) - offset, self._path(seq))
+      os.truncate(self._path(seq), offset)
+      self.sizes[seq] = offset
+
+  def _drop(self, seq):
+    os.remove(self._path(seq))
+    self.segments.remove(seq)
+    self.total_bytes -= self.sizes.pop(seq)
+
+  @property
+  def empty(self):
+    return not self.segments or (
+      self.read_seq == self.segments[-1] and
+      self.read_offset >= self.sizes[self.read_seq])
+
+  def append(self, timestamp, topic, payload):
+    topic = topic.encode('utf-8')
+    payload = payload.encode('utf-8')
+    if self._file is None or self.sizes[self.segments[-1]] >= (
+        self.segment_bytes):
+      self._roll()
+    record = SPOOL_RECORD.pack(
+      timestamp, zlib.crc32(payload, zlib.crc32(topic)), len(topic),
+      len(payload)) + topic + payload
+    # Flushed on each reading, a crash of the add-on loses none.
+    self._file.write(record)
+    self._file.flush()
+    self.sizes[self.segments[-1]] += len(record)
+    self.total_bytes += len(record)
+    if time.monotonic() >= self._sync_at:
+      os.fsync(self._file.fileno())
+      self._sync_at = time.monotonic() + SPOOL_SYNC_S
+    while self.total_bytes > self.max_bytes and len(self.segments) > 1:
+      self._drop_oldest()
+
+  def _roll(self):
+    """Starts a new segment, or appends to the last one after a restart."""
+    if self._file is not None:
+      os.fsync(self._file.fileno())
+      self._file.close()
+    elif self.segments and self.sizes[self.segments[-1]] < self.segment_bytes:
+      self._file = open(self._path(self.segments[-1]), 'ab')
+      return
+    seq = self.segments[-1] + 1 if self.segments else 0
+    self._file = open(self._path(seq), 'wb')
+    self._file.write(SPOOL_MAGIC)
+    self.segments.append(seq)
+    self.sizes[seq] = len(SPOOL_MAGIC)
+    self.total_bytes += len(SPOOL_MAGIC)
+    if len(self.segments) == 1:
+      self.read_seq, self.read_offset = seq, len(SPOOL_MAGIC)
+
+  def _drop_oldest(self):
+    seq = self.segments[0]
+    if not self.full:
+      LOG.warning('Spool %s full, dropping the oldest readings',
+                  self.directory)
+      self.full = True
+    self._drop(seq)
+    self.dropped_segments += 1
+    if self.read_seq == seq:
+      self.read_seq, self.read_offset = self.segments[0], len(SPOOL_MAGIC)
+
+  def drain(self, publish, max_records):
+    """Calls publish(timestamp, topic, payload) for the oldest readings.
+
+    Stops after max_records or when publish returns False, the reading is
+    kept for the next drain. Returns the number of readings published.
+    """
+    if self.empty:
+      return 0
+    if self._file is not None:
+      self._file.flush()
+    published = 0
+    while published < max_records and not self.empty:
+      seq = self.read_seq
+      with open(self._path(seq), 'rb') as segment:
+        segment.seek(self.read_offset)
+        data = segment.read()
+      offset = 0
+      while published < max_records:
+        record = next_record(data, offset)
+        if record is None:
+          break
+        if not publish(*record[1:]):
+          max_records = published  # Stop after saving the position.
+          break
+        offset = record[0]
+        published += 1
+      self.read_offset += offset
+      if offset < len(data) and published < max_records:
+        LOG.warning('Skipping %d bytes of a corrupt reading in %s',
+                    len(data) - offset, self._path(seq))
+        self.read_offset += len(data) - offset
+      if self.read_offset >= self.sizes[seq] and seq != self.segments[-1]:
+        self._drop(seq)
+        self.read_seq, self.read_offset = self.segments[0], len(SPOOL_MAGIC)
+    if self.empty:
+      # All published, start over with an empty spool.
+      if self._file is not None:
+        self._file.close()
+        self._file = None
+      while self.segments:
+        self._drop(self.segments[0])
+      self.read_seq, self.read_offset = 0, len(SPOOL_MAGIC)
+      self.full = False
+    self._save_cursor()
+    return published
+
+
+def next_record(data, offset):
+  """Returns (next offset, timestamp, topic, payload) of the spool record at
+  offset of data, None if it is incomplete or corrupt.
+  """
+  if len(data) < offset + SPOOL_RECORD.size:
+    return None
+  timestamp, crc, topic_length, payload_length = SPOOL_RECORD.unpack_from(
+    data, offset)
+  topic_start = offset + SPOOL_RECORD.size
+  payload_start = topic_start + topic_length
+  end = payload_start + payload_length
+  if len(data) < end:
+    return None
+  topic = data[topic_start:payload_start]
+  payload = data[payload_start:end]
+  if zlib.crc32(payload, zlib.crc32(topic)) != crc:
+    return None
+  return end, timestamp, topic.decode('utf-8'), payload.decode('utf-8')
+
+
+def init_spool(options_json):
+  """Returns the ReadingSpool in spool_dir, None if spool_max_mb is 0."""
+  max_mb = options_json.get('spool_max_mb', DEFAULT_SPOOL_MAX_MB)
+  if max_mb <= 0:
+    return None
+  spool_dir = options_json.get('spool_dir', DEFAULT_SPOOL_DIR)
+  try:
+    return ReadingSpool(spool_dir, max_mb << 20)
+  except OSError as e:
+    LOG.fatal('Could not open spool %s, check option spool_dir: %s',
+              spool_dir, str(e))
+    sys.exit(1)
 
-def parse_int(data, offset):
-  return int.from_bytes(data[offset: offset+2], byteorder='little')
 
+def with_time(payload, timestamp):
+  """Returns the JSON object payload with "time", epoch seconds.
+
+  Other JSON values, e.g. of field topics, become {"time": ..., "value": ...}.
+  """
+  if not payload.startswith('{'):
+    return '{"time": %.3f, "value": %s}' % (timestamp, payload)
+  rest = payload[1:].lstrip()
+  return '{"time": %.3f%s%s' % (timestamp, '' if rest == '}' else ', ', rest)
+
+
+class ReadingPublisher(object):
+  """Publishes readings to MQTT, through the spool while it is unreachable.
+
+  Readings are spooled while MQTT is disconnected, while more than
+  MAX_INFLIGHT_PUBLISHES were not acked, and until earlier spooled readings
+  were drained, so readings are published in order. Spooled readings are
+  published with "time" when they were read.
+  """
+
+  def __init__(self, mqtt_client, qos, retain, spool=None):
+    self.mqtt_client = mqtt_client
+    self.qos = qos
+    self.retain = retain
+    self.spool = spool
+    self.connected = False
+    self.sent = 0
+    self.acked = 0  # Counted from the paho network thread.
+    self._sent_lock = threading.Lock()  # send is called from both threads.
+
+  def on_connect(self, client, userdata, flags, rc):
+    self.connected = rc == 0
+
+  def on_disconnect(self, client, userdata, rc):
+    self.connected = False
+
+  def on_publish(self, client, userdata, mid):
+    self.acked += 1
+
+  @property
+  def ready(self):
+    return self.connected and (
+      self.sent - self.acked < MAX_INFLIGHT_PUBLISHES)
+
+  def send(self, topic, payload, retain=None):
+    """Publishes now, not through the spool. Returns False if dropped."""
+    info = self.mqtt_client.publish(
+      topic, payload, qos=self.qos,
+      retain=self.retain if retain is None else retain)
+    if info.rc != mqtt.MQTT_ERR_SUCCESS and self.qos == 0:
+      return False  # Dropped by paho.
+    # Kept by paho otherwise, on_publish is called after reconnect.
+    with self._sent_lock:
+      self.sent += 1
+    return True
+
+  def publish(self, topic, payload):
+    if self.spool is None:
+      self.send(topic, payload)
+    elif not (self.ready and self.spool.empty and self.send(topic, payload)):
+      self.spool.append(time.time(), topic, payload)
+
+  def drain(self):
+    """Publishes spooled readings while MQTT keeps up."""
+    if self.spool is not None and self.ready:
+      self.spool.drain(self._send_spooled, SPOOL_DRAIN_BATCH)
+
+  def _send_spooled(self, timestamp, topic, payload):
+    return self.ready and self.send(topic, with_time(payload, timestamp))
+
+
+class WindowStats(object):
+  """Min, max and sum of each field over a period, updated per reading."""
 
-def parse_bool(data, offset):
-  return data[offset] > 0
+  def __init__(self):
+    self.reset()
 
+  def reset(self):
+    self.count = 0
+    self.mins = self.maxs = self.sums = None
 
-def parse_temp(data, offset):
-  return int.from_bytes(data[offset: offset + 1], byteorder='little') - 30
+  def add(self, values):
+    if self.count:
+      self.mins = tuple(map(min, self.mins, values))
+      self.maxs = tuple(map(max, self.maxs, values))
+      self.sums = tuple(map(operator.add, self.sums, values))
+    else:
+      self.mins = self.maxs = self.sums = values
+    self.count += 1
 
 
-def read_now_ms():
-  return int(time.time() * 1000)
+class EnergyStore(object):
+  """Energy counters in Wh by controller id, kept in a JSON file."""
 
+  def __init__(self, path):
+    self.path = path
+    self.counters = {}  # {controller id: {counter name: Wh}}
+    self.dirty = False
+    try:
+      with open(path) as energy_file:
+        self.counters = {int(controller_id): counters for controller_id,
+                         counters in json.load(energy_file).items()}
+    except FileNotFoundError:
+      pass
+    except (OSError, ValueError) as e:
+      LOG.warning('Could not read energy counters %s, starting at 0: %s',
+                  path, str(e))
+
+  def counters_of(self, controller_id):
+    return self.counters.setdefault(controller_id, {})
+
+  def save(self):
+    """Writes the counters if they changed, replacing the file at once."""
+    if not self.dirty:
+      return
+    try:
+      with open(self.path + '.tmp', 'w') as energy_file:
+        json.dump(self.counters, energy_file)
+      os.replace(self.path + '.tmp', self.path)
+      self.dirty = False
+    except OSError as e:
+      LOG.warning('Could not save energy counters %s: %s', self.path, str(e))
+
+
+class ReadingAggregator(object):
+  """Rolling statistics and energy of the readings of one command.
+
+  Min, max and mean of each of names are kept for each period in periods_s,
+  updated on each reading instead of keeping the readings. Power fields in
+  ENERGY_FIELDS are integrated over time with the trapezoid rule into the Wh
+  counters of the controller in energy_store. A gap of more than
+  ENERGY_MAX_GAP_S between readings, e.g. the add-on was stopped, is not
+  counted.
+  """
+
+  def __init__(self, names, periods_s, energy_store, controller_id):
+    self.names = names
+    get_values = operator.attrgetter(*names)
+    self.get_values = get_values if len(names) > 1 else (
+      lambda msg: (get_values(msg),))
+    self.windows = {period_s: WindowStats() for period_s in periods_s}
+    self.energy_store = energy_store
+    self.energy = energy_store.counters_of(controller_id)
+    # (index in names, counter name) of each power field.
+    self.energy_fields = tuple(
+      (names.index(power), counter) for power, counter in ENERGY_FIELDS
+      if power in names)
+    self.last_time = None
+    self.last_values = None
+
+  def on_reading(self, msg, now=None):
+    values = self.get_values(msg)
+    for window in self.windows.values():
+      window.add(values)
+    now = time.monotonic() if now is None else now
+    if self.last_time is not None and self.energy_fields:
+      elapsed_h = (now - self.last_time) / 3600.0
+      if 0 < elapsed_h <= ENERGY_MAX_GAP_S / 3600.0:
+        for index, counter in self.energy_fields:
+          self.energy[counter] = self.energy.get(counter, 0.0) + (
+            self.last_values[index] + values[index]) / 2 * elapsed_h
+        self.energy_store.dirty = True
+    self.last_time = now
+    self.last_values = values
+
+  def to_json(self, period_s, end):
+    """Returns the statistics of the period_s ending at end, epoch seconds.
+
+    Starts the next period. Returns None if there were no readings.
+    """
+    window = self.windows[period_s]
+    if not window.count:
+      return None
+    stats = {'period': period_s, 'start': end - period_s, 'end': end,
+             'samples': window.count}
+    for name, low, high, total in zip(
+        self.names, window.mins, window.maxs, window.sums):
+      stats[name] = {'min': low, 'max': high,
+                     'mean': round(total / window.count, 3)}
+    for _, counter in self.energy_fields:
+      stats[counter] = round(self.energy.get(counter, 0.0), 3)
+    window.reset()
+    return json.dumps(stats)
+
+
+def init_aggregators(controllers, options_json):
+  """Adds the ReadingAggregators to controllers.
+
+  Returns the EnergyStore, None if aggregate_periods_sec is not set.
+  """
+  periods_s = options_json.get('aggregate_periods_sec') or []
+  if not periods_s:
+    return None
+  energy_store = EnergyStore(
+    options_json.get('energy_file', DEFAULT_ENERGY_FILE))
+  for controller in controllers:
+    controller.aggregators = {
+      command: ReadingAggregator(
+        decoder.numeric_names, periods_s, energy_store,
+        controller.controller_id)
+      for command, decoder in DECODERS.items() if decoder.numeric_names}
+  return energy_store
+
+
+class ChangeFilter(object):
+  """Picks the changed fields of readings, to publish each to its own topic.
+
+  A number field changed once it is its deadband or more away from the value
+  published last, so a slow drift is published too. Bools and fields with
+  deadband 0 on any change. The full record is published with any change, so
+  it agrees with the field topics. Every heartbeat_s all fields and the full
+  record are published again, which refreshes retained messages.
+  """
+
+  def __init__(self, decoder, topic, heartbeat_s, deadbands=None):
+    self.topic = topic
+    self.heartbeat_s = heartbeat_s
+    names = decoder.names
+    get_values = operator.attrgetter(*names)
+    self.get_values = get_values if len(names) > 1 else (
+      lambda msg: (get_values(msg),))
+    deadbands = dict(decoder.deadbands, **(deadbands or {}))
+    self.deadbands = tuple(
+      deadbands[name] - DEADBAND_TOLERANCE for name in names)
+    self.topics = tuple('%s/%s' % (topic, name) for name in names)
+    self.heartbeat_at = None
+    self.published = None  # Values published last.
+    self.last_values = None  # Values of the last reading.
+
+  def changes(self, msg, now=None):
+    """Returns [(topic, payload)] to publish for the reading msg."""
+    now = time.monotonic() if now is None else now
+    values = self.get_values(msg)
+    if self.heartbeat_at is None or now >= self.heartbeat_at:
+      self.heartbeat_at = now + self.heartbeat_s
+      self.published = list(values)
+      self.last_values = values
+      return [(self.topic, msg.to_json())] + [
+        (topic, json.dumps(value)) for topic, value in zip(self.topics, values)]
+    if values == self.last_values:
+      return []
+    self.last_values = values
+    changes = []
+    published = self.published
+    for i, value in enumerate(values):
+      if value != published[i] and not (
+          abs(value - published[i]) < self.deadbands[i]):
+        published[i] = value
+        changes.append((self.topics[i], json.dumps(value)))
+    if changes:
+      changes.insert(0, (self.topic, msg.to_json()))
+    return changes
+
+
+def init_change_filters(controllers, options_json):
+  """Adds the ChangeFilters to controllers, if publish_changes is set."""
+  if not options_json.get('publish_changes', False):
+    return
+  deadbands = {}
+  for deadband_json in options_json.get('deadbands') or []:
+    if not any(deadband_json['field'] in decoder.deadbands
+               for decoder in DECODERS.values()):
+      LOG.warning('Unknown field %s in option deadbands, ignored.',
+                  deadband_json['field'])
+      continue
+    deadbands[deadband_json['field']] = deadband_json['delta']
+  heartbeat_s = options_json.get('heartbeat_sec', DEFAULT_HEARTBEAT_SEC)
+  for controller in controllers:
+    controller.change_filters = {
+      command: ChangeFilter(
+        decoder, controller.topics[command], heartbeat_s,
+        {name: deadband for name, deadband in deadbands.items()
+         if name in decoder.deadbands})
+      for command, decoder in DECODERS.items()}
+
+
+def history_row(fields):
+  """Returns the row struct: time, a float per field, bools as bits."""
+  return struct.Struct('<d%dfI' % fields)
+
+
+class HistoryFile(object):
+  """One day of history of a controller, memory-mapped for reading.
+
+  Behaves as a sequence of the row times, for bisect.
+  """
+
+  def __init__(self, path):
+    """Raises ValueError if path is not a complete history file header."""
+    with open(path, 'rb') as history_file:
+      # Raises ValueError for an empty file.
+      self.map = mmap.mmap(history_file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic = length = None
+    if len(self.map) >= HISTORY_HEADER.size:
+      magic, length = HISTORY_HEADER.unpack_from(self.map)
+    if magic != HISTORY_MAGIC or len(self.map) < HISTORY_HEADER.size + length:
+      self.map.close()
+      raise ValueError('Not a history file')
+    header = json.loads(self.map[
+      HISTORY_HEADER.size:HISTORY_HEADER.size + length])
+    self.fields = header['fields']
+    self.bools = header['bools']
+    self.row = history_row(len(self.fields))
+    self.start = HISTORY_HEADER.size + length
+    # A row cut short by a crash is not counted.
+    self.count = (len(self.map) - self.start) // self.row.size
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self, index):
+    return HISTORY_TIME.unpack_from(
+      self.map, self.start + index * self.row.size)[0]
+
+  def rows(self, start, end):
+    """Returns an iterator of the rows from time start to before end."""
+    first = bisect.bisect_left(self, start)
+    last = bisect.bisect_left(self, end, first)
+    return self.row.iter_unpack(self.map[
+      self.start + first * self.row.size:self.start + last * self.row.size])
+
+  def getter(self, name):
+    """Returns a function of a row returning the value of field name."""
+    if name in self.fields:
+      return operator.itemgetter(1 + self.fields.index(name))
+    if name in self.bools:
+      bit = 1 << self.bools.index(name)
+      return lambda row: bool(row[-1] & bit)
+    return lambda row: None  # Not recorded on this day.
+
+  def close(self):
+    self.map.close()
+
+
+class ReadingHistory(object):
+  """History of the readings of decoder of each controller, a file per day.
+
+  Each file, <controller id>-<UTC day>.hist, starts with HISTORY_HEADER and a
+  JSON header naming the fields, followed by fixed width rows of history_row.
+  Rows are appended as readings arrive, and read memory-mapped, found by
+  binary search on time. Files of more than days ago are removed.
+
+  Queries are answered from the paho network thread, they only read files
+  that appends flush on each row.
+  """
+
+  def __init__(self, directory, days, decoder):
+    self.directory = directory
+    self.days = days
+    self.fields = decoder.numeric_names
+    self.bools = tuple(
+      name for name in decoder.names if name not in self.fields)
+    self.get_values = operator.attrgetter(*(self.fields + self.bools))
+    self.row = history_row(len(self.fields))
+    header = json.dumps({'fields': self.fields, 'bools': self.bools})
+    self.header = HISTORY_HEADER.pack(
+      HISTORY_MAGIC, len(header)) + header.encode('utf-8')
+    self.writers = {}  # Controller id -> [day, file, last row time]
+    os.makedirs(directory, exist_ok=True)
+
+  def _path(self, controller_id, day):
+    return os.path.join(
+      self.directory, '%d-%s%s' % (controller_id, day, HISTORY_SUFFIX))
+
+  def _open(self, controller_id, day):
+    path = self._path(controller_id, day)
+    last_time = 0.0
+    try:
+      with open(path, 'rb') as history_file:
+        data = history_file.read()
+    except FileNotFoundError:
+      data = None
+    if data is not None and data.startswith(self.header):
+      count = (len(data) - len(self.header)) // self.row.size
+      if count:
+        last_time = HISTORY_TIME.unpack_from(
+          data, len(self.header) + (count - 1) * self.row.size)[0]
+      os.truncate(path, len(self.header) + count * self.row.size)
+      return [day, open(path, 'ab'), last_time]
+    if data is not None:
+      LOG.warning('History %s has other fields, starting it over.', path)
+    history_file = open(path, 'wb')
+    history_file.write(self.header)
+    return [day, history_file, last_time]
+
+  def append(self, controller_id, msg, timestamp=None):
+    timestamp = time.time() if timestamp is None else timestamp
+    day = time.strftime('%Y%m%d', time.gmtime(timestamp))
+    writer = self.writers.get(controller_id)
+    if writer is None or writer[0] != day:
+      if writer is not None:
+        writer[1].close()
+      writer = self.writers[controller_id] = self._open(controller_id, day)
+      self.expire(timestamp)
+    values = self.get_values(msg)
+    fields = len(self.fields)
+    bits = 0
+    for bit, value in enumerate(values[fields:]):
+      if value:
+        bits |= 1 << bit
+    # Rows stay sorted for bisect if the clock is set back.
+    writer[2] = max(timestamp, writer[2])
+    writer[1].write(self.row.pack(writer[2], *values[:fields], bits))
+    writer[1].flush()
+
+  def expire(self, now):
+    oldest = time.strftime('%Y%m%d', time.gmtime(now - self.days * 86400))
+    for name in os.listdir(self.directory):
+      if name.endswith(HISTORY_SUFFIX) and (
+          name[:-len(HISTORY_SUFFIX)].rpartition('-')[2] < oldest):
+        os.remove(os.path.join(self.directory, name))
+
+  def query(self, request, controller_id):
+    """Returns the response to a history request dict, see README.md.
+
+    Raises ValueError for a bad request.
+    """
+    now = time.time()
+    controller_id = int(request.get('controller_id', controller_id))
+    end = float(request.get('end') or now)
+    start = float(request.get('start') or end - 86400)
+    step = float(request.get('step') or 0)
+    if not all(math.isfinite(value) for value in (start, end, step)):
+      raise ValueError('start, end and step must be finite')
+    names = request.get('fields') or list(self.fields + self.bools)
+    unknown = set(names).difference(self.fields + self.bools)
+    if unknown:
+      raise ValueError('Unknown fields: %s' % ', '.join(sorted(unknown)))
+    if step < 0 or (step and (end - start) / step > MAX_HISTORY_POINTS):
+      raise ValueError('step must give at most %d points' %
+                       MAX_HISTORY_POINTS)
+
+    times = []
+    columns = [[] for _ in names]
+    truncated = False
+    # Only the days kept by expire, up to a day ahead for clock changes.
+    day_start = max(start, now - self.days * 86400)
+    day_start -= day_start % 86400
+    days_end = min(end, now + 86400)
+    while day_start < days_end and not truncated:
+      path = self._path(controller_id, time.strftime(
+        '%Y%m%d', time.gmtime(day_start)))
+      day_start += 86400
+      try:
+        history_file = HistoryFile(path)
+      except FileNotFoundError:
+        continue  # No readings that day, or removed by expire.
+      except ValueError as e:
+        LOG.warning('Skipping corrupt history %s: %s', path, e)
+        continue
+      try:
+        getters = [history_file.getter(name) for name in names]
+        for row in history_file.rows(start, end):
+          if not step and len(times) >= MAX_HISTORY_POINTS:
+            truncated = True
+            break
+          times.append(row[0])
+          for column, getter in zip(columns, getters):
+            column.append(getter(row))
+      finally:
+        history_file.close()
+
+    if step:
+      times, columns = downsample(times, columns, start, step)
+    response = {
+      'controller_id': controller_id, 'start': start, 'end': end,
+      'step': step, 'truncated': truncated, 'time': times}
+    for name, column in zip(names, columns):
+      response[name] = [round(value, HISTORY_DECIMALS)
+                        if isinstance(value, float) else value
+                        for value in column]
+    return response
+
+
+def downsample(times, columns, start, step):
+  """Returns (times, columns) of the mean of each step from start.
+
+  times must be sorted. Steps without rows are left out, None values are not
+  counted.
+  """
+  step_times = []
+  step_columns = [[] for _ in columns]
+  first = 0
+  while first < len(times):
+    index = int((times[first] - start) // step)
+    last = max(first + 1, bisect.bisect_left(
+      times, start + (index + 1) * step, first))
+    step_times.append(start + index * step)
+    for column, step_column in zip(columns, step_columns):
+      values = [value for value in column[first:last] if value is not None]
+      step_column.append(sum(values) / len(values) if values else None)
+    first = last
+  return step_times, step_columns
+
+
+def init_history(options_json):
+  """Returns the ReadingHistory of real time data, None if history_days is 0.
+  """
+  days = options_json.get('history_days', DEFAULT_HISTORY_DAYS)
+  if days <= 0:
+    return None
+  history_dir = options_json.get('history_dir', DEFAULT_HISTORY_DIR)
+  try:
+    return ReadingHistory(
+      history_dir, days, DECODERS[REAL_TIME_DATA_COMMAND])
+  except OSError as e:
+    LOG.fatal('Could not create history %s, check option history_dir: %s',
+              history_dir, str(e))
+    sys.exit(1)
 
-def send_query_command(serial_client):
-  serial_client.send(SYNC_HEADER)
-  serial_client.send(QUERY_COMMAND)
 
 def main(argv):
   init_logger_stdout()
@@ -244,38 +1584,159 @@ def main(argv):
     return 1
   mqtt_client = init_mqtt_client(argv[1])
   mqtt_topic = options_json.get('mqtt_topic', 'epsolar_tracer/')
-  mqtt_topic_msg = '%s/read' % mqtt_topic.removesuffix('/')
+  controllers = init_controllers(options_json, mqtt_topic)
+  controllers_by_id = {
+    controller.controller_id: controller for controller in controllers}
+  # Frames of unknown controllers, e.g. sent unasked, go to the first one.
+  default_controller = controllers[0]
   mqtt_topic_online = '%s/online' % mqtt_topic.removesuffix('/')
   mqtt_qos = options_json.get('mqtt_publish_qos', 0)
   mqtt_retain = options_json.get('mqtt_publish_retain', True)
-  mqtt_client.publish(
-    mqtt_topic_online, "{\"online\": true}", qos=mqtt_qos, retain=mqtt_retain)
+  publisher = ReadingPublisher(
+    mqtt_client, mqtt_qos, mqtt_retain, init_spool(options_json))
+
+  # Answer history requests, from the paho network thread
+  history = init_history(options_json)
+  mqtt_topic_history = '%s/history' % mqtt_topic.removesuffix('/')
+
+  def on_history_request(client, userdata, message):
+    request = {}
+    response_topic = None
+    try:
+      request = json.loads(message.payload)
+      if not isinstance(request, dict):
+        raise ValueError('History request must be a JSON object')
+      response = history.query(request, default_controller.controller_id)
+    except (ValueError, TypeError, OverflowError, OSError, struct.error) as e:
+      # Raised on the paho network thread, it would end the thread.
+      response = {'error': str(e)}
+    if isinstance(request, dict):
+      response['id'] = request.get('id')
+      response_topic = request.get('response_topic')
+    publisher.send(
+      response_topic or '%s/response' % mqtt_topic_history,
+      json.dumps(response), retain=False)
+
+  def on_mqtt_connect(client, userdata, flags, rc):
+    publisher.on_connect(client, userdata, flags, rc)
+    if history is not None and rc == 0:
+      client.subscribe('%s/get' % mqtt_topic_history)
+
+  if history is not None:
+    mqtt_client.message_callback_add(
+      '%s/get' % mqtt_topic_history, on_history_request)
+  mqtt_client.on_connect = on_mqtt_connect
+  mqtt_client.on_disconnect = publisher.on_disconnect
+  mqtt_client.on_publish = publisher.on_publish
+  # Network thread, keeps the connection alive and reconnects.
+  mqtt_client.loop_start()
+  publisher.send(mqtt_topic_online, "{\"online\": true}")
   LOG.info('MQTT Published init messsage to: %s', mqtt_topic_online)
 
-  query_period_ms = options_json.get('query_period_sec', 600) * 1000
-  next_query_ms = read_now_ms()
   log_msg_left = LOG_FIRST_N_MSG
+  scheduler = DeadlineScheduler()
+  verify_crc = options_json.get('verify_crc', False)
+  frame_stats = FrameStats()
+
+  # Send query requests periodically, one controller at a time
+  poller = BusPoller(serial_client, scheduler, frame_stats)
+
+  def query(controller):
+    # Schedule first, a disconnected port must not stop the queries.
+    scheduler.call_later(
+      controller.query_period.period_s, lambda: query(controller))
+    poller.request(controller)
+
+  for controller in controllers:
+    if controller.query_period is not None:
+      scheduler.call_later(0, lambda controller=controller: query(controller))
+
+  # Publish frame statistics periodically
+  mqtt_topic_stats = '%s/stats' % mqtt_topic.removesuffix('/')
+  stats_period_s = options_json.get('stats_period_sec', 0)
+
+  def publish_stats():
+    scheduler.call_later(stats_period_s, publish_stats)
+    publisher.send(mqtt_topic_stats, frame_stats.to_json(), retain=False)
+
+  if stats_period_s > 0:
+    scheduler.call_later(stats_period_s, publish_stats)
+
+  # Publish spooled readings once MQTT is back
+  def drain_spool():
+    scheduler.call_later(SPOOL_DRAIN_PERIOD_S, drain_spool)
+    publisher.drain()
+
+  if publisher.spool is not None:
+    scheduler.call_later(SPOOL_DRAIN_PERIOD_S, drain_spool)
+
+  # Publish only changed fields, if publish_changes is set
+  init_change_filters(controllers, options_json)
+
+  # Publish aggregates at the end of each period, on the wall clock
+  energy_store = init_aggregators(controllers, options_json)
+
+  def publish_aggregates(period_s):
+    end = round(time.time() / period_s) * period_s
+    scheduler.call_later(
+      end + period_s - time.time(), lambda: publish_aggregates(period_s))
+    for controller in controllers:
+      for command, aggregator in controller.aggregators.items():
+        payload = aggregator.to_json(period_s, end)
+        if payload is not None:
+          publisher.publish(
+            '%s/%ds' % (controller.topics[command], period_s), payload)
+
+  def save_energy():
+    scheduler.call_later(ENERGY_SAVE_PERIOD_S, save_energy)
+    energy_store.save()
+
+  if energy_store is not None:
+    for period_s in options_json['aggregate_periods_sec']:
+      scheduler.call_later(
+        period_s - time.time() % period_s,
+        lambda period_s=period_s: publish_aggregates(period_s))
+    scheduler.call_later(ENERGY_SAVE_PERIOD_S, save_energy)
 
   while True:
     LOG.info(
       'Start to listen to serial port %s. '
       'serial_client.is_open: %s',
       options_json.get('serial_port', '/dev/ttyUSB0'), serial_client.is_open)
+    frame_scanner = FrameScanner(
+      serial_client, verify_crc=verify_crc, stats=frame_stats)
 
     try:
       while True:
-        # Send query request periodically
-        now_ms = read_now_ms()
-        if query_period_ms > 0 and next_query_ms > now_ms:
-          next_query_ms = max(now_ms, next_query_ms + query_period_ms)
-          send_query_command(serial_client)
-
-        # Listen to new messages the rest of the time
-        msg = read_serial_message(serial_client)
-
-        if msg and msg.command == 0xA0:
-          mqtt_client.publish(
-            mqtt_topic_msg, msg.to_json(), qos=mqtt_qos, retain=mqtt_retain)
+        scheduler.run_due()
+
+        # Listen to new messages until the next scheduled call
+        msg = frame_scanner.read_message(scheduler.next_deadline)
+        if msg is None:
+          continue
+        poller.on_message(msg)
+        if not is_decoded(msg):
+          LOG.debug('Dropping frame too short to decode: %s', msg)
+          continue
+        controller = controllers_by_id.get(
+          msg.controller_id, default_controller)
+        if controller.query_period is not None:
+          controller.query_period.on_reading(msg)
+        aggregator = controller.aggregators.get(msg.command)
+        if aggregator is not None:
+          aggregator.on_reading(msg)
+        if history is not None and msg.command == REAL_TIME_DATA_COMMAND:
+          history.append(controller.controller_id, msg)
+
+        change_filter = controller.change_filters.get(msg.command)
+        if change_filter is not None:
+          for topic, payload in change_filter.changes(msg):
+            publisher.publish(topic, payload)
+          continue
+
+        mqtt_topic_msg = controller.topics.get(msg.command)
+        if mqtt_topic_msg is not None:
+          publisher.publish(mqtt_topic_msg, msg.to_json())
           if log_msg_left:
             LOG.info(
               'Picked up message and published to MQTT! (Only first %d '
@@ -294,8 +1755,7 @@ def main(argv):
     LOG.info('Disconnected, will attempt reconnect.')
     reconnect_serial_client(serial_client)
 
-  mqtt_client.publish(
-    mqtt_topic_online, "{\"online\": false}", qos=mqtt_qos, retain=mqtt_retain)
+  publisher.send(mqtt_topic_online, "{\"online\": false}")
 
 
 if __name__ == "__main__":
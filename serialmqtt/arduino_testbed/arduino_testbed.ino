@@ -2,14 +2,129 @@
  * Serial MQTT Bridge Test Bed.
  * 
  * Sends a status message on the serial port every 10s.
- * Echos any incoming message.
+ * Echos any incoming message. Requests with an RPC id, option rpc, are echoed
+ * as the reply to that id.
+ *
+ * Set USE_COBS_MSGPACK to 1 to use the binary framing, serial_framing option
+ * "cobs_msgpack", with topic_ids:
+ *   - id: 1
+ *     topic: status
+ *   - id: 2
+ *     topic: echo
+ * Binary framing needs the ArduinoJson library (v6).
+ *
+ * Set USE_FLOW_CONTROL to 1 for the flow_control option "credit". Frames are
+ * accepted in seq order only, and every frame is acked with the credit.
  */
 
 #include <ESP8266WiFi.h>
 
+#define USE_COBS_MSGPACK 0
+#define USE_FLOW_CONTROL 0
+
+#if USE_COBS_MSGPACK
+#include <ArduinoJson.h>
+#endif
+
 const int SERIAL_BAUD = 74880;
 const int STATUS_PERIOD_MS = 10000;
 
+#if USE_COBS_MSGPACK
+const int TOPIC_ID_STATUS = 1;
+const int TOPIC_ID_ECHO = 2;
+const size_t MAX_FRAME_LEN = 256;
+
+// CRC-16/CCITT-FALSE, same as Python binascii.crc_hqx(data, 0xFFFF).
+uint16_t crc16(const uint8_t* data, size_t len) {
+  uint16_t crc = 0xFFFF;
+  for (size_t i = 0; i < len; i++) {
+    crc ^= (uint16_t)data[i] << 8;
+    for (int bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+// Writes COBS encoded data followed by the 0x00 frame delimiter.
+void writeCobsFrame(const uint8_t* data, size_t len) {
+  uint8_t block[255];
+  size_t block_len = 0;
+  for (size_t i = 0; i < len; i++) {
+    if (data[i] != 0) {
+      block[block_len++] = data[i];
+    }
+    if (data[i] == 0 || block_len == 254) {
+      Serial.write((uint8_t)(block_len + 1));
+      Serial.write(block, block_len);
+      block_len = 0;
+    }
+  }
+  Serial.write((uint8_t)(block_len + 1));
+  Serial.write(block, block_len);
+  Serial.write((uint8_t)0);
+}
+
+// Decodes COBS data in place, returns decoded length or 0 on error.
+size_t cobsDecode(uint8_t* data, size_t len) {
+  size_t read = 0;
+  size_t written = 0;
+  while (read < len) {
+    uint8_t code = data[read++];
+    if (code == 0 || read + code - 1 > len) {
+      return 0;
+    }
+    for (uint8_t i = 1; i < code; i++) {
+      data[written++] = data[read++];
+    }
+    if (code < 0xFF && read < len) {
+      data[written++] = 0;
+    }
+  }
+  return written;
+}
+
+// Sends [topic_id, msg] as a MessagePack frame with CRC.
+void sendFrame(JsonDocument& doc) {
+  uint8_t frame[MAX_FRAME_LEN + 2];
+  size_t len = serializeMsgPack(doc, frame, MAX_FRAME_LEN);
+  uint16_t crc = crc16(frame, len);
+  frame[len++] = crc >> 8;
+  frame[len++] = crc & 0xFF;
+  writeCobsFrame(frame, len);
+}
+#endif
+
+#if USE_FLOW_CONTROL
+const int FLOW_CREDIT = 2;  // Frames to receive before the next ack.
+uint16_t flow_last_seq = 0xFFFF;  // Last accepted seq.
+
+// Reports the last accepted seq and the credit to the bridge.
+void sendFlowAck() {
+  #if USE_COBS_MSGPACK
+    StaticJsonDocument<64> doc;
+    doc.add("flow");
+    JsonObject msg = doc.createNestedObject();
+    msg["ack"] = flow_last_seq;
+    msg["credit"] = FLOW_CREDIT;
+    sendFrame(doc);
+  #else
+    Serial.printf("{\"topic\": \"flow\", \"msg\": {\"ack\": %u, \"credit\": %d}}\n",
+                  flow_last_seq, FLOW_CREDIT);
+  #endif
+}
+
+// Returns true if seq is the next frame in order. Others are lost frames or
+// duplicates of retransmissions, and are dropped.
+bool acceptSeq(long seq) {
+  if (seq != (uint16_t)(flow_last_seq + 1)) {
+    return false;
+  }
+  flow_last_seq = seq;
+  return true;
+}
+#endif
+
 ADC_MODE(ADC_VCC);
 
 String readSerialUntil(char terminator='\n', int max_len=1024, int timeout_ms=1000) {
@@ -68,7 +183,19 @@ void loopStatus() {
   uint64_t uptime_ms = uptime_millis64();
   
   if (uptime_ms >= next_uptime_ms) {
-    #ifdef ESP8266
+    #if USE_COBS_MSGPACK
+      StaticJsonDocument<256> doc;
+      doc.add(TOPIC_ID_STATUS);
+      JsonObject msg = doc.createNestedObject();
+      msg["uptime_ms"] = next_uptime_ms;
+      #ifdef ESP8266
+        msg["vcc"] = (float)ESP.getVcc() / 1024;
+        msg["free_heap_bytes"] = ESP.getFreeHeap();
+        msg["cpu_mhz"] = ESP.getCpuFreqMHz();
+        msg["chip_id"] = ESP.getChipId();
+      #endif
+      sendFrame(doc);
+    #elif defined(ESP8266)
       float vcc = ((float)ESP.getVcc() / 1024);
       int mem_free_bytes = ESP.getFreeHeap();
       int cpu_mhz = ESP.getCpuFreqMHz();
@@ -84,6 +211,55 @@ void loopStatus() {
   }
 }
 
+#if USE_COBS_MSGPACK
+void loopEcho() {
+  static uint8_t frame[MAX_FRAME_LEN];
+  static size_t frame_len = 0;
+
+  while (Serial.available()) {
+    uint8_t new_byte = Serial.read();
+    if (new_byte != 0) {
+      if (frame_len < MAX_FRAME_LEN) {
+        frame[frame_len++] = new_byte;
+      }
+      continue;
+    }
+
+    // End of frame, decode and check CRC.
+    size_t len = cobsDecode(frame, frame_len);
+    frame_len = 0;
+    if (len < 3) {
+      continue;
+    }
+    uint16_t crc = (frame[len - 2] << 8) | frame[len - 1];
+    if (crc16(frame, len - 2) != crc) {
+      continue;
+    }
+    StaticJsonDocument<256> input;
+    if (deserializeMsgPack(input, frame, len - 2)) {
+      continue;
+    }
+    #if USE_FLOW_CONTROL
+      bool accepted = !input[5].isNull() && acceptSeq(input[5]);
+      sendFlowAck();
+      if (!accepted) {
+        continue;
+      }
+    #endif
+
+    StaticJsonDocument<256> doc;
+    doc.add(TOPIC_ID_ECHO);
+    doc.add(input[1]);
+    if (!input[4].isNull()) {
+      // RPC request, reply with its id.
+      doc.add(nullptr);
+      doc.add(nullptr);
+      doc.add(input[4]);
+    }
+    sendFrame(doc);
+  }
+}
+#else
 void loopEcho() {
   if(Serial.available()){
     // Read serial
@@ -91,26 +267,55 @@ void loopEcho() {
     if (input == "") {
       return;
     }
+    #if USE_FLOW_CONTROL
+      // The bridge writes seq first: {"seq": 12, "topic": ...
+      bool accepted = (input.startsWith("{\"seq\": ") &&
+                       acceptSeq(input.substring(8).toInt()));
+      sendFlowAck();
+      if (!accepted) {
+        return;
+      }
+    #endif
+    // RPC requests carry an id, the bridge writes it last: , "id": 17}
+    int id_pos = input.lastIndexOf("\"id\": ");
+    long rpc_id = id_pos >= 0 ? input.substring(id_pos + 6).toInt() : -1;
+    if (!input.endsWith(String(rpc_id) + "}")) {
+      rpc_id = -1;  // Not top level, e.g. inside msg.
+    }
     // Escape for json string.
     input.replace("\"", "\\\"");
 
-    Serial.printf("{\"topic\": \"echo\", \"msg\": \"%s\"}\n", input.c_str());
+    if (rpc_id >= 0) {
+      Serial.printf("{\"id\": %ld, \"msg\": \"%s\"}\n", rpc_id, input.c_str());
+    } else {
+      Serial.printf("{\"topic\": \"echo\", \"msg\": \"%s\"}\n", input.c_str());
+    }
   }
 }
+#endif
 
 void setup() {
   // put your setup code here, to run once:
   Serial.begin(SERIAL_BAUD);
   while (!Serial) continue;
 
-  Serial.println("Serial Testbed starting");
+  #if !USE_COBS_MSGPACK
+    Serial.println("Serial Testbed starting");
+  #endif
 
   randomSeed(micros());
 
+  #if USE_FLOW_CONTROL
+    // Announce the seq expected, the bridge renumbers its frames to follow.
+    sendFlowAck();
+  #endif
+
   //Turn off WiFi to save power
   WiFi.mode(WIFI_OFF);
 
-  Serial.println("Serial Testbed started");
+  #if !USE_COBS_MSGPACK
+    Serial.println("Serial Testbed started");
+  #endif
 }
 
 void loop() {
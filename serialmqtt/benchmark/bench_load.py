@@ -0,0 +1,338 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Load benchmark of serial2mqtt without hardware.
+
+Runs the bridge in-process against a pseudo-terminal pair standing in for the
+serial port, and a minimal in-process MQTT broker standing in for the real
+one. Messages are driven at configurable rates and sizes in both directions:
+
+  read  - lines written to the pty, published by the bridge to the broker.
+  write - publishes injected by the broker, written by the bridge to the pty.
+
+Every message carries its send time, latency is measured on arrival. Each
+scenario runs in its own forked process, so CPU time and memory are those of
+the bridge plus the harness threads (pty writer/reader and broker).
+
+Note that a pty does not limit the rate to a baud rate, the numbers show the
+CPU bound of the bridge.
+
+Usage:
+  python3 bench_load.py --rates 100,1000,0 --sizes 32,512 --output out.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import pty
+import resource
+import socket
+import sys
+import threading
+import time
+import tty
+
+# Allow depend on serial2mqtt.py in the parent directory.
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+import serial2mqtt
+
+PUBLISH_TOPIC = 'bench/read'
+SUBSCRIBE_TOPIC = 'bench/write'
+SUB_TOPIC = 'load'
+DRAIN_S = 1.0  # Time to wait for in flight messages after sending.
+STARTUP_TIMEOUT_S = 10.0
+
+
+def encode_remaining_length(length):
+  out = bytearray()
+  while True:
+    byte = length % 128
+    length //= 128
+    if length:
+      byte |= 0x80
+    out.append(byte)
+    if not length:
+      return bytes(out)
+
+
+def encode_packet(packet_type, body):
+  return bytes([packet_type]) + encode_remaining_length(len(body)) + body
+
+
+def encode_publish(topic, payload):
+  topic = topic.encode('utf-8')
+  return encode_packet(0x30, len(topic).to_bytes(2, 'big') + topic + payload)
+
+
+def topic_matches(topic_filter, topic):
+  filter_levels = topic_filter.split('/')
+  topic_levels = topic.split('/')
+  for i, level in enumerate(filter_levels):
+    if level == '#':
+      return True
+    if i >= len(topic_levels) or level not in ('+', topic_levels[i]):
+      return False
+  return len(filter_levels) == len(topic_levels)
+
+
+class MiniBroker(object):
+  """Minimal MQTT 3.1.1 broker stand-in, enough to drive the bridge.
+
+  Accepts QoS 0 and 1 publishes and subscriptions with wildcards, and
+  delivers everything with QoS 0. No retained messages, sessions or auth.
+  on_publish(topic, payload) is called for every received publish.
+  """
+
+  def __init__(self, on_publish):
+    self.on_publish = on_publish
+    self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.server.bind(('127.0.0.1', 0))
+    self.server.listen(4)
+    self.port = self.server.getsockname()[1]
+    self.lock = threading.Lock()
+    self.subscriptions = []  # [(topic_filter, conn)]
+    self.subscribed = threading.Event()
+
+  def start(self):
+    threading.Thread(target=self._accept, daemon=True).start()
+
+  def _accept(self):
+    while True:
+      conn, _ = self.server.accept()
+      conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+  def _serve(self, conn):
+    stream = conn.makefile('rb', buffering=65536)
+    while True:
+      header = stream.read(1)
+      if not header:
+        return
+      length = 0
+      multiplier = 1
+      while True:
+        byte = stream.read(1)[0]
+        length += (byte & 0x7F) * multiplier
+        multiplier *= 128
+        if not byte & 0x80:
+          break
+      body = stream.read(length)
+      self._handle(conn, header[0], body)
+
+  def _handle(self, conn, header, body):
+    packet_type = header >> 4
+    if packet_type == 1:  # CONNECT
+      conn.sendall(b'\x20\x02\x00\x00')
+    elif packet_type == 3:  # PUBLISH
+      qos = (header >> 1) & 0x03
+      topic_length = int.from_bytes(body[0:2], 'big')
+      topic = body[2:2 + topic_length].decode('utf-8')
+      pos = 2 + topic_length
+      if qos:
+        conn.sendall(b'\x40\x02' + body[pos:pos + 2])  # PUBACK
+        pos += 2
+      self.on_publish(topic, body[pos:])
+      self.publish(topic, body[pos:])
+    elif packet_type == 8:  # SUBSCRIBE
+      packet_id = body[0:2]
+      pos = 2
+      granted = bytearray()
+      while pos < len(body):
+        filter_length = int.from_bytes(body[pos:pos + 2], 'big')
+        topic_filter = body[pos + 2:pos + 2 + filter_length].decode('utf-8')
+        pos += 2 + filter_length + 1
+        granted.append(0)
+        with self.lock:
+          self.subscriptions.append((topic_filter, conn))
+      conn.sendall(encode_packet(0x90, packet_id + bytes(granted)))
+      self.subscribed.set()
+    elif packet_type == 12:  # PINGREQ
+      conn.sendall(b'\xd0\x00')
+    elif packet_type == 14:  # DISCONNECT
+      conn.close()
+
+  def publish(self, topic, payload):
+    """Delivers a publish to all matching subscribers."""
+    packet = None
+    with self.lock:
+      subscriptions = list(self.subscriptions)
+    for topic_filter, conn in subscriptions:
+      if topic_matches(topic_filter, topic):
+        packet = packet or encode_publish(topic, payload)
+        conn.sendall(packet)
+
+
+class LatencyRecorder(object):
+
+  def __init__(self):
+    self.latencies_ms = []
+    self.received = 0
+
+  def record(self, msg):
+    self.received += 1
+    self.latencies_ms.append((time.perf_counter_ns() - msg['t']) / 1e6)
+
+  def percentile(self, fraction):
+    if not self.latencies_ms:
+      return None
+    values = sorted(self.latencies_ms)
+    return round(values[min(len(values) - 1, int(fraction * len(values)))], 3)
+
+
+def send_paced(rate, duration_s, send):
+  """Calls send(seq) rate times per second, as fast as possible if 0."""
+  start = time.perf_counter()
+  seq = 0
+  while True:
+    now = time.perf_counter()
+    if now - start >= duration_s:
+      return seq
+    if rate > 0:
+      due = start + seq / rate
+      if due > now:
+        time.sleep(due - now)
+    send(seq)
+    seq += 1
+
+
+def run_scenario(scenario):
+  """Runs one scenario in this process, returns the result dict."""
+  recorder = LatencyRecorder()
+  published_topic = '%s/%s' % (PUBLISH_TOPIC, SUB_TOPIC)
+
+  def on_broker_publish(topic, payload):
+    if topic == published_topic:
+      recorder.record(json.loads(payload))
+
+  broker = MiniBroker(on_broker_publish)
+  broker.start()
+
+  master, slave = pty.openpty()
+  tty.setraw(slave)
+  options_json = {
+    'mqtt_address': 'mqtt://127.0.0.1:%d' % broker.port,
+    'mqtt_publish_topic': PUBLISH_TOPIC,
+    'mqtt_subscribe_topic': SUBSCRIBE_TOPIC,
+    'serial_port': os.ttyname(slave),
+    'engine': scenario['engine'],
+    'queue_size': scenario['queue_size'],
+  }
+  threading.Thread(
+    target=serial2mqtt.run_bridge, args=(options_json,), daemon=True).start()
+  if not broker.subscribed.wait(STARTUP_TIMEOUT_S):
+    raise RuntimeError('Bridge did not subscribe to the broker')
+
+  pad = 'x' * scenario['size']
+  if scenario['direction'] == 'read':
+    def send(seq):
+      line = json.dumps({'topic': SUB_TOPIC, 'msg': {
+        't': time.perf_counter_ns(), 'seq': seq, 'pad': pad}})
+      os.write(master, line.encode('utf-8') + b'\n')
+  else:
+    write_topic = '%s/%s' % (SUBSCRIBE_TOPIC, SUB_TOPIC)
+
+    def send(seq):
+      broker.publish(write_topic, json.dumps(
+        {'t': time.perf_counter_ns(), 'seq': seq, 'pad': pad}).encode('utf-8'))
+
+    def read_serial():
+      reader = serial2mqtt.SerialLineReader(None)
+      while True:
+        for line in reader.feed(os.read(master, 65536)):
+          recorder.record(json.loads(line)['msg'])
+
+    threading.Thread(target=read_serial, daemon=True).start()
+
+  usage_start = resource.getrusage(resource.RUSAGE_SELF)
+  start = time.perf_counter()
+  sent = send_paced(scenario['rate'], scenario['duration_s'], send)
+  time.sleep(DRAIN_S)
+  elapsed_s = time.perf_counter() - start
+  usage_end = resource.getrusage(resource.RUSAGE_SELF)
+
+  cpu_s = ((usage_end.ru_utime - usage_start.ru_utime) +
+           (usage_end.ru_stime - usage_start.ru_stime))
+  result = dict(scenario)
+  result.update({
+    'sent': sent,
+    'received': recorder.received,
+    'lost': sent - recorder.received,
+    'msgs_per_s': round(recorder.received / scenario['duration_s'], 1),
+    'cpu_us_per_msg': round(cpu_s * 1e6 / recorder.received, 1)
+                      if recorder.received else None,
+    'cpu_percent': round(cpu_s * 100.0 / elapsed_s, 1),
+    'max_rss_kb': usage_end.ru_maxrss,
+    'latency_ms': {
+      'p50': recorder.percentile(0.5),
+      'p99': recorder.percentile(0.99),
+      'max': round(max(recorder.latencies_ms), 3)
+             if recorder.latencies_ms else None,
+    },
+  })
+  return result
+
+
+def run_scenario_process(scenario, results):
+  results.put(run_scenario(scenario))
+  results.close()
+  results.join_thread()
+  os._exit(0)  # The bridge threads never return.
+
+
+def parse_ints(text):
+  return [int(value) for value in text.split(',')]
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--directions', default='read,write',
+                      help='Comma separated: read, write.')
+  parser.add_argument('--rates', type=parse_ints, default=[100, 1000, 0],
+                      help='Messages per second, 0 for as fast as possible.')
+  parser.add_argument('--sizes', type=parse_ints, default=[32, 512],
+                      help='Payload padding in bytes.')
+  parser.add_argument('--engines', default='thread',
+                      help='Comma separated: thread, asyncio.')
+  parser.add_argument('--duration', type=float, default=5.0,
+                      help='Seconds to send per scenario.')
+  parser.add_argument('--queue-size', type=int,
+                      default=serial2mqtt.DEFAULT_QUEUE_SIZE)
+  parser.add_argument('--output', help='Write results as JSON to this file.')
+  args = parser.parse_args(argv[1:])
+
+  # Dropped messages are counted as lost, do not log each one.
+  serial2mqtt.LOG.setLevel(serial2mqtt.logging.ERROR)
+  context = multiprocessing.get_context('fork')
+  results = []
+  for engine in args.engines.split(','):
+    for direction in args.directions.split(','):
+      for rate in args.rates:
+        for size in args.sizes:
+          scenario = {
+            'engine': engine, 'direction': direction, 'rate': rate,
+            'size': size, 'duration_s': args.duration,
+            'queue_size': args.queue_size,
+          }
+          queue = context.Queue()
+          process = context.Process(
+            target=run_scenario_process, args=(scenario, queue))
+          process.start()
+          result = queue.get()
+          process.join()
+          results.append(result)
+          print('%-7s %-5s rate %6s size %5d: %9.1f msg/s, lost %6d, '
+                '%7s us/msg, p50 %s ms, p99 %s ms, rss %d kB' % (
+                  engine, direction, rate or 'max', size, result['msgs_per_s'],
+                  result['lost'], result['cpu_us_per_msg'],
+                  result['latency_ms']['p50'], result['latency_ms']['p99'],
+                  result['max_rss_kb']))
+
+  if args.output:
+    with open(args.output, 'w') as output_file:
+      json.dump({'time': time.time(), 'results': results}, output_file,
+                indent=2)
+
+
+if __name__ == "__main__":
+  main(sys.argv)
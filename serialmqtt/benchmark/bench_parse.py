@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Microbenchmark of the serial2mqtt per line parse cost.
+
+Compares the v0.1 line handling (options lookups, json.loads on every line and
+% topic formatting per line) with parse_serial_line and a compiled policy.
+Publishing itself is not included.
+
+Usage: python3 bench_parse.py [iterations]
+"""
+
+import json
+import os
+import sys
+import timeit
+
+# Allow depend on serial2mqtt.py in the parent directory.
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+import serial2mqtt
+
+OPTIONS_JSON = {
+  'mqtt_publish_topic': 'arduino/read',
+  'mqtt_publish_qos': 0,
+  'mqtt_publish_retain': False,
+  'topic_policies': [
+    {'topic': 'status', 'coalesce': 'state', 'log_level': 'debug'},
+    {'topic': 'bresser/*', 'qos': 1},
+  ],
+}
+
+LINES = {
+  'json': b'{"topic": "bresser/ch2", "msg": {"battery": 1, "temp": 249, '
+          b'"humidity": 29}}\n',
+  'string': b'{"topic": "echo", "msg": "hello world"}\n',
+  'log': b'Serial Testbed started, free heap 41234 bytes\n',
+}
+
+
+def baseline_parse_line(line, mqtt_publish_topic, options_json):
+  """The v0.1 process_serial_readline, without the publish."""
+  qos = options_json.get('mqtt_publish_qos', 0)
+  retain = options_json.get('mqtt_publish_retain', False)
+
+  try:
+    line = line.decode('utf-8')
+    line_json = json.loads(line)
+    sub_topic = line_json.get('topic', 'data')
+    msg = line_json.get('msg', None)
+    qos = line_json.get('qos', qos)
+    retain = line_json.get('retain', retain)
+  except UnicodeDecodeError:
+    return None
+  except json.JSONDecodeError:
+    msg = None
+
+  if msg is None:
+    sub_topic = 'log'
+    msg_str = line
+  elif isinstance(msg, dict):
+    msg_str = json.dumps(msg)
+  elif isinstance(msg, str):
+    msg_str = msg
+  else:
+    msg_str = '%s' % msg
+
+  topic = '%s/%s' % (mqtt_publish_topic, sub_topic)
+  return topic, msg_str, qos, retain
+
+
+def bench(func, iterations):
+  """Returns the per call time in microseconds, best of 5 runs."""
+  return min(timeit.repeat(func, number=iterations, repeat=5)) / iterations * 1e6
+
+
+def main(argv):
+  iterations = int(argv[1]) if len(argv) > 1 else 100000
+  policy = serial2mqtt.init_policy('arduino/read', OPTIONS_JSON)
+
+  print('JSON backend: %s' % serial2mqtt.json_loads.__module__)
+  print('%-8s %12s %12s %8s' % ('line', 'before (us)', 'after (us)', 'speedup'))
+  for name, line in LINES.items():
+    before = bench(
+      lambda: baseline_parse_line(line, 'arduino/read', OPTIONS_JSON),
+      iterations)
+    after = bench(lambda: serial2mqtt.parse_serial_line(line, policy),
+                  iterations)
+    print('%-8s %12.2f %12.2f %7.1fx' % (name, before, after, before / after))
+
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -0,0 +1,194 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Replays a serial2mqtt recording through the serial parse and publish path.
+
+Recordings are made by the bridge with the record_dir option. The recorded
+serial input is fed to process_serial_readline at the recorded pace, sped up
+by --speed, or as fast as possible with --speed 0. Publishes are counted, not
+sent, so the numbers show the cost of the bridge hot path for real traffic.
+
+By default an in-memory serial stand-in returns the recorded reads. With
+--pty the data is written to a pseudo-terminal and read back with pyserial,
+including the driver and system call overhead. Reconnects in the recording
+reset the line reader in memory only.
+
+Usage:
+  python3 bench_replay.py recording.s2mrec --speed 0 --options options.json
+"""
+
+import argparse
+import json
+import os
+import pty
+import resource
+import sys
+import threading
+import time
+import tty
+
+import serial
+
+# Allow depend on serial2mqtt.py in the parent directory.
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+import serial2mqtt
+
+PTY_READ_TIMEOUT_S = 0.5
+
+
+class ReplaySerial(object):
+  """In-memory serial stand-in, returns recorded data once it is due.
+
+  Raises EOFError when the recording has been read. on_reset is called for
+  reconnect records.
+  """
+
+  def __init__(self, records, speed, on_reset):
+    self.records = records
+    self.speed = speed
+    self.on_reset = on_reset
+    self.index = 0
+    self.pending = bytearray()
+    self.start = time.perf_counter()
+
+  def _due(self, offset_s):
+    return self.speed <= 0 or (
+      time.perf_counter() - self.start >= offset_s / self.speed)
+
+  def _fill(self, block):
+    while self.index < len(self.records):
+      offset_s, data = self.records[self.index]
+      if not self._due(offset_s):
+        if self.pending or not block:
+          return
+        time.sleep(max(0.0, offset_s / self.speed -
+                       (time.perf_counter() - self.start)))
+      self.index += 1
+      if data:
+        self.pending += data
+      else:
+        self.on_reset()
+    if block and not self.pending:
+      raise EOFError()
+
+  @property
+  def in_waiting(self):
+    self._fill(block=False)
+    return len(self.pending)
+
+  def read(self, size=1):
+    self._fill(block=True)
+    data = bytes(self.pending[:size])
+    del self.pending[:size]
+    return data
+
+
+def write_paced(fd, records, speed):
+  """Writes the recorded data to fd at its recorded pace."""
+  start = time.perf_counter()
+  for offset_s, data in records:
+    if speed > 0:
+      delay_s = offset_s / speed - (time.perf_counter() - start)
+      if delay_s > 0:
+        time.sleep(delay_s)
+    view = memoryview(data)
+    while view:
+      view = view[os.write(fd, view):]
+
+
+def replay(records, options_json, speed, use_pty):
+  """Replays records, returns the result dict."""
+  mqtt_publish_topic, _ = serial2mqtt.init_topics(options_json)
+  policy = serial2mqtt.init_policy(mqtt_publish_topic, options_json)
+  metrics = serial2mqtt.PortMetrics('replay', lambda: 0, lambda: 0)
+
+  def publish(topic_policy, payload, qos, retain):
+    metrics.published += 1
+
+  publisher = serial2mqtt.init_publisher(publish, options_json)
+
+  line_reader = serial2mqtt.SerialLineReader(
+    None, delimiter=policy.codec.delimiter)
+  if use_pty:
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    serial_client = serial.Serial(
+      os.ttyname(slave), timeout=PTY_READ_TIMEOUT_S)
+    writer = threading.Thread(
+      target=write_paced, args=(master, records, speed), daemon=True)
+  else:
+    serial_client = ReplaySerial(records, speed, line_reader.reset)
+  line_reader.serial_client = serial_client
+
+  usage_start = resource.getrusage(resource.RUSAGE_SELF)
+  start = time.perf_counter()
+  if use_pty:
+    writer.start()
+  while True:
+    try:
+      serial2mqtt.process_serial_readline(
+        line_reader, publisher, policy, metrics)
+    except EOFError:
+      break
+    if use_pty and not writer.is_alive() and not serial_client.in_waiting:
+      break
+  publisher.flush()
+  elapsed_s = time.perf_counter() - start
+  usage_end = resource.getrusage(resource.RUSAGE_SELF)
+
+  cpu_s = ((usage_end.ru_utime - usage_start.ru_utime) +
+           (usage_end.ru_stime - usage_start.ru_stime))
+  recorded_s = records[-1][0] if records else 0.0
+  lines = metrics.serial_lines
+  return {
+    'speed': speed,
+    'pty': use_pty,
+    'recorded_s': round(recorded_s, 3),
+    'elapsed_s': round(elapsed_s, 3),
+    'speedup': round(recorded_s / elapsed_s, 1) if elapsed_s else None,
+    'bytes': metrics.serial_bytes,
+    'lines': lines,
+    'lines_per_s': round(lines / elapsed_s, 1) if elapsed_s else None,
+    'mb_per_s': round(metrics.serial_bytes / elapsed_s / 1e6, 3)
+                if elapsed_s else None,
+    'parse_failures': metrics.parse_failures,
+    'parse_failure_rate': round(metrics.parse_failures / lines, 4)
+                          if lines else None,
+    'published': metrics.published,
+    'cpu_us_per_line': round(cpu_s * 1e6 / lines, 2) if lines else None,
+  }
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('recording', help='Recording made with record_dir.')
+  parser.add_argument('--speed', type=float, default=0.0,
+                      help='1 for real time, N for N times faster, 0 for as '
+                           'fast as possible.')
+  parser.add_argument('--pty', action='store_true',
+                      help='Replay through a pseudo-terminal.')
+  parser.add_argument('--options',
+                      help='Add-on options.json, for topics, framing and '
+                           'topic_policies.')
+  parser.add_argument('--output', help='Write the result as JSON to this file.')
+  args = parser.parse_args(argv[1:])
+
+  options_json = {}
+  if args.options:
+    with open(args.options) as options_file:
+      options_json = json.load(options_file)
+  # Only the totals are of interest, do not log each message.
+  serial2mqtt.LOG.setLevel(serial2mqtt.logging.ERROR)
+
+  records = list(serial2mqtt.read_recording(args.recording))
+  result = replay(records, options_json, args.speed, args.pty)
+  result['recording'] = args.recording
+  print(json.dumps(result, indent=2))
+
+  if args.output:
+    with open(args.output, 'w') as output_file:
+      json.dump(result, output_file, indent=2)
+
+
+if __name__ == "__main__":
+  main(sys.argv)
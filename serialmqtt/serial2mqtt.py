@@ -6,25 +6,87 @@
 Uesful to hook up Arduino to Raspberry Pi.
 """
 
+import asyncio
+import binascii
+import bisect
+import collections
+import ctypes
+import fnmatch
+import heapq
+import http.server
 import json
 import logging
+import os
+import re
+import select
+import selectors
+import struct
 import sys
 import serial
+import threading
 import time
 from urllib.parse import urlparse
-import functools
 
+import msgpack
 from paho.mqtt import client as mqtt
 
+try:
+  # Faster JSON parsing, if available.
+  from orjson import loads as json_loads
+except ImportError:
+  from json import loads as json_loads
+
 
 LOG = logging.getLogger(__name__)
 LOG.setLevel(logging.INFO)
 
 SERIAL_TIMEOUT = 100.0  # seconds?
-RECONNECT_TIMEOUT_S = 30.0  # seconds
+RECONNECT_MIN_S = 0.5  # First reconnect backoff, doubled on each failure.
+RECONNECT_TIMEOUT_S = 30.0  # seconds, max reconnect backoff.
 
 MAX_LINE_LENGTH = 64*1024
 MQTT_SUBSCRIBE_QOS = 1  # At least once delivery.
+MQTT_MISC_PERIOD_S = 1.0  # How often the asyncio engine services keepalives.
+
+DEFAULT_QUEUE_SIZE = 100  # Max queued lines/messages in each direction.
+DEFAULT_PUBLISH_FLUSH_MS = 1000
+COALESCE_MODES = ('state', 'event')
+LOG_LEVELS = {
+  'debug': logging.DEBUG,
+  'info': logging.INFO,
+  'warning': logging.WARNING,
+  'none': logging.CRITICAL + 1,
+}
+MAX_CACHED_TOPICS = 1024
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+MAX_TRACKED_PUBLISHES = 10000
+STATS_SUB_TOPIC = 'bridge_stats'
+RPC_SUB_TOPIC = 'rpc'  # Requests on $mqtt_subscribe_topic/rpc/<sub_topic>.
+DEFAULT_RPC_TIMEOUT_MS = 5000
+DEFAULT_RPC_MAX_IN_FLIGHT = 8
+RPC_EXPIRE_PERIOD_S = 0.1  # Resolution of RPC timeouts.
+MAX_RPC_ID = 0xFFFF  # Ids sent to serial wrap around, fit in 16 bits.
+FLOW_SUB_TOPIC = 'flow'  # Acks and credit from the device, with flow_control.
+FLOW_CONTROL_MODES = ('none', 'credit')
+DEFAULT_FLOW_CREDIT = 1  # Frames in flight until the device advertises credit.
+DEFAULT_FLOW_RETRANSMIT_MS = 500
+MAX_FLOW_SEQ = 0xFFFF  # Sequence numbers wrap around, fit in 16 bits.
+CHUNK_SUB_TOPIC = 'chunk'  # Chunks of large payloads, with chunk_mode.
+CHUNK_MODES = ('off', 'reassemble', 'stream')
+DEFAULT_CHUNK_MAX_BYTES = 1024*1024
+DEFAULT_CHUNK_MAX_TRANSFERS = 4
+DEFAULT_CHUNK_TIMEOUT_MS = 10000
+CHUNK_EXPIRE_PERIOD_S = 1.0  # How often the asyncio engine drops timed out.
+RECORDING_MAGIC = b'S2MQREC1'
+RECORDING_START = struct.Struct('<d')  # Wall clock start, epoch seconds.
+RECORD_HEADER = struct.Struct('<QI')  # ns since start, data length.
+RECORDING_SUFFIX = '.s2mrec'
+DEFAULT_RECORD_MAX_MB = 100
+RECORD_FLUSH_S = 1.0
+DROP_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+WRITE_BATCH_BYTES = 4096  # Max bytes of queued frames joined into one write.
+WRITER_BLOCK_TIMEOUT_S = 5.0  # Max wait for queue space with 'block' policy.
+WRITER_IDLE_CHECK_S = 1.0  # How often a waiting writer checks the port.
 
 
 def init_logger_stdout():
@@ -113,167 +175,2107 @@ def init_serial_client(options_json):
     sys.exit(1)
 
 
-def reconnect_serial_client(serial_client):
-  while not serial_client.is_open:
+# inotify(7) event masks, see <sys/inotify.h>.
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len; then name.
+
+
+class DeviceWatcher(object):
+  """Signals when a serial device node (re)appears, using inotify.
+
+  Watches the directory of the device, e.g. /dev or /dev/serial/by-id, for
+  the device name being created, moved in or getting its permissions set by
+  udev. Where inotify is not available (not Linux, or the directory itself is
+  gone) available is False and wait() just sleeps, so callers fall back to
+  plain backoff.
+  """
+
+  def __init__(self, device_path):
+    self.directory, self.name = os.path.split(device_path)
+    self.name = self.name.encode()
+    self.fd = -1
     try:
-      serial_client.open()
-    except serial.SerialException as se:
-      LOG.info('Reconnection attempt failed, waiting %d s: %s',
-               RECONNECT_TIMEOUT_S, str(se))
-      time.sleep(RECONNECT_TIMEOUT_S)
-      continue
+      libc = ctypes.CDLL(None, use_errno=True)
+      fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+      if fd < 0:
+        raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+      if libc.inotify_add_watch(fd, (self.directory or '.').encode(),
+                                IN_CREATE | IN_ATTRIB | IN_MOVED_TO) < 0:
+        errno = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(errno, 'inotify_add_watch %s failed' % self.directory)
+      self.fd = fd
+    except (OSError, AttributeError) as e:
+      LOG.info('Hotplug detection for %s not available, using backoff: %s',
+               device_path, str(e))
+
+  @property
+  def available(self):
+    return self.fd >= 0
+
+  def fileno(self):
+    return self.fd
+
+  def read_events(self):
+    """Consumes pending events, returns True if any was for the device."""
+    try:
+      data = os.read(self.fd, 4096)
+    except BlockingIOError:
+      return False
+    found = False
+    offset = 0
+    while offset < len(data):
+      _, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+      offset += INOTIFY_EVENT.size
+      if data[offset:offset + length].rstrip(b'\0') == self.name:
+        found = True
+      offset += length
+    return found
+
+  def wait(self, timeout_s):
+    """Blocks until the device appears or timeout_s passed."""
+    if not self.available:
+      time.sleep(timeout_s)
+      return False
+    deadline = time.monotonic() + timeout_s
+    while True:
+      remaining_s = deadline - time.monotonic()
+      if remaining_s <= 0:
+        return False
+      readable, _, _ = select.select([self.fd], [], [], remaining_s)
+      if readable and self.read_events():
+        return True
+
+  def close(self):
+    if self.fd >= 0:
+      os.close(self.fd)
+      self.fd = -1
+
+
+def reconnect_serial_client(serial_client):
+  """Reopens serial_client, as soon as its device node reappears.
+
+  Retries with exponential backoff from RECONNECT_MIN_S up to
+  RECONNECT_TIMEOUT_S, a hotplug event cuts the wait short.
+  """
+  # Watch before the first attempt, so a device appearing in between is seen.
+  watcher = DeviceWatcher(serial_client.port)
+  backoff_s = RECONNECT_MIN_S
+  try:
+    while not serial_client.is_open:
+      try:
+        serial_client.open()
+      except serial.SerialException as se:
+        LOG.info('Reconnection attempt failed, waiting up to %.1f s: %s',
+                 backoff_s, str(se))
+        if watcher.wait(backoff_s):
+          LOG.info('Serial device %s appeared.', serial_client.port)
+          # udev may still be setting up permissions, retry quickly.
+          backoff_s = RECONNECT_MIN_S
+        else:
+          backoff_s = min(backoff_s * 2, RECONNECT_TIMEOUT_S)
+  finally:
+    watcher.close()
   LOG.info('Reconnection to serial successful!')
 
 
-def process_serial_readline(serial_client, mqtt_client, mqtt_publish_topic, options_json):
-  line = serial_client.readline(MAX_LINE_LENGTH)
-  if not line:
+class SerialLineReader(object):
+  """Reads newline terminated lines from the serial port in bulk.
+
+  pyserial's readline() reads one byte at a time, which burns CPU at high baud
+  rates. This instead drains everything waiting in the driver in one read into
+  a reusable buffer and splits out all complete lines. Incomplete lines are
+  kept until the rest arrives. Lines longer than max_line_length are split,
+  same as readline(max_line_length) would do. With a recorder, all data read
+  is recorded as is.
+  """
+
+  def __init__(self, serial_client, max_line_length=MAX_LINE_LENGTH,
+               delimiter=b'\n', recorder=None):
+    self.serial_client = serial_client
+    self.max_line_length = max_line_length
+    self.delimiter = delimiter
+    self.recorder = recorder
+    self._buffer = bytearray()
+
+  def reset(self):
+    """Drops any partially received line, e.g. after a reconnect."""
+    del self._buffer[:]
+    if self.recorder is not None:
+      self.recorder.record(b'')
+
+  def read_lines(self):
+    """Blocks until data arrives or timeout, returns complete lines read."""
+    waiting = self.serial_client.in_waiting
+    data = self.serial_client.read(waiting or 1)
+    if not data:
+      return []  # Read timeout
+    if not waiting:
+      # Woke up on the first byte, pick up whatever arrived with it.
+      waiting = self.serial_client.in_waiting
+      if waiting:
+        data += self.serial_client.read(waiting)
+    return self.feed(data)
+
+  def feed(self, data):
+    """Appends raw serial data, returns the list of complete lines.
+
+    Lines are returned as bytes including the line terminator.
+    """
+    if self.recorder is not None:
+      self.recorder.record(data)
+    buf = self._buffer
+    buf += data
+    lines = []
+    start = 0
+    end = len(buf)
+    with memoryview(buf) as view:
+      while start < end:
+        newline = buf.find(self.delimiter, start, start + self.max_line_length)
+        if newline >= 0:
+          stop = newline + 1
+        elif end - start >= self.max_line_length:
+          stop = start + self.max_line_length
+        else:
+          break
+        lines.append(bytes(view[start:stop]))
+        start = stop
+    if start:
+      del buf[:start]
+    return lines
+
+
+class SerialRecorder(object):
+  """Records the raw serial input with timestamps, for replay.
+
+  The file starts with RECORDING_MAGIC and the wall clock start time as a
+  little endian double. Each read follows as the little endian uint64
+  nanoseconds since the start, on the monotonic clock, the uint32 length and
+  the data. A record of length 0 marks a reconnect. Recording stops when the
+  file would exceed max_bytes.
+  """
+
+  def __init__(self, path, max_bytes):
+    self.path = path
+    self.max_bytes = max_bytes
+    self._file = open(path, 'wb')
+    self._file.write(RECORDING_MAGIC + RECORDING_START.pack(time.time()))
+    self._size = len(RECORDING_MAGIC) + RECORDING_START.size
+    self._start_ns = time.monotonic_ns()
+    self._flush_at = time.monotonic() + RECORD_FLUSH_S
+    LOG.info('Recording serial input to %s', path)
+
+  def record(self, data):
+    if self._file is None:
+      return
+    self._size += RECORD_HEADER.size + len(data)
+    if self._size > self.max_bytes:
+      LOG.warning('Recording %s reached %d bytes, stopped.', self.path,
+                  self.max_bytes)
+      self.close()
+      return
+    self._file.write(
+      RECORD_HEADER.pack(time.monotonic_ns() - self._start_ns, len(data)))
+    self._file.write(data)
+    if time.monotonic() >= self._flush_at:
+      self._file.flush()
+      self._flush_at = time.monotonic() + RECORD_FLUSH_S
+
+  def close(self):
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+
+def init_recorder(serial_port, options_json):
+  """Returns a SerialRecorder into record_dir, None if not set."""
+  record_dir = options_json.get('record_dir')
+  if not record_dir:
+    return None
+  path = os.path.join(record_dir, '%s-%s%s' % (
+    os.path.basename(serial_port), time.strftime('%Y%m%d-%H%M%S'),
+    RECORDING_SUFFIX))
+  try:
+    os.makedirs(record_dir, exist_ok=True)
+    return SerialRecorder(
+      path, options_json.get('record_max_mb', DEFAULT_RECORD_MAX_MB) << 20)
+  except OSError as e:
+    LOG.fatal('Could not create recording %s, check option record_dir: %s',
+              path, str(e))
+    sys.exit(1)
+
+
+def read_recording(path):
+  """Yields (seconds since start, data) of each record of a recording."""
+  with open(path, 'rb') as recording:
+    header = recording.read(len(RECORDING_MAGIC) + RECORDING_START.size)
+    if not header.startswith(RECORDING_MAGIC):
+      raise ValueError('Not a serial2mqtt recording: %s' % path)
+    while True:
+      record_header = recording.read(RECORD_HEADER.size)
+      if len(record_header) < RECORD_HEADER.size:
+        return  # End, or cut short by a crash.
+      offset_ns, length = RECORD_HEADER.unpack(record_header)
+      data = recording.read(length)
+      if len(data) < length:
+        return
+      yield offset_ns / 1e9, data
+
+
+def process_serial_readline(line_reader, publisher, policy, metrics=None,
+                            rpc=None, handlers=None):
+  lines = line_reader.read_lines()
+  if metrics is not None and lines:
+    metrics.on_serial_lines(lines, time.monotonic())
+  for line in lines:
+    process_serial_line(line, publisher, policy, metrics, rpc, handlers)
+  publisher.flush_if_due()
+
+
+def process_serial_line(line, publisher, policy, metrics=None, rpc=None,
+                        handlers=None):
+  parsed = parse_serial_line(line, policy, metrics, rpc, handlers)
+  if parsed is None:
     return
+  publisher.publish(*parsed)
+
+
+def publish_mqtt(mqtt_client, topic_policy, payload, qos, retain):
+  info = mqtt_client.publish(
+    topic_policy.topic, payload, qos=qos, retain=retain)
+  if LOG.isEnabledFor(topic_policy.log_level):
+    LOG.log(topic_policy.log_level, 'Published %s: %s', topic_policy.topic,
+            payload)
+  return info
 
-  qos = options_json.get('mqtt_publish_qos', 0)
-  retain = options_json.get('mqtt_publish_retain', False)
 
+def to_json_value(payload):
   try:
-    line = line.decode('utf-8')
-    line_json = json.loads(line)
-    sub_topic = line_json.get('topic', 'data')
-    msg = line_json.get('msg', None)
-    qos = line_json.get('qos', qos)
-    retain = line_json.get('retain', retain)
+    return json.loads(payload)
+  except ValueError:
+    if isinstance(payload, bytes):
+      return payload.hex()
+    return payload
+
+
+class CoalescingPublisher(object):
+  """Holds back publishes on busy topics and flushes them once per window.
+
+  The coalesce field of the topic policy selects how:
+    state - only the latest payload per topic is published.
+    event - all payloads per topic are published as one JSON array.
+  Topics without coalesce are published right away.
+  """
+
+  def __init__(self, publish, flush_window_s):
+    self.publish_now = publish
+    self.flush_window_s = flush_window_s
+    self._state = {}  # topic -> (topic_policy, payload, qos, retain)
+    self._events = {}  # topic -> (topic_policy, [payload, ...], qos, retain)
+    self._flush_at = None
+
+  @property
+  def flush_at(self):
+    """Monotonic time of the next flush, None if nothing is held back."""
+    return self._flush_at
+
+  def publish(self, topic_policy, payload, qos, retain):
+    mode = topic_policy.coalesce
+    if mode is None:
+      self.publish_now(topic_policy, payload, qos, retain)
+      return
+
+    topic = topic_policy.topic
+    if mode == 'state':
+      self._state[topic] = (topic_policy, payload, qos, retain)
+    else:
+      events = self._events.get(topic)
+      if events is None:
+        self._events[topic] = (topic_policy, [payload], qos, retain)
+      else:
+        events[1].append(payload)
+    if self._flush_at is None:
+      self._flush_at = time.monotonic() + self.flush_window_s
+
+  def flush_if_due(self):
+    if self._flush_at is not None and time.monotonic() >= self._flush_at:
+      self.flush()
+
+  def flush(self):
+    state, self._state = self._state, {}
+    events, self._events = self._events, {}
+    self._flush_at = None
+    for topic_policy, payload, qos, retain in state.values():
+      self.publish_now(topic_policy, payload, qos, retain)
+    for topic_policy, payloads, qos, retain in events.values():
+      batch = json.dumps([to_json_value(payload) for payload in payloads])
+      self.publish_now(topic_policy, batch, qos, retain)
+
+
+def init_publisher(publish, options_json):
+  flush_window_s = (
+    options_json.get('publish_flush_ms', DEFAULT_PUBLISH_FLUSH_MS) / 1000.0)
+  return CoalescingPublisher(publish, flush_window_s)
+
+
+TopicPolicy = collections.namedtuple(
+  'TopicPolicy', ['topic', 'qos', 'retain', 'coalesce', 'log_level'])
+
+
+class PublishPolicy(object):
+  """Publish options of one serial port, compiled once from options_json.
+
+  Maps each sub-topic to a TopicPolicy with the full MQTT topic and the qos,
+  retain, coalesce and log_level to use. The first topic_policies entry whose
+  topic glob matches the sub-topic applies, unset fields fall back to the
+  port defaults. Lookups are cached per sub-topic, so the per line cost is a
+  dict lookup.
+  """
+
+  def __init__(self, mqtt_publish_topic, options_json, codec):
+    self.codec = codec
+    self.topic_prefix = mqtt_publish_topic + '/'
+    self.qos = options_json.get('mqtt_publish_qos', 0)
+    self.retain = options_json.get('mqtt_publish_retain', False)
+
+    rules = []
+    for rule in options_json.get('topic_policies', []):
+      coalesce = rule.get('coalesce')
+      if coalesce is not None and coalesce not in COALESCE_MODES:
+        LOG.fatal(
+          'Incorrect option topic_policies, coalesce must be one of %s, got '
+          '%s.', COALESCE_MODES, coalesce)
+        sys.exit(1)
+      log_level = rule.get('log_level', 'info')
+      if log_level not in LOG_LEVELS:
+        LOG.fatal(
+          'Incorrect option topic_policies, log_level must be one of %s, got '
+          '%s.', tuple(LOG_LEVELS), log_level)
+        sys.exit(1)
+      match = re.compile(fnmatch.translate(rule['topic'])).match
+      rules.append((match, rule.get('qos'), rule.get('retain'), coalesce,
+                    LOG_LEVELS[log_level]))
+    self._rules = tuple(rules)
+    self._cache = {}
+    self.coalescing = any(rule[3] for rule in rules)
+
+  def lookup(self, sub_topic):
+    try:
+      return self._cache[sub_topic]
+    except KeyError:
+      pass
+    topic_policy = TopicPolicy(
+      self.topic_prefix + sub_topic, self.qos, self.retain, None, logging.INFO)
+    for match, qos, retain, coalesce, log_level in self._rules:
+      if match(sub_topic):
+        topic_policy = TopicPolicy(
+          topic_policy.topic,
+          self.qos if qos is None else qos,
+          self.retain if retain is None else retain,
+          coalesce, log_level)
+        break
+    if len(self._cache) >= MAX_CACHED_TOPICS:
+      self._cache.clear()
+    self._cache[sub_topic] = topic_policy
+    return topic_policy
+
+
+def init_policy(mqtt_publish_topic, options_json):
+  return PublishPolicy(mqtt_publish_topic, options_json,
+                       init_codec(options_json))
+
+
+def parse_serial_line(line, policy, metrics=None, rpc=None, handlers=None):
+  """Parses a serial line, returns (topic_policy, payload, qos, retain).
+
+  Returns None if the line is dropped. Replies to requests in flight on rpc
+  are routed to the response topic of the request. Messages on a sub-topic in
+  handlers, e.g. flow control acks or chunks, are passed to
+  handlers[sub_topic](msg) instead, which returns what to publish, if anything.
+  """
+  try:
+    sub_topic, msg, qos, retain, rpc_id = policy.codec.decode(line)
   except UnicodeDecodeError as ue:
+    if metrics is not None:
+      metrics.parse_failures += 1
     LOG.warning('Could not decode as utf-8: "%s", passing on as is, error: %s',
                 line, str(ue))
-    return
-  except json.JSONDecodeError as je:
-    # Messages that cannot be parsed, just pass on to the 'log' topic.
-    msg = None
+    return None
+  except ValueError as ve:
+    if metrics is not None:
+      metrics.parse_failures += 1
+    if policy.codec.binary:
+      LOG.warning('Could not decode serial frame: %s, error: %s', line, str(ve))
+      return None
+    try:
+      # Messages that cannot be parsed, just pass on to the 'log' topic.
+      sub_topic, msg, qos, retain, rpc_id = (
+        'log', line.decode('utf-8'), None, None, None)
+    except UnicodeDecodeError as ue:
+      LOG.warning('Could not decode as utf-8: "%s", passing on as is, '
+                  'error: %s', line, str(ue))
+      return None
 
-  if msg is None:
-    sub_topic = 'log'
-    msg_str = line
-  elif isinstance(msg, dict):
-    msg_str = json.dumps(msg)
-  elif isinstance(msg, str):
+  if msg is NO_MSG:
+    # A line with an id and no msg, e.g. {"id": 17}, replies to a request in
+    # flight. Any other is passed on to the 'log' topic.
+    reply = rpc.reply(rpc_id, None) if rpc is not None else None
+    if reply is not None:
+      return reply
+    sub_topic, msg, qos, retain, rpc_id = (
+      'log', line.decode('utf-8'), None, None, None)
+
+  if handlers is not None:
+    handler = handlers.get(sub_topic)
+    if handler is not None:
+      return handler(msg)
+
+  if rpc_id is not None and rpc is not None:
+    reply = rpc.reply(rpc_id, msg)
+    if reply is not None:
+      return reply
+    # Late or unknown reply, published like any other message.
+
+  if not isinstance(sub_topic, str):
+    sub_topic = '%s' % sub_topic
+  topic_policy = policy.lookup(sub_topic)
+  if qos is None:
+    qos = topic_policy.qos
+  if retain is None:
+    retain = topic_policy.retain
+
+  if isinstance(msg, (str, bytes)):
     msg_str = msg
+  elif isinstance(msg, (dict, list)):
+    msg_str = json.dumps(msg)
   else:
     msg_str = '%s' % msg
 
-  topic = '%s/%s' % (mqtt_publish_topic, sub_topic)
-  mqtt_client.publish(topic, msg_str, qos=qos, retain=retain)
-  LOG.info('Published %s: %s', topic, msg_str)
+  return topic_policy, msg_str, qos, retain
+
 
+def mqtt_message_to_serial(message, mqtt_subscribe_topic, codec=None,
+                           rpc=None):
+  """Encodes an MQTT message as a serial frame, returns bytes or None.
+
+  With rpc, messages on the rpc sub-topic are requests started on rpc.
+  """
+  codec = codec or JSON_LINE_CODEC
+
+  if isinstance(message.topic, bytes):
+    serial_topic = message.topic.decode('utf-8')
+  elif isinstance(message.topic, str):
+    serial_topic = message.topic
+  else:
+    LOG.error('Unexpected topic type: %s. Ignoring.', type(message.topic))
+    return None
+
+  serial_topic = remove_prefix(serial_topic, mqtt_subscribe_topic)
+  serial_topic = remove_prefix(serial_topic, '/')
 
-def on_mqtt_message(serial_client, mqtt_subscribe_topic, mqtt_client, userdata, message):
-  # This is called from the mqtt network thread
-  # seems like it's safe to read and write to PySerial in different
-  # threads:
-  #   https://stackoverflow.com/questions/8796800/pyserial-possible-to-write-to-serial-port-from-thread-a-do-blocking-reads-fro
   try:
-    serial_json = {}
+    if isinstance(message.payload, bytes):
+      msg_str = message.payload.decode('utf-8')
+    elif isinstance(message.payload, str):
+      msg_str = message.payload
+    else:
+      LOG.error(
+        'MQTT subscription on mesage, unexpected payload on topic %s '
+        'type: %s. Ignoring.',
+        serial_topic, type(message.payload))
+      return None
 
-    if isinstance(message.topic, bytes):
-      serial_topic = message.topic.decode('utf-8')
-    elif isinstance(message.topic, str):
-      serial_topic = message.topic
+    # msg as a sub-json message
+    msg = json.loads(msg_str)
+  except UnicodeDecodeError as ue:
+    if codec.binary:
+      msg = message.payload
     else:
-      LOG.error('Unexpected topic type: %s. Ignoring.', type(message.topic))
-      return
+      LOG.error('Message on topic %s Ignoring bytes not convertible to utf-8',
+                message.topic)
+      msg = NO_MSG
+  except json.JSONDecodeError as je:
+    # msg as just a string
+    msg = msg_str
+
+  if rpc is not None and serial_topic.startswith(RPC_SUB_TOPIC + '/'):
+    return rpc.request(serial_topic[len(RPC_SUB_TOPIC) + 1:], msg, message.qos)
+  return codec.encode(serial_topic, msg)
+
+
+NO_MSG = object()  # Marks a serial message without a msg field.
+
+
+class JsonLineCodec(object):
+  """utf-8 JSON serial protocol, one message per line."""
+
+  delimiter = b'\n'
+  binary = False
+
+  def decode(self, line):
+    """Returns (sub_topic, msg, qos, retain, rpc_id), None fields if unset."""
+    line_json = None
+    # Only JSON objects are messages, skip parsing plain log lines. Lines that
+    # look like JSON but do not parse raise ValueError.
+    if line[:1] == b'{' or line.lstrip()[:1] == b'{':
+      line_json = json_loads(line)
+    if not isinstance(line_json, dict) or (
+        line_json.get('msg') is None and line_json.get('id') is None):
+      # Messages that cannot be parsed, just pass on to the 'log' topic.
+      return 'log', line.decode('utf-8'), None, None, None
+    msg = line_json.get('msg')
+    if msg is None:
+      msg = NO_MSG  # A reply without msg or a log line, see parse_serial_line.
+    return (line_json.get('topic', 'data'), msg, line_json.get('qos'),
+            line_json.get('retain'), line_json.get('id'))
+
+  def encode(self, sub_topic, msg, rpc_id=None):
+    serial_json = {'topic': sub_topic}
+    if msg is not NO_MSG:
+      serial_json['msg'] = msg
+    if rpc_id is not None:
+      serial_json['id'] = rpc_id
+    serial_data = '%s\n' % json.dumps(serial_json)
+    return serial_data.encode('utf-8')
+
+  def with_seq(self, frame, seq):
+    """Returns the encoded frame with the flow control field seq first."""
+    return b'{"seq": %d, %s' % (seq, frame[1:])
+
+
+JSON_LINE_CODEC = JsonLineCodec()
+
+
+def cobs_encode(data):
+  """Consistent Overhead Byte Stuffing, returns data without any 0x00 byte."""
+  out = bytearray()
+  for block in bytes(data).split(b'\x00'):
+    while len(block) >= 0xFE:
+      out.append(0xFF)
+      out += block[:0xFE]
+      block = block[0xFE:]
+    out.append(len(block) + 1)
+    out += block
+  return bytes(out)
+
+
+def cobs_decode(data):
+  out = bytearray()
+  pos = 0
+  size = len(data)
+  while pos < size:
+    code = data[pos]
+    end = pos + code
+    if code == 0 or end > size:
+      raise ValueError('Invalid COBS data')
+    out += data[pos + 1:end]
+    pos = end
+    if code < 0xFF and pos < size:
+      out.append(0)
+  return bytes(out)
+
+
+class CobsMsgpackCodec(object):
+  """Compact binary serial protocol, COBS framed MessagePack.
+
+  Each frame is the COBS encoded MessagePack array [topic, msg],
+  [topic, msg, qos, retain], [topic, msg, qos, retain, rpc_id] or, with flow
+  control, [topic, msg, qos, retain, rpc_id, seq], followed by a big endian
+  CRC-16/CCITT-FALSE of the MessagePack data, and terminated by a 0x00 byte.
+  topic is either a string or an integer id from the topic_ids option, to save
+  bandwidth.
+  """
+
+  delimiter = b'\x00'
+  binary = True
+
+  def __init__(self, topic_ids):
+    self.topic_names = {
+      topic_id['id']: topic_id['topic'] for topic_id in topic_ids}
+    self.topic_ids = {
+      topic_id['topic']: topic_id['id'] for topic_id in topic_ids}
+
+  def unpack(self, frame):
+    """Returns the MessagePack array of a frame, checks COBS and CRC."""
+    data = cobs_decode(frame.rstrip(self.delimiter))
+    if len(data) < 3:
+      raise ValueError('Too short frame')
+    payload = data[:-2]
+    if binascii.crc_hqx(payload, 0xFFFF) != int.from_bytes(data[-2:], 'big'):
+      raise ValueError('Incorrect CRC')
+    fields = msgpack.unpackb(payload, raw=False)
+    if not isinstance(fields, list) or not fields:
+      raise ValueError('Expected array [topic, ...]')
+    return fields
+
+  def pack(self, fields):
+    payload = msgpack.packb(fields, use_bin_type=True)
+    crc = binascii.crc_hqx(payload, 0xFFFF).to_bytes(2, 'big')
+    return cobs_encode(payload + crc) + self.delimiter
+
+  def decode(self, frame):
+    fields = self.unpack(frame)
+    if len(fields) < 2:
+      raise ValueError('Expected array [topic, msg, ...]')
+    topic = fields[0]
+    if isinstance(topic, int):
+      topic = self.topic_names.get(topic, str(topic))
+    qos = fields[2] if len(fields) > 2 else None
+    retain = fields[3] if len(fields) > 3 else None
+    rpc_id = fields[4] if len(fields) > 4 else None
+    return topic, fields[1], qos, retain, rpc_id
+
+  def encode(self, sub_topic, msg, rpc_id=None):
+    fields = [self.topic_ids.get(sub_topic, sub_topic)]
+    if rpc_id is not None:
+      fields += [None if msg is NO_MSG else msg, None, None, rpc_id]
+    elif msg is not NO_MSG:
+      fields.append(msg)
+    return self.pack(fields)
+
+  def with_seq(self, frame, seq):
+    """Returns the encoded frame with the flow control field seq added."""
+    fields = self.unpack(frame)
+    fields += [None] * (5 - len(fields))  # Missing msg is sent as nil.
+    return self.pack(fields + [seq])
+
+
+# serial_framing option -> factory creating the codec from options_json.
+CODECS = {
+  'json_lines': lambda options_json: JSON_LINE_CODEC,
+  'cobs_msgpack': lambda options_json: CobsMsgpackCodec(
+    options_json.get('topic_ids', [])),
+}
+
+
+def init_codec(options_json):
+  serial_framing = options_json.get('serial_framing', 'json_lines')
+  if serial_framing not in CODECS:
+    LOG.fatal(
+      'Incorrect option serial_framing, must be one of %s, got %s.',
+      tuple(CODECS), serial_framing)
+    sys.exit(1)
+  return CODECS[serial_framing](options_json)
+
+
+class ChunkTransfer(object):
+  """A payload being reassembled from chunks."""
+
+  def __init__(self, sub_topic, transfer_id):
+    self.sub_topic = sub_topic
+    self.transfer_id = transfer_id
+    self.total = None  # Number of chunks, once known.
+    self.parts = {}  # seq -> data
+    self.size = 0
+    self.last_at = time.monotonic()
+
+
+class ChunkAssembler(object):
+  """Payloads too large for one serial line, sent as numbered chunks.
+
+  The device sends each chunk as a message on the chunk sub-topic:
+    {"topic": "chunk", "msg": {"topic": "camera/thumb", "id": 7, "seq": 0,
+     "total": 12, "data": "..."}}
+  id identifies the transfer, seq numbers its chunks from 0. Instead of total,
+  the final chunk may have "last": true. With "encoding": "base64" the data is
+  decoded first, so binary payloads can be sent in JSON lines.
+
+  In reassemble mode the data of all chunks is joined and published once, on
+  the topic of the transfer. Up to max_transfers are reassembled at once, the
+  least recently active one is dropped for a new one. A transfer is dropped
+  when it grows over max_bytes, or has no new chunk for timeout_s.
+
+  In stream mode each chunk is published right away on the topic of the
+  transfer as {"id": 7, "seq": 0, "total": 12, "data": "..."}, binary data
+  base64 encoded. Nothing is held back.
+  """
+
+  def __init__(self, policy, mode, max_bytes, max_transfers, timeout_s):
+    self.policy = policy
+    self.mode = mode
+    self.max_bytes = max_bytes
+    self.max_transfers = max_transfers
+    self.timeout_s = timeout_s
+    # (sub_topic, id) -> ChunkTransfer, least recently active first.
+    self._transfers = collections.OrderedDict()
+    self.completed = 0
+    self.dropped = 0
 
-    serial_topic = remove_prefix(serial_topic, mqtt_subscribe_topic)
-    serial_topic = remove_prefix(serial_topic, '/')
-    serial_json['topic'] = serial_topic
+  @property
+  def next_expiry(self):
+    """Monotonic time the next transfer times out, None if none."""
+    for transfer in self._transfers.values():
+      return transfer.last_at + self.timeout_s
+    return None
 
+  def on_chunk(self, msg):
+    """Returns (topic_policy, payload, qos, retain) to publish, or None."""
     try:
-      if isinstance(message.payload, bytes):
-        msg_str = message.payload.decode('utf-8')
-      elif isinstance(message.payload, str):
-        msg_str = message.payload
-      else:
-        LOG.error(
-          'MQTT subscription on mesage, unexpected payload on topic %s '
-          'type: %s. Ignoring.',
-          serial_topic, type(message.payload))
+      if not isinstance(msg, dict):
+        raise ValueError('expected an object')
+      sub_topic = '%s' % msg['topic']
+      transfer_id = msg['id']
+      seq = msg['seq']
+      if not isinstance(seq, int) or seq < 0:
+        raise ValueError('seq must be an integer >= 0')
+      total = seq + 1 if msg.get('last') else msg.get('total')
+      if total is not None and (not isinstance(total, int) or total <= seq):
+        raise ValueError('total must be an integer > seq')
+      data = msg['data']
+      if msg.get('encoding') == 'base64':
+        data = binascii.a2b_base64(data)
+      elif not isinstance(data, (str, bytes)):
+        raise ValueError('data must be a string')
+      if self.mode == 'stream':
+        return self.stream(sub_topic, transfer_id, seq, total, data)
+      return self.reassemble(sub_topic, transfer_id, seq, total, data)
+    except (KeyError, TypeError, ValueError) as e:
+      LOG.warning('Dropping invalid chunk: %s, error: %s', msg, str(e))
+      return None
+
+  def stream(self, sub_topic, transfer_id, seq, total, data):
+    if isinstance(data, bytes):
+      data = binascii.b2a_base64(data, newline=False).decode('ascii')
+    payload = json.dumps(
+      {'id': transfer_id, 'seq': seq, 'total': total, 'data': data})
+    topic_policy = self.policy.lookup(sub_topic)
+    return topic_policy, payload, topic_policy.qos, topic_policy.retain
+
+  def reassemble(self, sub_topic, transfer_id, seq, total, data):
+    key = (sub_topic, transfer_id)
+    transfer = self._transfers.get(key)
+    if transfer is None:
+      if len(self._transfers) >= self.max_transfers:
+        _, oldest = self._transfers.popitem(last=False)
+        self.drop(oldest, 'too many transfers')
+      transfer = self._transfers[key] = ChunkTransfer(sub_topic, transfer_id)
+    else:
+      self._transfers.move_to_end(key)
+      transfer.last_at = time.monotonic()
+    if total is not None:
+      transfer.total = total
+
+    old = transfer.parts.get(seq)
+    transfer.size += len(data) - (len(old) if old is not None else 0)
+    transfer.parts[seq] = data
+    if transfer.size > self.max_bytes:
+      del self._transfers[key]
+      self.drop(transfer, 'larger than %d bytes' % self.max_bytes)
+      return None
+    if transfer.total is None or len(transfer.parts) < transfer.total:
+      return None
+
+    del self._transfers[key]
+    parts = [transfer.parts.get(i) for i in range(transfer.total)]
+    if None in parts:
+      self.drop(transfer, 'chunks beyond total')
+      return None
+    if all(isinstance(part, str) for part in parts):
+      payload = ''.join(parts)
+    else:
+      payload = b''.join(
+        part.encode('utf-8') if isinstance(part, str) else part
+        for part in parts)
+    self.completed += 1
+    topic_policy = self.policy.lookup(sub_topic)
+    return topic_policy, payload, topic_policy.qos, topic_policy.retain
+
+  def expire(self):
+    """Drops transfers without a new chunk for timeout_s."""
+    now = time.monotonic()
+    while self._transfers:
+      key, transfer = next(iter(self._transfers.items()))
+      if transfer.last_at + self.timeout_s > now:
         return
+      del self._transfers[key]
+      self.drop(transfer, 'timed out')
 
-      msg_json = json.loads(msg_str)
-      # msg as a sub-json message
-      serial_json['msg'] = msg_json
-    except UnicodeDecodeError as ue:
-      LOG.error('Message on topic %s Ignoring bytes not convertible to utf-8',
-                message.topic)
-    except json.JSONDecodeError as je:
-      # msg as just a string
-      serial_json['msg'] = msg_str
+  def drop(self, transfer, reason):
+    self.dropped += 1
+    LOG.warning('Dropping chunked transfer %s on %s, %s. Got %d of %s chunks.',
+                transfer.transfer_id, transfer.sub_topic, reason,
+                len(transfer.parts), transfer.total or 'unknown')
 
-    serial_data = '%s\n' % json.dumps(serial_json)
-    if serial_client.is_open:
-      serial_client.write(serial_data.encode('utf-8'))
-      LOG.info("Sent to serial: %s", serial_data)
+
+def init_chunks(policy, options_json):
+  """Returns the ChunkAssembler of a serial port, None if chunk_mode is off."""
+  chunk_mode = options_json.get('chunk_mode', 'off')
+  if chunk_mode not in CHUNK_MODES:
+    LOG.fatal('Incorrect option chunk_mode, must be one of %s, got %s.',
+              CHUNK_MODES, chunk_mode)
+    sys.exit(1)
+  if chunk_mode == 'off':
+    return None
+  return ChunkAssembler(
+    policy, chunk_mode,
+    options_json.get('chunk_max_bytes', DEFAULT_CHUNK_MAX_BYTES),
+    options_json.get('chunk_max_transfers', DEFAULT_CHUNK_MAX_TRANSFERS),
+    options_json.get('chunk_timeout_ms', DEFAULT_CHUNK_TIMEOUT_MS) / 1000.0)
+
+
+def init_handlers(serial_writer, chunks):
+  """Returns the handlers of reserved sub-topics of a port, None if none."""
+  handlers = {}
+  if serial_writer is not None and serial_writer.flow is not None:
+    handlers[FLOW_SUB_TOPIC] = serial_writer.on_ack
+  if chunks is not None:
+    handlers[CHUNK_SUB_TOPIC] = chunks.on_chunk
+  return handlers or None
+
+
+class CreditFlowControl(object):
+  """Credit based flow control and retransmission of frames to serial.
+
+  Each frame gets a sequence number, seq, when written. The device reports
+  the last seq it accepted and how many more frames it can take on the flow
+  sub-topic, {"topic": "flow", "msg": {"ack": 41, "credit": 2}}, and only
+  that many frames are in flight past the ack. Until the first report
+  initial_credit applies. Frames not acked within retransmit_s are written
+  again from the oldest one (go-back-N): the device only accepts the seq after
+  the last one it accepted and acks every frame, also those it drops.
+
+  The device starts with 65535 as last seq, and reports it when it boots. An
+  ack outside the frames in flight means the device or the bridge restarted,
+  frames in flight are renumbered to follow the ack.
+
+  Not thread safe, SerialWriter calls it with its lock held.
+  """
+
+  def __init__(self, codec, initial_credit, retransmit_s):
+    self.codec = codec
+    self.credit = initial_credit
+    self.retransmit_s = retransmit_s
+    self.next_seq = 0
+    self.unacked = collections.deque()  # (seq, frame without seq), oldest first.
+    self.retransmit_at = None  # Monotonic time, None if nothing in flight.
+    self.sent = 0
+    self.acked = 0
+    self.retransmits = 0
+
+  @property
+  def available(self):
+    """Number of new frames that may be written now."""
+    return self.credit - len(self.unacked)
+
+  @property
+  def retransmit_due(self):
+    return (self.retransmit_at is not None and
+            time.monotonic() >= self.retransmit_at)
+
+  def sequence(self, frame):
+    """Assigns the next seq to a new frame, returns it ready to write."""
+    seq = self.next_seq
+    self.next_seq = (seq + 1) & MAX_FLOW_SEQ
+    self.unacked.append((seq, frame))
+    self.sent += 1
+    if self.retransmit_at is None:
+      self.retransmit_at = time.monotonic() + self.retransmit_s
+    return self.codec.with_seq(frame, seq)
+
+  def take_retransmit(self):
+    """Returns the frames in flight ready to write again, if due."""
+    if not self.retransmit_due:
+      return []
+    self.retransmits += len(self.unacked)
+    self.retransmit_at = time.monotonic() + self.retransmit_s
+    LOG.info('Retransmitting %d unacked frames to serial', len(self.unacked))
+    return [self.codec.with_seq(frame, seq) for seq, frame in self.unacked]
+
+  def on_ack(self, msg):
+    if not isinstance(msg, dict):
+      LOG.warning('Ignoring flow control message: %s', msg)
+      return
+    credit = msg.get('credit')
+    if isinstance(credit, int):
+      self.credit = credit
+    ack = msg.get('ack')
+    if not isinstance(ack, int):
+      return
+
+    # Frames up to ack, in sequence space order from the oldest in flight.
+    first_seq = (self.next_seq - len(self.unacked)) & MAX_FLOW_SEQ
+    count = ((ack - first_seq) & MAX_FLOW_SEQ) + 1
+    if count > len(self.unacked):
+      if count != MAX_FLOW_SEQ + 1:  # Not an ack of the frame before first.
+        LOG.info('Flow control ack %d out of sequence, renumbering', ack)
+        self.next_seq = (ack + 1) & MAX_FLOW_SEQ
+        frames = [frame for _, frame in self.unacked]
+        self.unacked.clear()
+        for frame in frames:
+          self.unacked.append((self.next_seq, frame))
+          self.next_seq = (self.next_seq + 1) & MAX_FLOW_SEQ
+        if frames:
+          self.retransmit_at = time.monotonic()  # Write them again now.
+      return
+    for _ in range(count):
+      self.unacked.popleft()
+    self.acked += count
+    self.retransmit_at = (
+      time.monotonic() + self.retransmit_s if self.unacked else None)
+
+
+class SerialWriter(object):
+  """Writes MQTT messages to serial from a dedicated thread.
+
+  Messages are queued by the MQTT network thread, which so never waits on a
+  slow or stalled UART. Frames pending at the same time are joined into one
+  write call. When the queue is full, drop_policy decides what happens:
+    drop_oldest - the oldest queued frame is dropped.
+    drop_newest - the new frame is dropped.
+    block - wait for space, up to WRITER_BLOCK_TIMEOUT_S, then drop it.
+  With flow, a CreditFlowControl, frames are only written while the device
+  has credit, and retransmitted until acked.
+  """
+
+  def __init__(self, serial_client, queue_size=DEFAULT_QUEUE_SIZE,
+               drop_policy='drop_oldest', flow=None):
+    self.serial_client = serial_client
+    self.queue_size = queue_size
+    self.drop_policy = drop_policy
+    self.flow = flow
+    self.dropped = 0
+    self.written = 0
+    self._queue = collections.deque()
+    self._cond = threading.Condition()
+    self._thread = threading.Thread(
+      target=self._run, name='serial-writer', daemon=True)
+
+  @property
+  def depth(self):
+    return len(self._queue)
+
+  def start(self):
+    self._thread.start()
+
+  def notify(self):
+    """Wakes up the writer, e.g. when the serial port has been reopened."""
+    with self._cond:
+      self._cond.notify_all()
+
+  def on_ack(self, msg):
+    """Passes a flow control message from the device to flow."""
+    with self._cond:
+      self.flow.on_ack(msg)
+      self._cond.notify_all()
+    return None  # Nothing to publish.
+
+  def put(self, serial_data):
+    """Queues a frame for writing, returns False if a frame was dropped."""
+    with self._cond:
+      if len(self._queue) >= self.queue_size:
+        if self.drop_policy == 'block':
+          self._cond.wait_for(lambda: len(self._queue) < self.queue_size,
+                              WRITER_BLOCK_TIMEOUT_S)
+        if len(self._queue) >= self.queue_size:
+          self.dropped += 1
+          LOG.warning('Serial write queue full, dropping message (%d dropped)',
+                      self.dropped)
+          if self.drop_policy != 'drop_oldest':
+            return False
+          self._queue.popleft()
+          self._queue.append(serial_data)
+          return False
+      self._queue.append(serial_data)
+      self._cond.notify_all()
+      return True
+
+  def _can_write(self):
+    if not self.serial_client.is_open:
+      return False
+    if self.flow is None:
+      return bool(self._queue)
+    return (self.flow.retransmit_due or
+            bool(self._queue) and self.flow.available > 0)
+
+  def _wait_s(self):
+    if self.flow is None or self.flow.retransmit_at is None:
+      return WRITER_IDLE_CHECK_S
+    return min(WRITER_IDLE_CHECK_S,
+               max(0.0, self.flow.retransmit_at - time.monotonic()))
+
+  def _take_batch(self):
+    with self._cond:
+      while not self._can_write():
+        self._cond.wait(self._wait_s())
+      batch = self.flow.take_retransmit() if self.flow else []
+      size = sum(len(frame) for frame in batch)
+      while (self._queue and
+             (not batch or size + len(self._queue[0]) <= WRITE_BATCH_BYTES) and
+             (self.flow is None or self.flow.available > 0)):
+        frame = self._queue.popleft()
+        if self.flow is not None:
+          frame = self.flow.sequence(frame)
+        batch.append(frame)
+        size += len(frame)
+      self._cond.notify_all()
+      return batch
+
+  def _run(self):
+    while True:
+      batch = self._take_batch()
+      try:
+        self.serial_client.write(b''.join(batch))
+      except serial.SerialException as se:
+        LOG.warning('Serial disconnected while writing %d messages: %s',
+                    len(batch), str(se))
+        if self.flow is not None:
+          continue  # Still unacked, retransmitted after reconnect.
+        with self._cond:
+          # Retry after reconnect, keeps the queue bound.
+          while batch and len(self._queue) < self.queue_size:
+            self._queue.appendleft(batch.pop())
+          self.dropped += len(batch)
+        continue
+      self.written += len(batch)
+      if LOG.isEnabledFor(logging.INFO):
+        for serial_data in batch:
+          LOG.info('Sent to serial: %s', serial_data)
+
+
+def init_flow_control(codec, options_json):
+  """Returns the CreditFlowControl of a serial port, None if not enabled."""
+  flow_control = options_json.get('flow_control', 'none')
+  if flow_control not in FLOW_CONTROL_MODES:
+    LOG.fatal(
+      'Incorrect option flow_control, must be one of %s, got %s.',
+      FLOW_CONTROL_MODES, flow_control)
+    sys.exit(1)
+  if flow_control == 'none':
+    return None
+  return CreditFlowControl(
+    codec, options_json.get('flow_initial_credit', DEFAULT_FLOW_CREDIT),
+    options_json.get('flow_retransmit_ms', DEFAULT_FLOW_RETRANSMIT_MS) / 1000.0)
+
+
+def init_serial_writer(serial_client, options_json, codec=None):
+  drop_policy = options_json.get('writer_drop_policy', 'drop_oldest')
+  if drop_policy not in DROP_POLICIES:
+    LOG.fatal(
+      'Incorrect option writer_drop_policy, must be one of %s, got %s.',
+      DROP_POLICIES, drop_policy)
+    sys.exit(1)
+  return SerialWriter(
+    serial_client, options_json.get('queue_size', DEFAULT_QUEUE_SIZE),
+    drop_policy, init_flow_control(codec or JSON_LINE_CODEC, options_json))
+
+
+RpcRequest = collections.namedtuple(
+  'RpcRequest', ['request_id', 'response_topic', 'qos', 'deadline'])
+
+
+class RpcDispatcher(object):
+  """Pipelined request/response over serial, matched by correlation id.
+
+  A request is a JSON object published on $mqtt_subscribe_topic/rpc/<sub_topic>
+  with the fields:
+    id - correlation id, returned with the response.
+    msg - optional payload, forwarded to serial.
+    response_topic - optional, default $mqtt_publish_topic/rpc/<sub_topic>.
+    timeout_ms - optional, overrides the rpc_timeout_ms option.
+  It is written to serial with a bridge assigned integer id, unique among the
+  requests in flight, so ids of different MQTT clients cannot collide. The
+  device replies with a message carrying that id. Up to max_in_flight requests
+  wait for their reply at once. The reply is published on the response topic
+  as {"id": id, "msg": msg}, a timeout or too many requests in flight as
+  {"id": id, "error": "timeout" | "busy"}. Errors are published with
+  publish(topic_policy, payload, qos, retain).
+
+  Requests are started on the MQTT network thread and replies matched on the
+  serial thread, hence the lock.
+  """
+
+  def __init__(self, publish, mqtt_publish_topic, codec, max_in_flight,
+               timeout_s):
+    self.publish = publish
+    self.response_prefix = '%s/%s/' % (mqtt_publish_topic, RPC_SUB_TOPIC)
+    self.codec = codec
+    self.max_in_flight = max_in_flight
+    self.timeout_s = timeout_s
+    self._lock = threading.Lock()
+    self._in_flight = {}  # serial id -> RpcRequest
+    self._deadlines = []  # Heap of (deadline, serial id), may hold completed.
+    self._next_id = 0
+
+  @property
+  def next_deadline(self):
+    """Monotonic time of the earliest possible timeout, None if none."""
+    deadlines = self._deadlines
+    return deadlines[0][0] if deadlines else None
+
+  def request(self, sub_topic, request_json, qos):
+    """Starts a request, returns the serial frame or None if not sent."""
+    if not isinstance(request_json, dict) or request_json.get('id') is None:
+      LOG.warning('Ignoring RPC request on %s without id: %s', sub_topic,
+                  request_json)
+      return None
+    response_topic = (request_json.get('response_topic') or
+                      self.response_prefix + sub_topic)
+    timeout_ms = request_json.get('timeout_ms')
+    if isinstance(timeout_ms, (int, float)):
+      timeout_s = timeout_ms / 1000.0
     else:
-      LOG.warning(
-        'Could not send to closed serial. Dropping message on topic: %s',
-        message.topic)
+      timeout_s = self.timeout_s
+    request = RpcRequest(request_json['id'], response_topic, qos,
+                         time.monotonic() + timeout_s)
 
-  except serial.SerialException:
-    # https://stackoverflow.com/questions/46998496/paho-mqtt-python-client-acknowledgement-missing-guaranteed-delivery-for-subsc
-    LOG.warning('Serial disconnected while handling a message: %s', message)
-    raise  # Try to raise exception for redelivery??
-  except Exception as e:
-    # Log and ignore any other message (broken message?)
-    LOG.error('Exception handling MQTT subscribe message: %s', str(e),
-              exc_info=True)
+    with self._lock:
+      serial_id = None
+      if len(self._in_flight) < self.max_in_flight:
+        serial_id = self._next_id
+        while serial_id in self._in_flight:
+          serial_id = (serial_id + 1) & MAX_RPC_ID
+        self._next_id = (serial_id + 1) & MAX_RPC_ID
+        self._in_flight[serial_id] = request
+        heapq.heappush(self._deadlines, (request.deadline, serial_id))
+    if serial_id is None:
+      self.publish_error(request, 'busy')
+      return None
+    return self.codec.encode(
+      sub_topic, request_json.get('msg', NO_MSG), serial_id)
 
+  def reply(self, serial_id, msg):
+    """Completes a request in flight.
 
-def init_mqtt_subscriber(mqtt_client, serial_client, mqtt_subscribe_topic):
-  mqtt_client.on_message = functools.partial(on_mqtt_message, serial_client,
-                                             mqtt_subscribe_topic)
-  mqtt_client.subscribe('%s/#' % mqtt_subscribe_topic, MQTT_SUBSCRIBE_QOS)
+    Returns (topic_policy, payload, qos, retain) of the response, None if no
+    such request is in flight.
+    """
+    if not isinstance(serial_id, int):
+      return None
+    with self._lock:
+      request = self._in_flight.pop(serial_id, None)
+    if request is None:
+      return None
+    if isinstance(msg, bytes):
+      msg = msg.hex()
+    payload = json.dumps({'id': request.request_id, 'msg': msg})
+    topic_policy = TopicPolicy(
+      request.response_topic, request.qos, False, None, logging.INFO)
+    return topic_policy, payload, request.qos, False
 
+  def expire(self):
+    """Publishes a timeout error for each request past its deadline."""
+    now = time.monotonic()
+    expired = []
+    with self._lock:
+      while self._deadlines and self._deadlines[0][0] <= now:
+        deadline, serial_id = heapq.heappop(self._deadlines)
+        request = self._in_flight.get(serial_id)
+        if request is not None and request.deadline == deadline:
+          del self._in_flight[serial_id]
+          expired.append(request)
+    for request in expired:
+      self.publish_error(request, 'timeout')
 
-def main():
-  init_logger_stdout()
+  def publish_error(self, request, error):
+    LOG.warning('RPC request %s failed: %s', request.request_id, error)
+    topic_policy = TopicPolicy(
+      request.response_topic, request.qos, False, None, logging.DEBUG)
+    self.publish(
+      topic_policy, json.dumps({'id': request.request_id, 'error': error}),
+      request.qos, False)
 
-  LOG.info('Serial2Mqtt starting...')
 
-  LOG.info('Reading options.json')
-  with open('/data/options.json') as options_file:
-    options_json = json.load(options_file)
+def init_rpc(publish, mqtt_publish_topic, codec, options_json):
+  """Returns the RpcDispatcher of a serial port, None if rpc is off."""
+  if not options_json.get('rpc', False):
+    return None
+  max_in_flight = options_json.get(
+    'rpc_max_in_flight', DEFAULT_RPC_MAX_IN_FLIGHT)
+  if not 0 < max_in_flight <= MAX_RPC_ID:
+    LOG.fatal('Incorrect option rpc_max_in_flight, must be 1 to %d, got %s.',
+              MAX_RPC_ID, max_in_flight)
+    sys.exit(1)
+  timeout_s = (
+    options_json.get('rpc_timeout_ms', DEFAULT_RPC_TIMEOUT_MS) / 1000.0)
+  return RpcDispatcher(
+    publish, mqtt_publish_topic, codec, max_in_flight, timeout_s)
 
-  LOG.info('Init Serial port')
-  serial_client = init_serial_client(options_json)
 
-  LOG.info('Init MQTT client')
-  mqtt_client = init_mqtt_client(options_json)
+class LatencyHistogram(object):
+  """Fixed bucket histogram of latencies in milliseconds."""
+
+  def __init__(self, buckets_ms=LATENCY_BUCKETS_MS):
+    self.buckets_ms = buckets_ms
+    self.counts = [0] * (len(buckets_ms) + 1)  # Last bucket is +Inf.
+    self.count = 0
+    self.sum_ms = 0.0
+    self.max_ms = 0.0
+
+  def observe(self, value_ms):
+    self.counts[bisect.bisect_left(self.buckets_ms, value_ms)] += 1
+    self.count += 1
+    self.sum_ms += value_ms
+    self.max_ms = max(self.max_ms, value_ms)
+
+  def percentile(self, fraction):
+    """Upper bound of the bucket holding the fraction, None if empty."""
+    if not self.count:
+      return None
+    rank = fraction * self.count
+    seen = 0
+    for bucket, count in enumerate(self.counts):
+      seen += count
+      if seen >= rank:
+        break
+    if bucket < len(self.buckets_ms):
+      return round(min(self.buckets_ms[bucket], self.max_ms), 2)
+    return round(self.max_ms, 2)
+
+
+class PortMetrics(object):
+  """Counters of one bridged serial port.
+
+  Written by the serial and MQTT threads without locking, they are only
+  statistics.
+  """
+
+  def __init__(self, serial_port, write_queue_depth, write_dropped,
+               flow_control=None):
+    self.serial_port = serial_port
+    self.write_queue_depth = write_queue_depth  # Callables, owned by writer.
+    self.write_dropped = write_dropped
+    self.flow_control = flow_control  # CreditFlowControl or None.
+    self.serial_bytes = 0
+    self.serial_lines = 0
+    self.parse_failures = 0
+    self.published = 0
+    self.publish_latency = LatencyHistogram()
+    self.reconnects = 0
+    self.read_at = None  # Monotonic time the last serial lines arrived.
+    self._disconnected_s = 0.0
+    self._disconnected_at = None
+
+  def on_serial_lines(self, lines, read_at):
+    self.serial_lines += len(lines)
+    self.serial_bytes += sum(len(line) for line in lines)
+    self.read_at = read_at
+
+  def on_published(self, latency_s):
+    self.publish_latency.observe(latency_s * 1000.0)
+
+  def on_disconnect(self):
+    self._disconnected_at = time.monotonic()
+
+  def on_reconnect(self):
+    self.reconnects += 1
+    if self._disconnected_at is not None:
+      self._disconnected_s += time.monotonic() - self._disconnected_at
+      self._disconnected_at = None
+
+  @property
+  def disconnected_s(self):
+    if self._disconnected_at is None:
+      return self._disconnected_s
+    return self._disconnected_s + time.monotonic() - self._disconnected_at
+
+
+class PublishTracker(object):
+  """Matches paho publish completions to the serial arrival of the line.
+
+  on_publish is called from the paho network thread, and may be called before
+  publish() has returned the mid to the serial thread, so both orders are
+  handled.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._pending = {}  # mid -> (port_metrics, read_at)
+    self._completed = {}  # mid -> monotonic time of on_publish
+
+  def on_sent(self, info, qos, port_metrics):
+    if port_metrics.read_at is None:
+      return
+    if info.rc != mqtt.MQTT_ERR_SUCCESS and qos == 0:
+      return  # Dropped by paho, on_publish will not be called.
+    with self._lock:
+      completed_at = self._completed.pop(info.mid, None)
+      if completed_at is None:
+        if len(self._pending) >= MAX_TRACKED_PUBLISHES:
+          self._pending.clear()
+        self._pending[info.mid] = (port_metrics, port_metrics.read_at)
+        return
+    port_metrics.on_published(completed_at - port_metrics.read_at)
+
+  def on_publish(self, client, userdata, mid):
+    now = time.monotonic()
+    with self._lock:
+      pending = self._pending.pop(mid, None)
+      if pending is None:
+        if len(self._completed) >= MAX_TRACKED_PUBLISHES:
+          self._completed.clear()
+        self._completed[mid] = now
+        return
+    port_metrics, read_at = pending
+    port_metrics.on_published(now - read_at)
+
+
+# name, type, help, function returning the value of a PortMetrics.
+PROMETHEUS_METRICS = (
+  ('serial_bytes_total', 'counter', 'Bytes of complete lines read from serial.',
+   lambda metrics: metrics.serial_bytes),
+  ('serial_lines_total', 'counter', 'Lines read from serial.',
+   lambda metrics: metrics.serial_lines),
+  ('parse_failures_total', 'counter', 'Serial lines that could not be parsed.',
+   lambda metrics: metrics.parse_failures),
+  ('published_total', 'counter', 'Messages published to MQTT.',
+   lambda metrics: metrics.published),
+  ('write_queue_depth', 'gauge', 'MQTT messages waiting to be written to serial.',
+   lambda metrics: metrics.write_queue_depth()),
+  ('write_dropped_total', 'counter', 'MQTT messages dropped, serial too slow.',
+   lambda metrics: metrics.write_dropped()),
+  ('reconnects_total', 'counter', 'Serial reconnections.',
+   lambda metrics: metrics.reconnects),
+  ('disconnected_seconds_total', 'counter', 'Time serial was disconnected.',
+   lambda metrics: metrics.disconnected_s),
+  ('write_acked_total', 'counter', 'Frames acked by the device, flow control.',
+   lambda metrics: metrics.flow_control.acked if metrics.flow_control else 0),
+  ('write_retransmits_total', 'counter',
+   'Frames written again, not acked in time, flow control.',
+   lambda metrics: (
+     metrics.flow_control.retransmits if metrics.flow_control else 0)),
+)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    if self.path != '/metrics':
+      self.send_error(404)
+      return
+    body = self.server.reporter.prometheus_text().encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    LOG.debug(format, *args)
+
+
+class MetricsReporter(object):
+  """Reports PortMetrics periodically to MQTT and on a HTTP endpoint.
+
+  Every stats_period_s, the stats of each port are published as JSON to
+  <mqtt_publish_topic>/bridge_stats. With metrics_port set, all ports are
+  served in the Prometheus text format on http://<host>:<metrics_port>/metrics.
+
+  publish(topic, payload) is called from the reporter thread.
+  """
+
+  def __init__(self, publish, ports_metrics, stats_period_s, metrics_port):
+    self.publish = publish
+    self.ports_metrics = ports_metrics  # [(stats_topic, PortMetrics)]
+    self.stats_period_s = stats_period_s
+    self.metrics_port = metrics_port
+
+  def start(self):
+    if self.stats_period_s > 0:
+      threading.Thread(
+        target=self._run, name='stats-reporter', daemon=True).start()
+    if self.metrics_port:
+      server = http.server.ThreadingHTTPServer(
+        ('', self.metrics_port), MetricsHandler)
+      server.reporter = self
+      threading.Thread(
+        target=server.serve_forever, name='metrics-http', daemon=True).start()
+      LOG.info('Serving metrics on port %d', self.metrics_port)
+
+  def _run(self):
+    last = {
+      topic: (time.monotonic(), metrics.serial_bytes, metrics.serial_lines,
+              self.write_acked(metrics))
+      for topic, metrics in self.ports_metrics}
+    while True:
+      time.sleep(self.stats_period_s)
+      for topic, metrics in self.ports_metrics:
+        now = time.monotonic()
+        last_at, last_bytes, last_lines, last_acked = last[topic]
+        write_acked = self.write_acked(metrics)
+        last[topic] = (now, metrics.serial_bytes, metrics.serial_lines,
+                       write_acked)
+        elapsed_s = max(now - last_at, 1e-6)
+        stats = self.stats(metrics)
+        stats['serial_bytes_per_s'] = round(
+          (metrics.serial_bytes - last_bytes) / elapsed_s, 1)
+        stats['serial_lines_per_s'] = round(
+          (metrics.serial_lines - last_lines) / elapsed_s, 1)
+        if metrics.flow_control is not None:
+          stats['write_acked_per_s'] = round(
+            (write_acked - last_acked) / elapsed_s, 1)
+        self.publish(topic, json.dumps(stats))
+
+  @staticmethod
+  def write_acked(metrics):
+    return metrics.flow_control.acked if metrics.flow_control else 0
+
+  def stats(self, metrics):
+    latency = metrics.publish_latency
+    stats = {
+      'serial_bytes': metrics.serial_bytes,
+      'serial_lines': metrics.serial_lines,
+      'parse_failures': metrics.parse_failures,
+      'published': metrics.published,
+      'publish_latency_ms': {
+        'count': latency.count,
+        'mean': round(latency.sum_ms / latency.count, 2)
+                if latency.count else None,
+        'p50': latency.percentile(0.5),
+        'p99': latency.percentile(0.99),
+        'max': round(latency.max_ms, 2),
+      },
+      'write_queue_depth': metrics.write_queue_depth(),
+      'write_dropped': metrics.write_dropped(),
+      'reconnects': metrics.reconnects,
+      'disconnected_s': round(metrics.disconnected_s, 1),
+    }
+    if metrics.flow_control is not None:
+      stats['write_acked'] = metrics.flow_control.acked
+      stats['write_retransmits'] = metrics.flow_control.retransmits
+      stats['write_in_flight'] = len(metrics.flow_control.unacked)
+      stats['write_credit'] = metrics.flow_control.credit
+    return stats
+
+  def prometheus_text(self):
+    lines = []
+    for name, metric_type, help_text, value in PROMETHEUS_METRICS:
+      lines.append('# HELP serial2mqtt_%s %s' % (name, help_text))
+      lines.append('# TYPE serial2mqtt_%s %s' % (name, metric_type))
+      for topic, metrics in self.ports_metrics:
+        lines.append('serial2mqtt_%s{port="%s"} %s' % (
+          name, metrics.serial_port, value(metrics)))
+
+    name = 'serial2mqtt_publish_latency_seconds'
+    lines.append('# HELP %s Serial arrival to MQTT publish completion.' % name)
+    lines.append('# TYPE %s histogram' % name)
+    for topic, metrics in self.ports_metrics:
+      latency = metrics.publish_latency
+      cumulative = 0
+      for bucket, count in enumerate(latency.counts):
+        cumulative += count
+        if bucket < len(latency.buckets_ms):
+          le = '%g' % (latency.buckets_ms[bucket] / 1000.0)
+        else:
+          le = '+Inf'
+        lines.append('%s_bucket{port="%s",le="%s"} %d' % (
+          name, metrics.serial_port, le, cumulative))
+      lines.append('%s_sum{port="%s"} %f' % (
+        name, metrics.serial_port, latency.sum_ms / 1000.0))
+      lines.append('%s_count{port="%s"} %d' % (
+        name, metrics.serial_port, latency.count))
+    return '\n'.join(lines) + '\n'
+
+
+def init_metrics_reporter(publish, ports_metrics, options_json):
+  return MetricsReporter(
+    publish, ports_metrics, options_json.get('stats_period_sec', 0),
+    options_json.get('metrics_port', 0))
+
+
+class SerialPortBridge(object):
+  """Bridges one serial port to its own MQTT publish and subscribe topics.
+
+  options_json holds the options of this port, see init_ports_options.
+  """
+
+  def __init__(self, mqtt_client, options_json, publish_tracker):
+    self.mqtt_client = mqtt_client
+    self.options_json = options_json
+    self.publish_tracker = publish_tracker
+    self.serial_port = options_json.get('serial_port', '/dev/ttyUSB0')
+    self.mqtt_publish_topic, self.mqtt_subscribe_topic = init_topics(
+      options_json)
+    self.stats_topic = '%s/%s' % (self.mqtt_publish_topic, STATS_SUB_TOPIC)
+    self.serial_client = init_serial_client(options_json)
+    self.policy = init_policy(self.mqtt_publish_topic, options_json)
+    self.codec = self.policy.codec
+    self.line_reader = SerialLineReader(
+      self.serial_client, delimiter=self.codec.delimiter,
+      recorder=init_recorder(self.serial_port, options_json))
+    self.publisher = init_publisher(self.publish, options_json)
+    self.serial_writer = init_serial_writer(
+      self.serial_client, options_json, self.codec)
+    self.rpc = init_rpc(
+      self.publish_rpc_error, self.mqtt_publish_topic, self.codec,
+      options_json)
+    self.chunks = init_chunks(self.policy, options_json)
+    self.handlers = init_handlers(self.serial_writer, self.chunks)
+    self.metrics = PortMetrics(
+      self.serial_port, lambda: self.serial_writer.depth,
+      lambda: self.serial_writer.dropped, self.serial_writer.flow)
+    self.next_reconnect_s = None  # Monotonic time, None while connected.
+    self.reconnect_backoff_s = RECONNECT_MIN_S
+    self.device_watcher = None  # Watches for the device while disconnected.
+
+  def fileno(self):
+    return self.serial_client.fileno()
+
+  def read(self):
+    process_serial_readline(self.line_reader, self.publisher, self.policy,
+                            self.metrics, self.rpc, self.handlers)
+
+  def publish(self, topic_policy, payload, qos, retain):
+    info = publish_mqtt(self.mqtt_client, topic_policy, payload, qos, retain)
+    self.metrics.published += 1
+    self.publish_tracker.on_sent(info, qos, self.metrics)
+
+  def publish_rpc_error(self, topic_policy, payload, qos, retain):
+    # Also called from the MQTT network thread, paho publish is thread-safe.
+    publish_mqtt(self.mqtt_client, topic_policy, payload, qos, retain)
+
+  def handles_topic(self, topic):
+    return (topic == self.mqtt_subscribe_topic or
+            topic.startswith(self.mqtt_subscribe_topic + '/'))
+
+  def on_mqtt_message(self, message):
+    # This is called from the mqtt network thread, the serial port itself is
+    # only written by the serial writer thread.
+    serial_data = mqtt_message_to_serial(
+      message, self.mqtt_subscribe_topic, self.codec, self.rpc)
+    if serial_data is not None:
+      self.serial_writer.put(serial_data)
+
+  def close(self, error):
+    LOG.warning('Serial %s disconnected: %s', self.serial_port, str(error))
+    self.serial_client.close()
+    self.line_reader.reset()
+    self.metrics.on_disconnect()
+    LOG.info('Disconnected, will attempt reconnect.')
+    self.next_reconnect_s = time.monotonic()
+    self.reconnect_backoff_s = RECONNECT_MIN_S
+    self.device_watcher = DeviceWatcher(self.serial_port)
+
+  def on_device_event(self):
+    """Called when the device watcher is readable."""
+    if self.device_watcher.read_events():
+      LOG.info('Serial device %s appeared.', self.serial_port)
+      # udev may still be setting up permissions, retry quickly from here.
+      self.next_reconnect_s = time.monotonic()
+      self.reconnect_backoff_s = RECONNECT_MIN_S
+
+  def try_reconnect(self):
+    try:
+      self.serial_client.open()
+    except serial.SerialException as se:
+      LOG.info('Reconnection attempt to %s failed, waiting up to %.1f s: %s',
+               self.serial_port, self.reconnect_backoff_s, str(se))
+      self.next_reconnect_s = time.monotonic() + self.reconnect_backoff_s
+      self.reconnect_backoff_s = min(
+        self.reconnect_backoff_s * 2, RECONNECT_TIMEOUT_S)
+      return False
+    LOG.info('Reconnection to serial %s successful!', self.serial_port)
+    self.next_reconnect_s = None
+    self.metrics.on_reconnect()
+    self.serial_writer.notify()
+    return True
+
+
+class SerialMultiplexer(object):
+  """Bridges any number of serial ports from one selector loop.
+
+  Each port reconnects on its own schedule, a lost port does not stop the
+  others. All ports share one MQTT client.
+  """
+
+  def __init__(self, mqtt_client, ports, publish_tracker):
+    self.mqtt_client = mqtt_client
+    self.ports = ports
+    self.publish_tracker = publish_tracker
+    self.selector = selectors.DefaultSelector()
+
+  def on_mqtt_message(self, mqtt_client, userdata, message):
+    try:
+      topic = message.topic
+      if isinstance(topic, bytes):
+        topic = topic.decode('utf-8')
+      for port in self.ports:
+        if port.handles_topic(topic):
+          port.on_mqtt_message(message)
+          return
+      LOG.warning('No serial port for topic %s. Ignoring.', topic)
+    except Exception as e:
+      # Log and ignore any other message (broken message?)
+      LOG.error('Exception handling MQTT subscribe message: %s', str(e),
+                exc_info=True)
+
+  def subscribe(self):
+    self.mqtt_client.on_message = self.on_mqtt_message
+    self.mqtt_client.on_publish = self.publish_tracker.on_publish
+    for port in self.ports:
+      self.mqtt_client.subscribe('%s/#' % port.mqtt_subscribe_topic,
+                                 MQTT_SUBSCRIBE_QOS)
+
+  def select_timeout(self):
+    """Seconds until the next flush, reconnect, RPC or chunk timeout is due.
+
+    None if none is. RPC requests are started on the MQTT network thread, so
+    with RPC on it is at most RPC_EXPIRE_PERIOD_S to notice new deadlines.
+    """
+    now = time.monotonic()
+    deadlines = []
+    for port in self.ports:
+      if port.next_reconnect_s is not None:
+        deadlines.append(port.next_reconnect_s)
+      if port.publisher.flush_at is not None:
+        deadlines.append(port.publisher.flush_at)
+      if port.rpc is not None:
+        deadlines.append(now + RPC_EXPIRE_PERIOD_S)
+        if port.rpc.next_deadline is not None:
+          deadlines.append(port.rpc.next_deadline)
+      if port.chunks is not None and port.chunks.next_expiry is not None:
+        deadlines.append(port.chunks.next_expiry)
+    if not deadlines:
+      return None
+    return max(0.0, min(deadlines) - now)
+
+  def listen(self, port):
+    LOG.info(
+      'Start to listen to serial port %s and mqtt topic %s. '
+      'serial_client.is_open: %s',
+      port.serial_port, port.mqtt_subscribe_topic, port.serial_client.is_open)
+    self.selector.register(port, selectors.EVENT_READ, self.read_port)
+
+  def read_port(self, port):
+    try:
+      port.read()
+    except (serial.SerialException, OSError) as e:
+      self.selector.unregister(port)
+      port.close(e)
+      if port.device_watcher.available:
+        self.selector.register(port.device_watcher, selectors.EVENT_READ,
+                               lambda watcher: port.on_device_event())
+
+  def reconnect_port(self, port):
+    if port.try_reconnect():
+      if port.device_watcher.available:
+        self.selector.unregister(port.device_watcher)
+      port.device_watcher.close()
+      port.device_watcher = None
+      self.listen(port)
+
+  def run(self):
+    for port in self.ports:
+      port.serial_writer.start()
+      self.listen(port)
+
+    while True:
+      for key, events in self.selector.select(self.select_timeout()):
+        key.data(key.fileobj)
+
+      now = time.monotonic()
+      for port in self.ports:
+        port.publisher.flush_if_due()
+        if port.rpc is not None:
+          port.rpc.expire()
+        if port.chunks is not None:
+          port.chunks.expire()
+        if (port.next_reconnect_s is not None and
+            now >= port.next_reconnect_s):
+          self.reconnect_port(port)
+
+
+def init_topics(options_json):
+  """Returns (mqtt_publish_topic, mqtt_subscribe_topic) without trailing /."""
   mqtt_publish_topic = options_json.get('mqtt_publish_topic', 'arduino/read')
   mqtt_publish_topic = remove_suffix(mqtt_publish_topic, '/')
   mqtt_subscribe_topic = options_json.get('mqtt_subscribe_topic',
                                           'arduino/write')
   mqtt_subscribe_topic = remove_suffix(mqtt_subscribe_topic, '#')
   mqtt_subscribe_topic = remove_suffix(mqtt_subscribe_topic, '/')
+  return mqtt_publish_topic, mqtt_subscribe_topic
 
-  LOG.info('Subscribe to topic')
-  init_mqtt_subscriber(mqtt_client, serial_client, mqtt_subscribe_topic)
-  mqtt_client.loop_start()
 
-  while True:
-    LOG.info(
-      'Start to listen to serial port and mqtt topic. '
-      'serial_client.is_open: %s',
-      serial_client.is_open)
+def init_ports_options(options_json):
+  """Returns the options of each serial port to bridge.
+
+  Each serial_ports entry overrides the top level options for that port. With
+  no serial_ports, the top level options describe a single port.
+  """
+  ports_options = []
+  for port_json in options_json.get('serial_ports') or [{}]:
+    port_options = dict(options_json)
+    port_options.pop('serial_ports', None)
+    port_options.update(port_json)
+    ports_options.append(port_options)
+
+  subscribe_topics = [init_topics(port)[1] for port in ports_options]
+  if len(set(subscribe_topics)) < len(subscribe_topics):
+    LOG.fatal(
+      'Incorrect option serial_ports, each port needs its own '
+      'mqtt_subscribe_topic, got: %s', subscribe_topics)
+    sys.exit(1)
+  return ports_options
+
+
+class AsyncioBridge(object):
+  """Runs serial reads, serial writes and MQTT I/O on one asyncio event loop.
+
+  Serial lines waiting to be published and MQTT messages waiting to be written
+  to serial are kept in bounded queues. When the broker does not keep up with
+  publishes, the serial port is no longer read, and when the serial port does
+  not keep up with writes, the MQTT socket is no longer read. The OS and device
+  buffers then apply backpressure instead of memory growing without limit.
+  """
+
+  def __init__(self, serial_client, mqtt_client, mqtt_publish_topic,
+               mqtt_subscribe_topic, options_json):
+    self.serial_client = serial_client
+    self.mqtt_client = mqtt_client
+    self.mqtt_publish_topic = mqtt_publish_topic
+    self.mqtt_subscribe_topic = mqtt_subscribe_topic
+    self.options_json = options_json
+    self.queue_size = options_json.get('queue_size', DEFAULT_QUEUE_SIZE)
+    self.policy = init_policy(mqtt_publish_topic, options_json)
+    self.codec = self.policy.codec
+    self.line_reader = SerialLineReader(
+      serial_client, delimiter=self.codec.delimiter,
+      recorder=init_recorder(
+        options_json.get('serial_port', '/dev/ttyUSB0'), options_json))
+    self.outgoing = collections.deque()  # Publishes released by publisher.
+    self.publisher = init_publisher(self.queue_publish, options_json)
+    self.rpc = init_rpc(self.publish_rpc_error, mqtt_publish_topic,
+                        self.codec, options_json)
+    self.chunks = init_chunks(self.policy, options_json)
+    self.handlers = init_handlers(None, self.chunks)
+    self.stats_topic = '%s/%s' % (mqtt_publish_topic, STATS_SUB_TOPIC)
+    self.metrics = PortMetrics(
+      options_json.get('serial_port', '/dev/ttyUSB0'),
+      lambda: self.write_queue.qsize() if self.write_queue else 0,
+      lambda: self.write_dropped)
+    self.publish_tracker = PublishTracker()
+
+    self.loop = None
+    self.publish_queue = None
+    self.write_queue = None
+    self.write_dropped = 0
+    self.publish_slots = None  # Publishes not yet completed by paho.
+    self.slot_mids = set()  # Mids of the publishes holding a slot.
+    self.completed_mids = None  # Completed within mqtt_client.publish().
+    self.serial_lost = None
+    self.serial_reading = False
+    self.mqtt_socket = None
+    self.mqtt_reading = True
+
+  async def run(self):
+    self.loop = asyncio.get_running_loop()
+    self.publish_queue = asyncio.Queue()
+    self.write_queue = asyncio.Queue()
+    self.publish_slots = asyncio.Semaphore(self.queue_size)
+
+    # Non-blocking serial I/O, readiness is signalled by the event loop.
+    self.serial_client.timeout = 0
+    self.serial_client.write_timeout = 0
+
+    self.mqtt_client.on_socket_open = self.on_mqtt_socket_open
+    self.mqtt_client.on_socket_close = self.on_mqtt_socket_close
+    self.mqtt_client.on_socket_register_write = self.on_mqtt_socket_register_write
+    self.mqtt_client.on_socket_unregister_write = (
+      self.on_mqtt_socket_unregister_write)
+    self.mqtt_client.on_message = self.on_mqtt_message
+    self.mqtt_client.on_publish = self.on_mqtt_publish
+    # Already connected by init_mqtt_client, hook up the existing socket.
+    if self.mqtt_client.socket():
+      self.on_mqtt_socket_open(self.mqtt_client, None, self.mqtt_client.socket())
+      if self.mqtt_client.want_write():
+        self.on_mqtt_socket_register_write(
+          self.mqtt_client, None, self.mqtt_client.socket())
+    self.mqtt_client.subscribe('%s/#' % self.mqtt_subscribe_topic,
+                               MQTT_SUBSCRIBE_QOS)
+
+    tasks = [self.mqtt_publisher(), self.mqtt_misc_loop(), self.serial_session()]
+    if self.policy.coalescing:
+      tasks.append(self.mqtt_flush_loop())
+    if self.rpc is not None:
+      tasks.append(self.rpc_expire_loop())
+    if self.chunks is not None:
+      tasks.append(self.chunk_expire_loop())
+    await asyncio.gather(*tasks)
+
+  # MQTT side
+
+  def on_mqtt_socket_open(self, client, userdata, sock):
+    self.mqtt_socket = sock
+    if self.mqtt_reading:
+      self.loop.add_reader(sock, client.loop_read)
+
+  def on_mqtt_socket_close(self, client, userdata, sock):
+    self.loop.remove_reader(sock)
+    self.loop.remove_writer(sock)
+    self.mqtt_socket = None
+
+  def on_mqtt_socket_register_write(self, client, userdata, sock):
+    self.loop.add_writer(sock, client.loop_write)
+
+  def on_mqtt_socket_unregister_write(self, client, userdata, sock):
+    self.loop.remove_writer(sock)
+
+  def pause_mqtt_reading(self):
+    if self.mqtt_reading:
+      self.mqtt_reading = False
+      if self.mqtt_socket:
+        self.loop.remove_reader(self.mqtt_socket)
+
+  def resume_mqtt_reading(self):
+    if not self.mqtt_reading:
+      self.mqtt_reading = True
+      if self.mqtt_socket:
+        self.loop.add_reader(self.mqtt_socket, self.mqtt_client.loop_read)
+
+  async def mqtt_misc_loop(self):
+    while True:
+      if self.mqtt_client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+        try:
+          self.mqtt_client.reconnect()
+          self.mqtt_client.subscribe('%s/#' % self.mqtt_subscribe_topic,
+                                     MQTT_SUBSCRIBE_QOS)
+        except OSError as e:
+          LOG.warning('MQTT reconnection attempt failed, waiting %d s: %s',
+                      RECONNECT_TIMEOUT_S, str(e))
+          await asyncio.sleep(RECONNECT_TIMEOUT_S)
+      await asyncio.sleep(MQTT_MISC_PERIOD_S)
+
+  def on_mqtt_publish(self, client, userdata, mid):
+    # Only publishes of mqtt_publisher hold a slot, not stats.
+    if mid in self.slot_mids:
+      self.slot_mids.remove(mid)
+      self.publish_slots.release()
+    elif self.completed_mids is not None:
+      # paho may write and complete a publish before returning its mid.
+      self.completed_mids.add(mid)
+    self.publish_tracker.on_publish(client, userdata, mid)
+
+  def publish_threadsafe(self, topic, payload):
+    """Publishes from another thread, paho is only used on the event loop."""
+    if self.loop is not None:
+      self.loop.call_soon_threadsafe(self.mqtt_client.publish, topic, payload)
+
+  def queue_publish(self, topic_policy, payload, qos, retain):
+    self.outgoing.append((topic_policy, payload, qos, retain))
+
+  def publish_rpc_error(self, topic_policy, payload, qos, retain):
+    # Published by mqtt_publisher, within the publish slots.
+    self.queue_publish(topic_policy, payload, qos, retain)
+    self.publish_queue.put_nowait(None)  # Wakes up mqtt_publisher.
+
+  async def mqtt_flush_loop(self):
+    while True:
+      await asyncio.sleep(self.publisher.flush_window_s)
+      # Flush from the publisher task, so publishes stay in order.
+      self.publish_queue.put_nowait(None)
+
+  async def rpc_expire_loop(self):
+    while True:
+      await asyncio.sleep(RPC_EXPIRE_PERIOD_S)
+      self.rpc.expire()
+
+  async def chunk_expire_loop(self):
+    while True:
+      await asyncio.sleep(CHUNK_EXPIRE_PERIOD_S)
+      self.chunks.expire()
+
+  async def mqtt_publisher(self):
+    while True:
+      item = await self.publish_queue.get()
+      if self.publish_queue.qsize() <= self.queue_size // 2:
+        self.resume_serial_reading()
+
+      if item is None:
+        self.publisher.flush_if_due()
+      else:
+        line, self.metrics.read_at = item
+        process_serial_line(line, self.publisher, self.policy, self.metrics,
+                            self.rpc, self.handlers)
+
+      while self.outgoing:
+        topic_policy, msg_str, qos, retain = self.outgoing.popleft()
+        # Wait for paho to complete earlier publishes, if too many are pending.
+        await self.publish_slots.acquire()
+        self.completed_mids = set()
+        info = self.mqtt_client.publish(
+          topic_policy.topic, msg_str, qos=qos, retain=retain)
+        completed_mids, self.completed_mids = self.completed_mids, None
+        if (info.mid in completed_mids or
+            (info.rc != mqtt.MQTT_ERR_SUCCESS and qos == 0)):
+          # Completed already, or dropped by paho and on_publish will not be
+          # called.
+          self.publish_slots.release()
+        else:
+          self.slot_mids.add(info.mid)
+        self.metrics.published += 1
+        self.publish_tracker.on_sent(info, qos, self.metrics)
+        if LOG.isEnabledFor(topic_policy.log_level):
+          LOG.log(topic_policy.log_level, 'Published %s: %s',
+                  topic_policy.topic, msg_str)
 
+  def on_mqtt_message(self, client, userdata, message):
     try:
-      while True:
-        process_serial_readline(serial_client, mqtt_client, mqtt_publish_topic, options_json)
+      serial_data = mqtt_message_to_serial(
+        message, self.mqtt_subscribe_topic, self.codec, self.rpc)
+    except Exception as e:
+      # Log and ignore any other message (broken message?)
+      LOG.error('Exception handling MQTT subscribe message: %s', str(e),
+                exc_info=True)
+      return
+    if serial_data is None:
+      return
+
+    if not self.serial_client.is_open:
+      # Buffered until reconnected. Pausing MQTT reading for a disconnect of
+      # unknown length would stall keepalives, so the oldest message goes.
+      if self.write_queue.qsize() >= self.queue_size:
+        self.write_queue.get_nowait()
+        self.write_dropped += 1
+        LOG.warning('Serial closed and write queue full, dropping oldest '
+                    'message. Received on topic: %s', message.topic)
+      self.write_queue.put_nowait(serial_data)
+      return
+    self.write_queue.put_nowait(serial_data)
+    if self.write_queue.qsize() >= self.queue_size:
+      self.pause_mqtt_reading()
+
+  # Serial side
+
+  def on_serial_readable(self):
+    try:
+      data = self.serial_client.read(self.serial_client.in_waiting or 1)
     except serial.SerialException as se:
-      LOG.warning('Serial disconnected: %s', str(se))
-    except serial.Exception as e:
-      LOG.warning('Serial disconnected: %s', e)
+      self.on_serial_error(se)
+      return
+    lines = self.line_reader.feed(data)
+    if lines:
+      read_at = time.monotonic()
+      self.metrics.on_serial_lines(lines, read_at)
+      for line in lines:
+        self.publish_queue.put_nowait((line, read_at))
+    if self.publish_queue.qsize() >= self.queue_size:
+      self.pause_serial_reading()
+
+  def pause_serial_reading(self):
+    if self.serial_reading:
+      self.serial_reading = False
+      self.loop.remove_reader(self.serial_client.fileno())
+
+  def resume_serial_reading(self):
+    if not self.serial_reading and self.serial_client.is_open:
+      self.serial_reading = True
+      self.loop.add_reader(self.serial_client.fileno(), self.on_serial_readable)
+
+  def on_serial_error(self, error):
+    if not self.serial_lost.done():
+      self.serial_lost.set_result(error)
+
+  async def wait_serial_writable(self):
+    writable = self.loop.create_future()
+    fd = self.serial_client.fileno()
+    self.loop.add_writer(
+      fd, lambda: writable.done() or writable.set_result(None))
+    try:
+      await writable
     finally:
-      serial_client.close()
+      self.loop.remove_writer(fd)
 
-    # Reconnection loop
-    LOG.info('Disconnected, will attempt reconnect.')
-    reconnect_serial_client(serial_client)
+  async def serial_writer(self):
+    try:
+      while True:
+        serial_data = await self.write_queue.get()
+        if self.write_queue.qsize() <= self.queue_size // 2:
+          self.resume_mqtt_reading()
+
+        view = memoryview(serial_data)
+        while view:
+          written = self.serial_client.write(view)
+          view = view[written or 0:]
+          if view:
+            await self.wait_serial_writable()
+        LOG.info("Sent to serial: %s", serial_data)
+    except serial.SerialException as se:
+      self.on_serial_error(se)
+
+  async def serial_session(self):
+    while True:
+      LOG.info(
+        'Start to listen to serial port and mqtt topic. '
+        'serial_client.is_open: %s',
+        self.serial_client.is_open)
+
+      self.serial_lost = self.loop.create_future()
+      self.resume_serial_reading()
+      writer = self.loop.create_task(self.serial_writer())
+      error = await self.serial_lost
+      LOG.warning('Serial disconnected: %s', str(error))
+
+      writer.cancel()
+      self.pause_serial_reading()
+      self.serial_client.close()
+      self.line_reader.reset()
+      self.metrics.on_disconnect()
+      # Messages to serial are queued until reconnected, see on_mqtt_message.
+      self.resume_mqtt_reading()
+
+      # Reconnection loop
+      LOG.info('Disconnected, will attempt reconnect.')
+      await self.loop.run_in_executor(
+        None, reconnect_serial_client, self.serial_client)
+      self.metrics.on_reconnect()
+
+
+def main():
+  init_logger_stdout()
+
+  LOG.info('Serial2Mqtt starting...')
+
+  LOG.info('Reading options.json')
+  with open('/data/options.json') as options_file:
+    options_json = json.load(options_file)
+
+  run_bridge(options_json)
+
+
+def run_bridge(options_json):
+  """Runs the bridge with the given options, does not return."""
+  ports_options = init_ports_options(options_json)
+
+  LOG.info('Init MQTT client')
+  mqtt_client = init_mqtt_client(options_json)
+
+  if options_json.get('engine', 'thread') == 'asyncio':
+    if len(ports_options) > 1:
+      LOG.fatal('The asyncio engine supports a single serial port, got %d. '
+                'Use the thread engine for serial_ports.', len(ports_options))
+      sys.exit(1)
+    if ports_options[0].get('flow_control', 'none') != 'none':
+      LOG.fatal('The asyncio engine does not support flow_control. Use the '
+                'thread engine.')
+      sys.exit(1)
+    port_options = ports_options[0]
+    LOG.info('Init Serial port')
+    serial_client = init_serial_client(port_options)
+    mqtt_publish_topic, mqtt_subscribe_topic = init_topics(port_options)
+    LOG.info('Starting asyncio engine')
+    bridge = AsyncioBridge(serial_client, mqtt_client, mqtt_publish_topic,
+                           mqtt_subscribe_topic, port_options)
+    init_metrics_reporter(
+      bridge.publish_threadsafe, [(bridge.stats_topic, bridge.metrics)],
+      options_json).start()
+    asyncio.run(bridge.run())
+    return
+
+  LOG.info('Init Serial ports')
+  publish_tracker = PublishTracker()
+  ports = [SerialPortBridge(mqtt_client, port_options, publish_tracker)
+           for port_options in ports_options]
+  multiplexer = SerialMultiplexer(mqtt_client, ports, publish_tracker)
+  init_metrics_reporter(
+    mqtt_client.publish, [(port.stats_topic, port.metrics) for port in ports],
+    options_json).start()
+
+  LOG.info('Subscribe to topics')
+  multiplexer.subscribe()
+  mqtt_client.loop_start()
+
+  multiplexer.run()
 
 
 if __name__ == "__main__":